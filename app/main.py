@@ -1,27 +1,103 @@
+import asyncio
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager, suppress
+
+from decouple import config
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi_csrf_protect import CsrfProtect
 from fastapi_csrf_protect.exceptions import CsrfProtectError
-from routers import auth, todo
+from routers import auth, metrics, todo
 from schemas.auth import CsrfSettings
 from schemas.common import SuccessMessage
+from utils.auth import password_pool
+from utils.cache import create_cache
+from utils.dependencies import DATABASE_NAME, connect_client, uses_memory_backend
+from utils.events import EventHub, watch_changes
+from utils.indexes import REQUIRED_COLLECTIONS, ensure_indexes
+from utils.metrics import MetricsMiddleware
+from utils.rate_limit import create_auth_rate_limiter
+from utils.search import InvertedIndex
+from utils.slow_queries import slow_queries
+from utils.warmup import warm_up
 
 # 設定の定数を定義
 ORIGINS = ["http://localhost:3000", "http://localhost:80", "https://fastapi-react-todo.onrender.com"]
 
 
+@asynccontextmanager
+async def lifespan(fastapi: FastAPI) -> AsyncIterator[None]:
+    """
+    プロセス全体で共有するリソースの作成と解放を行う
+    - MongoDBクライアント(接続プール)はプロセスごとに1つだけ作成し、終了時に閉じる
+    - todoの読み取り結果のキャッシュを作成する
+    - 遅いクエリのexplainに使うクライアントを設定する
+    - MONGO_ENSURE_INDEXESが有効な場合は、定義されたインデックスを作成する
+      ユーザー登録の重複の検出に必要なemailのユニークインデックスは、リクエストの受け付け前に作成する
+    - APP_PREWARMが有効な場合は、最初のリクエストを待たずにMongoDBへの接続やパスワードハッシュの準備を行う
+      起動(最初のリクエストの受け付け)を遅らせないように、インデックスの作成と共にバックグラウンドで実行する
+    - todoの変更イベントのEventHubを作成する。TODO_EVENTS_CHANGE_STREAMが有効な場合は、
+      書き込んだワーカーから直接配信する代わりに、MongoDBの変更ストリームから全てのワーカーに配信する
+    - テキストインデックスを使えないmemory://の場合は、検索用の転置インデックスを作成する
+    - ログインとユーザー登録の回数の制限を作成する
+
+    :param fastapi: FastAPIインスタンス
+    :return: なし
+    """
+    fastapi.state.mongo_client = connect_client()
+    slow_queries.bind(fastapi.state.mongo_client)
+    fastapi.state.todo_cache = create_cache()
+    fastapi.state.event_hub = EventHub()
+    fastapi.state.todo_events = fastapi.state.event_hub
+    fastapi.state.todo_search = InvertedIndex() if uses_memory_backend() else None
+    fastapi.state.auth_rate_limiter = create_auth_rate_limiter()
+    watcher = None
+    warmer = None
+    try:
+        db = fastapi.state.mongo_client[DATABASE_NAME]
+        if fastapi.state.todo_search:
+            await fastapi.state.todo_search.rebuild(db.todo)
+        ensure = config("MONGO_ENSURE_INDEXES", default=True, cast=bool)
+        if ensure:
+            await ensure_indexes(db, REQUIRED_COLLECTIONS)
+        if config("APP_PREWARM", default=True, cast=bool):
+            warmer = asyncio.create_task(warm_up(db, ensure))
+        elif ensure:
+            await ensure_indexes(db)
+        if config("TODO_EVENTS_CHANGE_STREAM", default=False, cast=bool):
+            fastapi.state.todo_events = None
+            watcher = asyncio.create_task(watch_changes(db, fastapi.state.event_hub))
+        yield
+    finally:
+        for task in (watcher, warmer):
+            if task:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+        if fastapi.state.todo_cache:
+            await fastapi.state.todo_cache.close()
+        if fastapi.state.auth_rate_limiter:
+            await fastapi.state.auth_rate_limiter.close()
+        await slow_queries.close()
+        fastapi.state.mongo_client.close()
+        password_pool.shutdown()
+
+
 def create_app() -> FastAPI:
     """
     アプリケーションの作成と設定を行う
 
     :return: FastAPI
     """
-    fastapi = FastAPI()
+    fastapi = FastAPI(lifespan=lifespan)
     fastapi.include_router(todo.router)
     fastapi.include_router(auth.router)
+    fastapi.include_router(metrics.router)
     add_cors_middleware(fastapi, ORIGINS)
     configure_csrf(fastapi)
+    # 最も外側で計測するために最後に追加する
+    fastapi.add_middleware(MetricsMiddleware)
     return fastapi
 
 
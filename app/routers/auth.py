@@ -1,15 +1,25 @@
-from fastapi import APIRouter, Depends, Request, Response
+from __future__ import annotations
+
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from fastapi.encoders import jsonable_encoder
 from fastapi_csrf_protect import CsrfProtect
 from schemas.auth import CsrfToken
 from schemas.common import SuccessMessage
 from schemas.user import UserBody, UserInfo
 from services.user import UserService
-from utils.auth import AuthJwtCsrf
+from utils.auth import AuthJwtCsrf, Principal, validate_csrf
+from utils.dependencies import get_auth_rate_limiter, get_principal, get_user_service
+from utils.rate_limit import AuthRateLimiter
 
 router: APIRouter = APIRouter()
-auth = AuthJwtCsrf()
-service = UserService()
+# そのままクライアントに返す例外のステータスコード。制限(429)とハッシュ計算のキューが満杯(503)はRetry-After付きで返す
+# それ以外の失敗は、これまで通り200でメッセージを返す
+PASSTHROUGH_STATUS_CODES = frozenset({429, 503})
+
+logger = logging.getLogger(__name__)
 
 
 @router.get("/api/csrf-token", response_model=CsrfToken)
@@ -27,42 +37,65 @@ def generate_csrf_token(response: Response, csrf_protect: CsrfProtect = Depends(
 
 
 @router.post("/api/register", response_model=UserInfo)
-async def signup(request: Request, user: UserBody, csrf_protect: CsrfProtect = Depends()) -> dict:
+async def signup(request: Request, user: UserBody, csrf_protect: CsrfProtect = Depends(),
+                 service: UserService = Depends(get_user_service),
+                 limiter: Optional[AuthRateLimiter] = Depends(get_auth_rate_limiter)) -> dict:
     """
     ユーザー登録する
     :param request: リクエスト
     :param user: ユーザー情報
     :param csrf_protect: CsrfProtectインスタンス
+    :param service: UserService
+    :param limiter: ログインとユーザー登録の制限
     :return: 登録した情報
     """
     try:
-        await csrf_protect.validate_csrf(request)
+        # CSRFトークンの無いリクエストで他人のメールアドレスの制限を使い切れないように、先にCSRFを検証する
+        # 制限はパスワードのハッシュ計算の前に確認する
+        await validate_csrf(request, csrf_protect)
+        if limiter:
+            await limiter.check(request.client.host if request.client else None, user.email)
         user = jsonable_encoder(user)
         return await service.register(user)
+    except HTTPException as e:
+        if e.status_code in PASSTHROUGH_STATUS_CODES:
+            raise
+        logger.info("%s failed: %s", request.url.path, e.detail)
+        return {"message": str(e)}
     except Exception as e:
-        print(e)
+        logger.exception("%s failed", request.url.path)
         return {"message": str(e)}
 
 
 @router.post("/api/login", response_model=SuccessMessage)
-async def login(request: Request, response: Response, user: UserBody, csrf_protect: CsrfProtect = Depends()) -> dict:
+async def login(request: Request, response: Response, user: UserBody, csrf_protect: CsrfProtect = Depends(),
+                service: UserService = Depends(get_user_service),
+                limiter: Optional[AuthRateLimiter] = Depends(get_auth_rate_limiter)) -> dict:
     """
     ログイン認証を行う
     :param request: リクエスト
     :param response: レスポンス
     :param user: ユーザー情報
     :param csrf_protect: CsrfProtectインスタンス
+    :param service: UserService
+    :param limiter: ログインとユーザー登録の制限
     :return: ログイン成功メッセージ
     """
     try:
-        # csrf_protect.validate_csrf(csrf_protect.get_csrf_from_headers(request.headers))
-        await csrf_protect.validate_csrf(request)
+        await validate_csrf(request, csrf_protect)
+        if limiter:
+            await limiter.check(request.client.host if request.client else None, user.email)
         user = jsonable_encoder(user)
         token = await service.authenticate(user)
-        auth.set_jwt_cookie(response, token)
+        AuthJwtCsrf.set_jwt_cookie(response, token)
         return {"message": "Login successful"}
+    except HTTPException as e:
+        if e.status_code in PASSTHROUGH_STATUS_CODES:
+            raise
+        logger.info("%s failed: %s", request.url.path, e.detail)
+        return {"message": str(e)}
     except Exception as e:
-        print(e)
+        logger.exception("%s failed", request.url.path)
         return {"message": str(e)}
 
 
@@ -75,21 +108,18 @@ async def logout(request: Request, response: Response, csrf_protect: CsrfProtect
     :param csrf_protect: CsrfProtectインスタンス
     :return: ログアウト成功メッセージ
     """
-    # csrf_protect.validate_csrf(csrf_protect.get_csrf_from_headers(request.headers))
-    await csrf_protect.validate_csrf(request)
-    auth.clear_jwt_cookie(response)
+    await validate_csrf(request, csrf_protect)
+    AuthJwtCsrf.clear_jwt_cookie(response)
     return {"message": "Logout successful"}
 
 
 @router.get("/api/user", response_model=UserInfo)
-def get_user_refresh_jwt(request: Request, response: Response) -> dict:
+def get_user_refresh_jwt(response: Response, principal: Principal = Depends(get_principal)) -> dict:
     """
     ユーザー情報を取得する
-    :param request: リクエスト
     :param response: レスポンス
+    :param principal: 認証済みのユーザー
     :return: メールアドレス
     """
-    print(request.cookies)
-    subject, new_token = auth.update_jwt(request)
-    auth.set_jwt_cookie(response, new_token)
-    return {"email": subject}
+    AuthJwtCsrf.set_jwt_cookie(response, principal.new_token)
+    return {"email": principal.email}
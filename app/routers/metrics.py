@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import hmac
+from typing import Optional
+
+from decouple import config
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, Response
+from utils.auth import password_pool, verified_tokens
+from utils.metrics import PROMETHEUS_MEDIA_TYPE, metrics
+
+# メトリクスを公開するか。無効の場合は/metricsが404を返す
+METRICS_ENABLED = config("METRICS_ENABLED", default=False, cast=bool)
+# 設定した場合は、Authorization: Bearer <token>が一致するリクエストだけにメトリクスを返す
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+router: APIRouter = APIRouter()
+
+
+def verify_metrics_access(authorization: Optional[str] = Header(None)) -> None:
+    """
+    メトリクスを取得できるかを確認する
+
+    :param authorization: Authorizationヘッダー
+    :return: なし
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not METRICS_TOKEN:
+        return
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+
+
+@router.get("/metrics", include_in_schema=False, dependencies=[Depends(verify_metrics_access)])
+def fetch_metrics(request: Request) -> Response:
+    """
+    Prometheusのテキスト形式でメトリクスを取得する
+    リクエストとMongoDBのコマンドのメトリクスに加えて、各コンポーネントのstats()をカウンターとゲージとして出力する
+    METRICS_ENABLEDが無効の場合は404、METRICS_TOKENと一致しない場合は401を返す
+    :param request: リクエスト
+    :return: メトリクス
+    """
+    state = request.app.state
+    stats = {
+        "password_pool": password_pool.stats(),
+        "jwt_cache": verified_tokens.stats(),
+    }
+    todo_cache = getattr(state, "todo_cache", None)
+    if todo_cache is not None:
+        stats["todo_cache"] = todo_cache.stats()
+    auth_rate_limiter = getattr(state, "auth_rate_limiter", None)
+    if auth_rate_limiter is not None:
+        stats["auth_rate_limit"] = auth_rate_limiter.stats()
+    event_hub = getattr(state, "event_hub", None)
+    if event_hub is not None:
+        stats["todo_events"] = event_hub.stats()
+    return Response(metrics.render(stats), media_type=PROMETHEUS_MEDIA_TYPE)
@@ -1,98 +1,287 @@
-from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
 from fastapi.encoders import jsonable_encoder
-from fastapi_csrf_protect import CsrfProtect
-from schemas.todo import Todo, TodoBody
-from services.todo import TodoService
-from starlette.status import HTTP_201_CREATED
-from utils.auth import AuthJwtCsrf
+from fastapi.responses import StreamingResponse
+from schemas.todo import Todo, TodoBatch, TodoBody, TodoChanges, TodoOperationResult, TodoSort
+from services.todo import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, TodoService
+from starlette.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_304_NOT_MODIFIED
+from utils.auth import JWT_LIFETIME_SECONDS, AuthJwtCsrf, Principal
+from utils.common import NDJSON_MEDIA_TYPE, FastJSONResponse, to_ndjson
+from utils.dependencies import get_event_hub, get_principal, get_todo_service
+from utils.etag import etag_matches, make_etag, make_list_etag, parse_if_match
+from utils.events import SSE_MEDIA_TYPE, EventHub, to_sse
 
 router = APIRouter()
-auth = AuthJwtCsrf()
-service = TodoService()
+# ブラウザにレスポンスを保存させつつ、使う前に必ずETagで再検証させる
+PRIVATE_REVALIDATE = "private, no-cache"
+# イベントストリームはJWTの有効期間ごとに切断し、再接続時に認証をやり直させる
+EVENT_STREAM_SECONDS = JWT_LIFETIME_SECONDS
+
+
+def not_modified(etag: str, new_token: Optional[str]) -> Response:
+    """
+    304 Not Modifiedのレスポンスを作成する
+
+    :param etag: 現在のETag
+    :param new_token: 再発行したJWT
+    :return: レスポンス
+    """
+    response = Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": PRIVATE_REVALIDATE})
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    return response
+
+
+def json_response(content: Any, response: Response) -> FastJSONResponse:
+    """
+    サービスの戻り値をそのままJSONにしたレスポンスを作成する
+    - サービスは検証済みの入力から決まったフィールドだけを返すので、response_modelによる再検証と変換を省略する
+      (Responseを返すとFastAPIはresponse_modelを使わない。response_modelはOpenAPIのスキーマとして残す)
+    - 依存関係で受け取ったresponseに設定したステータスコードとヘッダー(Cookie、ETagなど)を引き継ぐ
+
+    :param content: JSONに変換できる値
+    :param response: 依存関係で受け取ったレスポンス
+    :return: レスポンス
+    """
+    json_response = FastJSONResponse(content, status_code=response.status_code or HTTP_200_OK)
+    json_response.raw_headers.extend(response.raw_headers)
+    return json_response
 
 
 @router.post("/api/todo", response_model=Todo)
-async def create(request: Request, response: Response, data: TodoBody, csrf_protect: CsrfProtect = Depends()) -> dict:
+async def create(response: Response, data: TodoBody, principal: Principal = Depends(get_principal),
+                 service: TodoService = Depends(get_todo_service)) -> Response:
     """
     todoを作成する
-    :param request: リクエスト
     :param response: レスポンス
     :param data: todoの情報
-    :param csrf_protect: CsrfProtectインスタンス
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
     :return: 作成したtodo
     """
-    new_token = auth.update_jwt_with_csrf(request, csrf_protect, request.headers)
+    owner, new_token = principal.email, principal.new_token
     todo = jsonable_encoder(data)
-    res = await service.register(todo)
+    res = await service.register(owner, todo)
     response.status_code = HTTP_201_CREATED
-    auth.set_jwt_cookie(response, new_token)
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
     if res:
-        return res
+        response.headers["ETag"] = make_etag(res["version"])
+        return json_response(res, response)
     raise HTTPException(status_code=400, detail="Failed to create todo")
 
 
+@router.post("/api/todos:batch", response_model=list[TodoOperationResult])
+async def batch(response: Response, data: TodoBatch, principal: Principal = Depends(get_principal),
+                service: TodoService = Depends(get_todo_service)) -> Response:
+    """
+    todoの作成・更新・削除をまとめて実行する
+    認証は一括処理全体で1回だけ行い、操作ごとの結果を返す
+    :param response: レスポンス
+    :param data: 操作のリスト
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
+    :return: 操作ごとの結果のリスト
+    """
+    owner, new_token = principal.email, principal.new_token
+    results = await service.bulk(owner, jsonable_encoder(data.operations))
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    return json_response(results, response)
+
+
 @router.get("/api/todos", response_model=list[Todo])
-async def fetch_todos(request: Request) -> list[dict]:
+async def fetch_todos(request: Request, response: Response,
+                      limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                      after: Optional[str] = None, sort: Optional[TodoSort] = None,
+                      created_after: Optional[datetime] = None, created_before: Optional[datetime] = None,
+                      title_prefix: Optional[str] = Query(None, min_length=1, max_length=256),
+                      if_none_match: Optional[str] = Header(None),
+                      principal: Principal = Depends(get_principal),
+                      service: TodoService = Depends(get_todo_service)) -> Response:
+    """
+    ログインユーザーのtodoのリストを取得する
+    - Acceptヘッダーにapplication/x-ndjsonを指定した場合は全件をNDJSONでストリーミングする
+    - それ以外はlimit件ずつ返し、続きがある場合はX-Next-CursorヘッダーとLinkヘッダーで次ページを示す
+    - If-None-MatchがリストのETagと一致する場合は、リストを取得せずに304を返す
+      書き込みの直後(TODO_WRITE_SETTLE_SECONDS以内)はETagを付けない
+    - 並べ替えと絞り込みはDBで行う。インデックスで並べ替えられない組み合わせは400を返す
+    :param request: リクエスト
+    :param response: レスポンス
+    :param limit: 1ページあたりの最大件数
+    :param after: 次ページカーソル
+    :param sort: 並べ替え(created_at, updated_at, title。先頭に-を付けると降順)。省略した場合は作成順
+    :param created_after: この日時以降に作成されたtodoに絞り込む
+    :param created_before: この日時より前に作成されたtodoに絞り込む
+    :param title_prefix: タイトルがこの文字列で始まるtodoに絞り込む
+    :param if_none_match: If-None-Matchヘッダー
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
+    :return: todoのリスト
+    """
+    owner, new_token = principal.email, principal.new_token
+    filters = {name: value for name, value in (("sort", sort), ("created_after", created_after),
+                                               ("created_before", created_before), ("title_prefix", title_prefix))
+               if value is not None}
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        streaming_response = StreamingResponse(to_ndjson(service.iter_todos(owner, after, filters)),
+                                               media_type=NDJSON_MEDIA_TYPE)
+        AuthJwtCsrf.set_jwt_cookie(streaming_response, new_token)
+        return streaming_response
+    # リビジョンが変わっていなければリストも変わっていないので、リストの読み取りを省略する
+    # ETagとリストのキャッシュに同じリビジョンを使い、古いリストに新しいETagが付かないようにする
+    # 実行中の可能性がある書き込みがある間はリビジョンが決まらないので、ETagを付けない
+    revision = await service.get_revision(owner)
+    etag = None if revision is None else make_list_etag(owner, revision, limit, after, *sorted(filters.items()))
+    if etag and etag_matches(if_none_match, etag):
+        return not_modified(etag, new_token)
+    todos, next_cursor = await service.get_todos(owner, limit, after, filters, revision)
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    if etag:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = PRIVATE_REVALIDATE
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(after=next_cursor)}>; rel="next"'
+    return json_response(todos, response)
+
+
+@router.get("/api/todos/changes", response_model=TodoChanges)
+async def fetch_changes(response: Response, since: Optional[str] = None,
+                        limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                        principal: Principal = Depends(get_principal),
+                        service: TodoService = Depends(get_todo_service)) -> Response:
+    """
+    同期トークン以降に作成・更新・削除されたtodoだけを取得する
+    - sinceを省略した場合は現在の同期トークンだけを返す。その後に/api/todosでリスト全体を取得する
+    - 同期トークンが保持期間より古い場合は410を返す。リスト全体を取得し直す
+    :param response: レスポンス
+    :param since: 前回の同期で受け取った同期トークン
+    :param limit: 1回で返す変更の最大件数
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
+    :return: 変更されたtodo、削除されたtodoのIDと次回の同期トークン
     """
-    全てのtodoを取得する
+    owner, new_token = principal.email, principal.new_token
+    changes = await service.get_changes(owner, since, limit)
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    return json_response(changes, response)
+
+
+@router.get("/api/todos/search", response_model=list[Todo])
+async def search_todos(request: Request, response: Response, q: str = Query(..., min_length=1, max_length=256),
+                       limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), after: Optional[str] = None,
+                       principal: Principal = Depends(get_principal),
+                       service: TodoService = Depends(get_todo_service)) -> Response:
+    """
+    タイトルと詳細説明にいずれかの検索語を含むログインユーザーのtodoを、一致の度合いが高い順に取得する
+    - limit件ずつ返し、続きがある場合はX-Next-CursorヘッダーとLinkヘッダーで次ページを示す
     :param request: リクエスト
+    :param response: レスポンス
+    :param q: 検索文字列(空白区切りの検索語)
+    :param limit: 1ページあたりの最大件数
+    :param after: 次ページカーソル
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
     :return: todoのリスト
     """
-    # auth.verify_jwt(request)
-    return await service.get_todos()
+    owner, new_token = principal.email, principal.new_token
+    todos, next_cursor = await service.search_todos(owner, q, limit, after)
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(after=next_cursor)}>; rel="next"'
+    return json_response(todos, response)
+
+
+@router.get("/api/todos/events")
+async def subscribe_events(principal: Principal = Depends(get_principal),
+                           hub: EventHub = Depends(get_event_hub)) -> StreamingResponse:
+    """
+    ログインユーザーのtodoの作成・更新・削除のイベントをServer-Sent Eventsで受け取る
+    - イベントの種類はcreated, updated, deletedとresync
+    - resyncは取りこぼしたイベントがあることを示すので、/api/todos/changesで差分同期する
+    :param principal: 認証済みのユーザー
+    :param hub: EventHub
+    :return: イベントストリーム
+    """
+    owner, new_token = principal.email, principal.new_token
+    response = StreamingResponse(to_sse(hub, owner, EVENT_STREAM_SECONDS), media_type=SSE_MEDIA_TYPE,
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
+    return response
 
 
 @router.get("/api/todos/{_id}", response_model=Todo)
-async def fetch_single(request: Request, response: Response, _id: str) -> dict:
+async def fetch_single(response: Response, _id: str, if_none_match: Optional[str] = Header(None),
+                       principal: Principal = Depends(get_principal),
+                       service: TodoService = Depends(get_todo_service)) -> Response:
     """
     単一のtodoを取得する
-    :param request: リクエスト
+    If-None-MatchがtodoのETagと一致する場合は304を返す
     :param response: レスポンス
     :param _id: todoのID
+    :param if_none_match: If-None-Matchヘッダー
+    :param principal: 認証済みのユーザー
+    :param service: TodoService
     :return: 取得したtodo
     """
-    _, new_token = auth.update_jwt(request)
-    todo = await service.get_single(_id)
-    auth.set_jwt_cookie(response, new_token)
+    owner, new_token = principal.email, principal.new_token
+    todo = await service.get_single(owner, _id)
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
     if todo:
-        return todo
+        etag = make_etag(todo.get("version", 0))
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag, new_token)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = PRIVATE_REVALIDATE
+        return json_response(todo, response)
     raise HTTPException(status_code=404, detail=f"Todo(id:{_id}) not found")
 
 
 @router.put("/api/todos/{_id}", response_model=Todo)
-async def update_single(request: Request, response: Response, _id: str, data: TodoBody,
-                        csrf_protect: CsrfProtect = Depends()) -> dict:
+async def update_single(response: Response, _id: str, data: TodoBody,
+                        principal: Principal = Depends(get_principal), if_match: Optional[str] = Header(None),
+                        service: TodoService = Depends(get_todo_service)) -> Response:
     """
     todoを更新する
-    :param request: リクエスト
+    If-Matchヘッダーを指定した場合は、そのバージョンと一致する場合のみ更新し、不一致の場合は412を返す
     :param response: レスポンス
     :param _id: todoのID
     :param data: 更新データ
-    :param csrf_protect: CsrfProtectインスタンス
+    :param principal: 認証済みのユーザー
+    :param if_match: If-Matchヘッダー
+    :param service: TodoService
     :return: 更新したtodo
     """
-    new_token = auth.update_jwt_with_csrf(request, csrf_protect, request.headers)
+    owner, new_token = principal.email, principal.new_token
     todo = jsonable_encoder(data)
-    res = await service.update(_id, todo)
-    auth.set_jwt_cookie(response, new_token)
+    res = await service.update(owner, _id, todo, parse_if_match(if_match))
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
     if res:
-        return res
+        response.headers["ETag"] = make_etag(res["version"])
+        return json_response(res, response)
     raise HTTPException(status_code=404, detail=f"Update failed for Todo(id:{_id})")
 
 
 @router.delete("/api/todos/{_id}", response_model=dict)
-async def delete_single(request: Request, response: Response, _id: str, csrf_protect: CsrfProtect = Depends()) -> dict:
+async def delete_single(response: Response, _id: str, principal: Principal = Depends(get_principal),
+                        if_match: Optional[str] = Header(None),
+                        service: TodoService = Depends(get_todo_service)) -> Response:
     """
     todoを削除する
-    :param request: リクエスト
+    If-Matchヘッダーを指定した場合は、そのバージョンと一致する場合のみ削除し、不一致の場合は412を返す
     :param response: レスポンス
     :param _id: todoのID
-    :param csrf_protect: CsrfProtectインスタンス
+    :param principal: 認証済みのユーザー
+    :param if_match: If-Matchヘッダー
+    :param service: TodoService
     :return: 削除の成否
     """
-    new_token = auth.update_jwt_with_csrf(request, csrf_protect, request.headers)
-    res = await service.delete(_id)
-    auth.set_jwt_cookie(response, new_token)
+    owner, new_token = principal.email, principal.new_token
+    res = await service.delete(owner, _id, parse_if_match(if_match))
+    AuthJwtCsrf.set_jwt_cookie(response, new_token)
     if res:
-        return {"message": "Todo deleted successfully"}
+        return json_response({"message": "Todo deleted successfully"}, response)
     raise HTTPException(status_code=404, detail=f"Delete failed for Todo(id:{_id})")
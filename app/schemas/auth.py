@@ -1,3 +1,5 @@
+from typing import Literal
+
 from decouple import config
 from pydantic import BaseModel
 
@@ -7,10 +9,19 @@ CRSF_SECRET_KEY = config("CSRF_SECRET_KEY")
 class CsrfSettings(BaseModel):
     """
     CSRF設定
+    CsrfProtect.load_configで読み込む
     - secret_key: CSRFトークンの秘密鍵
+    - cookie_key: 署名したトークンを入れるCookieの名前
+    - header_name: トークンを受け取るヘッダーの名前
+    - max_age: トークンの有効期間(秒)
+    - token_location: トークンを受け取る場所(headerまたはbody)
     - cookie_samesite: CSRFトークンのCookie
     """
     secret_key: str = CRSF_SECRET_KEY
+    cookie_key: str = "fastapi-csrf-token"
+    header_name: str = "X-CSRF-Token"
+    max_age: int = 3600
+    token_location: Literal["header", "body"] = "header"
     if config("ENVIRONMENT") == "production":
         cookie_samesite: str = "none"
         cookie_secure: bool = True
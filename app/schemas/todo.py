@@ -1,4 +1,11 @@
-from pydantic import BaseModel
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+MAX_BATCH_OPERATIONS = 1000
 
 
 class Todo(BaseModel):
@@ -7,10 +14,20 @@ class Todo(BaseModel):
     - id: アイテムのID
     - title: アイテムのタイトル
     - description アイテムの詳細説明
+    - version: 更新ごとに増えるバージョン(ETagとして使用する)
+    - created_at: 作成日時(日時の記録より前に作成されたアイテムはNone)
+    - updated_at: 最終更新日時(日時の記録より前に作成されたアイテムはNone)
     """
     id: str
     title: str
     description: str
+    version: int = 0
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
+# リストの並べ替え。先頭の-は降順を表す
+TodoSort = Literal["created_at", "-created_at", "updated_at", "-updated_at", "title", "-title"]
 
 
 class TodoBody(BaseModel):
@@ -21,3 +38,57 @@ class TodoBody(BaseModel):
     """
     title: str
     description: str
+
+
+class TodoOperation(BaseModel):
+    """
+    一括処理の1操作
+    - op: 操作の種類(create, update, delete)
+    - id: 対象のtodoのID(update, deleteで必須)
+    - data: todoの情報(create, updateで必須)
+    - version: 期待するバージョン。指定した場合は一致する場合のみ更新・削除する
+    """
+    op: Literal["create", "update", "delete"]
+    id: Optional[str] = None
+    data: Optional[TodoBody] = None
+    version: Optional[int] = None
+
+
+class TodoBatch(BaseModel):
+    """
+    一括処理のリクエスト
+    - operations: 操作のリスト
+    """
+    operations: list[TodoOperation] = Field(min_length=1, max_length=MAX_BATCH_OPERATIONS)
+
+
+class TodoOperationResult(BaseModel):
+    """
+    一括処理の1操作の結果
+    - index: リクエスト内の操作の位置
+    - op: 操作の種類
+    - status: 結果のHTTPステータスコード相当の値
+    - id: 対象のtodoのID
+    - version: 操作後のバージョン
+    - detail: 失敗した場合の理由
+    """
+    index: int
+    op: str
+    status: int
+    id: Optional[str] = None
+    version: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class TodoChanges(BaseModel):
+    """
+    差分同期の結果
+    - todos: 同期トークン以降に作成・更新されたtodo
+    - deleted: 同期トークン以降に削除されたtodoのID
+    - next_token: 次回の同期で指定する同期トークン
+    - has_more: 続きの変更があるかどうか。Trueの場合はすぐにnext_tokenで続きを取得する
+    """
+    todos: list[Todo]
+    deleted: list[str]
+    next_token: str
+    has_more: bool
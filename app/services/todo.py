@@ -1,80 +1,810 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import logging
+import re
+import time
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta, timezone
+
 from bson import ObjectId
+from bson.errors import InvalidId
+from decouple import config
+from fastapi import HTTPException
 from motor import motor_asyncio
-from utils.common import convert_document
-from utils.dependencies import connect_database
+from pymongo import ASCENDING, DESCENDING, DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from utils.cache import CacheBackend
+from utils.common import convert_document, decode_cursor, encode_cursor, to_projection, utc_now
+from utils.events import EventHub, deleted_event, todo_event
+from utils.indexes import TOMBSTONE_RETENTION_SECONDS, UnsupportedQueryError, find_supporting_index
+from utils.search import InvertedIndex, tokenize
+from utils.slow_queries import trace_queries
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+TODO_FIELDS = ["_id", "title", "description", "version", "created_at", "updated_at"]
+# versionフィールド導入前のドキュメントはバージョン0として返す
+TODO_DEFAULTS = {"version": 0, "created_at": None, "updated_at": None}
+TODO_PROJECTION = to_projection(TODO_FIELDS)
+# 差分同期では変更の順序を決めるためにシーケンス番号も取得する
+CHANGE_PROJECTION = to_projection([*TODO_FIELDS, "seq"])
+# 検索結果をテキストのスコア順に並べるためにスコアも取得する
+SEARCH_PROJECTION = {**TODO_PROJECTION, "score": {"$meta": "textScore"}}
+CACHE_TTL_SECONDS = config("TODO_CACHE_TTL_SECONDS", default=30, cast=float)
+# 書き込みは番号の割り当てからこの時間内に完了するものとして扱う。この間は実行中の可能性があるものとして、
+# 同期トークンをその手前までしか進めず、リストのETagとキャッシュも使わない
+WRITE_SETTLE_SECONDS = config("TODO_WRITE_SETTLE_SECONDS", default=5, cast=float)
+# 日時の値を持つフィールド。並べ替えのカーソルから値を復元する際に使う
+DATETIME_FIELDS = {"created_at", "updated_at"}
 
+logger = logging.getLogger(__name__)
 
+
+@trace_queries
 class TodoService:
-    def __init__(self, db: motor_asyncio.AsyncIOMotorDatabase = connect_database()) -> None:
+    def __init__(self, db: motor_asyncio.AsyncIOMotorDatabase, cache: CacheBackend | None = None,
+                 events: EventHub | None = None, search: InvertedIndex | None = None) -> None:
         """
         コンストラクタ
 
         :param db: DBインスタンス
+        :param cache: 読み取り結果のキャッシュ。Noneの場合はキャッシュしない
+        :param events: 変更イベントの配信先。Noneの場合は配信しない
+        :param search: 検索に使うプロセス内の転置インデックス。Noneの場合はMongoDBのテキストインデックスで検索する
         :return: なし
         """
         self.collection = db.todo
+        self.revisions = db.todo_revision
+        self.tombstones = db.todo_tombstone
+        self.cache = cache
+        self.events = events
+        self.search = search
 
-    async def register(self, data: dict) -> dict | bool:
+    async def register(self, owner: str, data: dict) -> dict | bool:
         """
         todoを登録する
 
+        :param owner: 所有者(ユーザーのメールアドレス)
         :param data: 登録するデータ
         :return: 登録されたデータオブジェクト
         """
-        todo = await self.collection.insert_one(data)
-        new_todo = await self.collection.find_one({"_id": todo.inserted_id})
-        if new_todo:
-            return convert_document(new_todo, ["_id", "title", "description"])
-        return False
+        # 登録内容は手元にあるので、再取得せずにそのまま返す
+        now = utc_now()
+        new_todo = {**data, "owner": owner, "version": 1, "created_at": now, "updated_at": now,
+                    "seq": await self._begin_write(owner)}
+        todo = await self.collection.insert_one(new_todo)
+        new_todo["_id"] = todo.inserted_id
+        registered = convert_document(new_todo, TODO_FIELDS, TODO_DEFAULTS)
+        self._publish(owner, todo_event("created", registered))
+        return registered
+
+    async def get_todos(self, owner: str, limit: int = DEFAULT_PAGE_SIZE, after: str | None = None,
+                        filters: dict | None = None, revision: int | None = None) -> tuple[list, str | None]:
+        """
+        キーセットページングで所有者のtodoのリストを取得する
+        並べ替えを指定しない場合は_idの順、指定した場合はそのフィールドと_idの順にする
+        キャッシュのキーにはリビジョンを含める。リビジョンはDBにあるので、どのワーカーで書き込んでも古いリストは参照されない
+        実行中の可能性がある書き込みがありリビジョンが決まらない場合は、キャッシュを使わない
+
+        :param owner: 所有者
+        :param limit: 1ページあたりの最大件数
+        :param after: 前のページが返した次ページカーソル
+        :param filters: 絞り込みと並べ替え(sort, created_after, created_before, title_prefix)
+        :param revision: 呼び出し元がETagのために読んだリビジョン。Noneの場合はキャッシュを使うときだけ読む
+        :return: todoのリストと次ページカーソル(最終ページの場合はNone)
+        :raises HTTPException: カーソルが不正な場合、絞り込みと並べ替えに使えるインデックスが無い場合(400)
+        """
+        query, sort, index = self._list_query(owner, after, filters)
+        key = None
+        if self.cache:
+            if revision is None:
+                revision = await self.get_revision(owner)
+            if revision is not None:
+                key = f"todos:{owner}:{revision}:{limit}:{after or ''}"
+                if filters:
+                    key += f":{sorted(filters.items())}"
+                cached = await self.cache.get(key)
+                if cached is not None:
+                    return cached[0], cached[1]
+
+        # 次ページの有無を判定するために1件多く取得する
+        cursor = self.collection.find(query, projection=TODO_PROJECTION, sort=sort, limit=limit + 1)
+        if filters:
+            # 確認したインデックス以外を使ってメモリ上で並べ替えることが無いように、インデックスを指定する
+            cursor = cursor.hint(index)
+        todo_list = await cursor.to_list(length=limit + 1)
+        has_more = len(todo_list) > limit
+        todos = [convert_document(todo, TODO_FIELDS, TODO_DEFAULTS) for todo in todo_list[:limit]]
+        next_cursor = None
+        if has_more:
+            next_cursor = self._encode_list_cursor(todos[-1], sort[0][0])
+        if key:
+            await self.cache.set(key, [todos, next_cursor], CACHE_TTL_SECONDS)
+        return todos, next_cursor
+
+    def iter_todos(self, owner: str, after: str | None = None, filters: dict | None = None) -> AsyncIterator[dict]:
+        """
+        所有者のtodoを1件ずつ取得する。件数に関わらずメモリ使用量は一定になる
+
+        :param owner: 所有者
+        :param after: 取得を開始するカーソル
+        :param filters: 絞り込みと並べ替え(get_todosと同じ)
+        :return: todoの非同期イテレータ
+        :raises HTTPException: カーソルが不正な場合、絞り込みと並べ替えに使えるインデックスが無い場合(400)
+        """
+        # カーソルの検証はレスポンス送信開始前に行いたいので、ここで即時にクエリを作成する
+        query, sort, index = self._list_query(owner, after, filters)
+        cursor = self.collection.find(query, projection=TODO_PROJECTION, sort=sort, batch_size=STREAM_BATCH_SIZE)
+        if filters:
+            cursor = cursor.hint(index)
+        return (convert_document(todo, TODO_FIELDS, TODO_DEFAULTS) async for todo in cursor)
+
+    @classmethod
+    def _list_query(cls, owner: str, after: str | None,
+                    filters: dict | None) -> tuple[dict, list[tuple[str, int]], str]:
+        """
+        リストを取得するクエリと並べ替えを作成し、定義されたインデックスで処理できることを確認する
+        - 並べ替えに使えるインデックスが無い場合は、DBがメモリ上で全件を並べ替えることになるので拒否する
+        - 絞り込みのフィールドがインデックスに無い場合は、取得したドキュメントで絞り込むことになるので警告する
+
+        :param owner: 所有者
+        :param after: 次ページカーソル
+        :param filters: 絞り込みと並べ替え
+        :return: クエリ、並べ替えと使用するインデックス名
+        :raises HTTPException: カーソルが不正な場合、絞り込みと並べ替えに使えるインデックスが無い場合(400)
+        """
+        filters = filters or {}
+        order = filters.get("sort")
+        if order is None:
+            query = cls._after_query(owner, after)
+            sort = [("_id", ASCENDING)]
+        else:
+            field = order.lstrip("-")
+            direction = DESCENDING if order.startswith("-") else ASCENDING
+            query = {"owner": owner}
+            if after is not None:
+                query["$or"] = cls._keyset_conditions(field, direction, *cls._decode_list_cursor(after, field))
+            sort = [(field, direction), ("_id", direction)]
+        ranges = []
+        created = {key: filters[name] for key, name in (("$gte", "created_after"), ("$lt", "created_before"))
+                   if filters.get(name) is not None}
+        if created:
+            query["created_at"] = created
+            ranges.append("created_at")
+        if filters.get("title_prefix"):
+            query["title"] = {"$regex": "^" + re.escape(filters["title_prefix"])}
+            ranges.append("title")
+        try:
+            index, unindexed = find_supporting_index("todo", ["owner"], sort, tuple(ranges))
+        except UnsupportedQueryError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from None
+        if unindexed:
+            logger.warning("Todo list filter on %s is not covered by index %s and is applied after the index scan",
+                           unindexed, index)
+        return query, sort, index
+
+    @staticmethod
+    def _keyset_conditions(field: str, direction: int, value: object, last_id: ObjectId) -> list[dict]:
+        """
+        (field, _id)の順で、前のページの最後のドキュメントより後ろにあるドキュメントの条件を作成する
+        値が無いドキュメント(null)は、MongoDBの並べ替えと同じく他のどの値よりも前に並ぶものとする
+
+        :param field: 並べ替えのフィールド
+        :param direction: 並べ替えの向き
+        :param value: 最後のドキュメントのフィールドの値
+        :param last_id: 最後のドキュメントの_id
+        :return: $orの条件のリスト
+        """
+        operator = "$gt" if direction == ASCENDING else "$lt"
+        same_value = {field: value, "_id": {operator: last_id}}
+        if value is None:
+            # 昇順ではnullの後ろに値のあるドキュメントが続き、降順ではnullが最後になる
+            return [same_value, {field: {"$ne": None}}] if direction == ASCENDING else [same_value]
+        conditions = [{field: {operator: value}}, same_value]
+        if direction == DESCENDING:
+            conditions.append({field: None})
+        return conditions
+
+    @staticmethod
+    def _encode_list_cursor(todo: dict, field: str) -> str:
+        """
+        ページの最後のtodoから次ページカーソルを作成する
+
+        :param todo: convert_documentで変換したtodo
+        :param field: 並べ替えのフィールド
+        :return: カーソル
+        """
+        if field == "_id":
+            return encode_cursor(todo["id"])
+        return encode_cursor(json.dumps([todo.get(field), todo["id"]], ensure_ascii=False))
+
+    @staticmethod
+    def _decode_list_cursor(cursor: str, field: str) -> tuple[object, ObjectId]:
+        """
+        並べ替えを指定したリストの次ページカーソルを、最後のtodoのフィールドの値と_idに戻す
+
+        :param cursor: カーソル
+        :param field: 並べ替えのフィールド
+        :return: フィールドの値と_id
+        :raises HTTPException: カーソルが不正な場合
+        """
+        try:
+            value, last_id = json.loads(decode_cursor(cursor))
+            if field in DATETIME_FIELDS and value is not None:
+                value = datetime.fromisoformat(value)
+            elif value is not None and not isinstance(value, str):
+                raise ValueError(f"Invalid cursor value: {value}")
+            return value, ObjectId(last_id)
+        except (InvalidId, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor") from None
 
-    async def get_todos(self) -> list:
+    @staticmethod
+    def _after_query(owner: str, after: str | None) -> dict:
         """
-        todoのリストを取得する
+        所有者のドキュメントのうち、カーソル以降のものを取得するクエリを作成する
 
-        :return: todoのリスト
+        :param owner: 所有者
+        :param after: カーソル
+        :return: クエリ
+        :raises HTTPException: カーソルが不正な場合
         """
-        todo_list = await self.collection.find().to_list(length=100)
-        return [convert_document(todo, ["_id", "title", "description"]) for todo in todo_list]
+        if after is None:
+            return {"owner": owner}
+        try:
+            return {"owner": owner, "_id": {"$gt": ObjectId(decode_cursor(after))}}
+        except (InvalidId, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor") from None
 
-    async def get_single(self, _id: str) -> dict | bool:
+    async def get_single(self, owner: str, _id: str) -> dict | bool:
         """
         単一のtodoを取得する
+        キャッシュには最後の書き込みのシーケンス番号をバージョンとして保存する。取得中に書き込みがあった場合、
+        書き込みが残した新しい番号の記録を古い値で上書きしないので、古いtodoがキャッシュに残ることはない
 
+        :param owner: 所有者
         :param _id: ドキュメントのID
         :return: todo
         """
-        todo = await self.collection.find_one({"_id": ObjectId(_id)})
+        key = self._single_key(owner, _id)
+        if self.cache:
+            cached = await self.cache.get(key)
+            # 書き込みが残した記録(値がNone)は、キャッシュされていないものとして扱う
+            if cached is not None and cached[1] is not None:
+                return cached[1]
+        # 差分同期と同じく、最後の書き込みのシーケンス番号も取得する
+        todo = await self.collection.find_one({"_id": ObjectId(_id), "owner": owner}, projection=CHANGE_PROJECTION)
         if todo:
-            return convert_document(todo, ["_id", "title", "description"])
+            seq = todo.get("seq", 0)
+            todo = convert_document(todo, TODO_FIELDS, TODO_DEFAULTS)
+            if self.cache:
+                await self.cache.set_versioned(key, seq, todo, CACHE_TTL_SECONDS)
+            return todo
         return False
 
-    async def update(self, _id: str, data: dict) -> dict | bool:
+    async def search_todos(self, owner: str, query: str, limit: int = DEFAULT_PAGE_SIZE,
+                           after: str | None = None) -> tuple[list, str | None]:
+        """
+        タイトルと詳細説明にいずれかの検索語を含む所有者のtodoを、一致の度合いが高い順に取得する
+
+        :param owner: 所有者
+        :param query: 検索文字列
+        :param limit: 1ページあたりの最大件数
+        :param after: 前のページが返した次ページカーソル
+        :return: todoのリストと次ページカーソル(最終ページの場合はNone)
+        :raises HTTPException: カーソルが不正な場合
+        """
+        offset = self._search_offset(after)
+        if not tokenize(query):
+            return [], None
+        # 次ページの有無を判定するために1件多く取得する
+        if self.search:
+            ids = self.search.search(owner, query, offset, limit + 1)
+            found = await self.collection.find(
+                {"owner": owner, "_id": {"$in": [ObjectId(_id) for _id in ids]}}, projection=TODO_PROJECTION
+            ).to_list(length=None)
+            by_id = {str(todo["_id"]): todo for todo in found}
+            todo_list = [by_id[_id] for _id in ids if _id in by_id]
+        else:
+            todo_list = await self.collection.find(
+                {"owner": owner, "$text": {"$search": query}}, projection=SEARCH_PROJECTION,
+                sort=[("score", {"$meta": "textScore"}), ("_id", ASCENDING)], skip=offset, limit=limit + 1
+            ).to_list(length=limit + 1)
+        next_cursor = None
+        if len(todo_list) > limit:
+            todo_list = todo_list[:limit]
+            next_cursor = encode_cursor(str(offset + limit))
+        return [convert_document(todo, TODO_FIELDS, TODO_DEFAULTS) for todo in todo_list], next_cursor
+
+    @staticmethod
+    def _search_offset(after: str | None) -> int:
+        """
+        検索結果の次ページカーソルから読み飛ばす件数を取得する
+        スコア順の結果はキーセットで続きを指定できないため、カーソルは件数を表す
+
+        :param after: カーソル
+        :return: 読み飛ばす件数
+        :raises HTTPException: カーソルが不正な場合
+        """
+        if after is None:
+            return 0
+        try:
+            offset = int(decode_cursor(after))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor") from None
+        if offset < 0:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        return offset
+
+    async def get_revision(self, owner: str) -> int | None:
+        """
+        所有者のtodoのリビジョンを取得する。所有者のtodoへの書き込みが始まるたびに増える
+        リビジョンは書き込みの前に進めるので、WRITE_SETTLE_SECONDS以内に始まった書き込みがある場合は、
+        まだリストに反映されていない可能性があるものとしてNoneを返す
+
+        :param owner: 所有者
+        :return: リビジョン。実行中の可能性がある書き込みがある場合はNone
+        """
+        state = await self.revisions.find_one({"_id": owner}, projection={"revision": 1, "recent": 1})
+        if not state:
+            return 0
+        if self._recent_writes(state, datetime.now(timezone.utc)):
+            return None
+        return state.get("revision", 0)
+
+    async def get_changes(self, owner: str, since: str | None, limit: int = DEFAULT_PAGE_SIZE) -> dict:
+        """
+        同期トークン以降に作成・更新・削除された所有者のtodoを、変更シーケンス番号の順に取得する
+        - sinceを省略した場合は、現在の同期トークンだけを返す。クライアントはその後にリスト全体を取得する
+        - 続きがある場合はhas_moreをTrueにし、next_tokenで続きを取得できる
+        - 実行中の可能性がある書き込みがある場合は、その最も小さい番号の手前までしかトークンを進めず、
+          取りこぼさないようにする
+
+        :param owner: 所有者
+        :param since: 前回の同期で受け取った同期トークン
+        :param limit: 1回で返す変更の最大件数
+        :return: todos(作成・更新されたtodo), deleted(削除されたtodoのID), next_token, has_moreの辞書
+        :raises HTTPException: トークンが不正な場合(400)、トークンが保持期間より古い場合(410)
+        """
+        now = int(time.time())
+        since_seq, issued_at = self._decode_sync_token(since) if since else (0, now)
+        if now - issued_at > TOMBSTONE_RETENTION_SECONDS:
+            raise HTTPException(status_code=410, detail="Sync token has expired. Fetch the full list again")
+        state = await self.revisions.find_one({"_id": owner}, projection={"seq": 1, "recent": 1})
+        settled_seq, started_at = self._settled_seq(state or {})
+        settled_seq = max(since_seq, settled_seq)
+        # 実行中の書き込みのトゥームストーンは開始後に作られるので、トークンの発行時刻は開始時刻より後にしない
+        settled_at = min(now, started_at)
+        if since is None:
+            return {"todos": [], "deleted": [], "next_token": self._encode_sync_token(settled_seq, settled_at),
+                    "has_more": False}
+
+        query = {"owner": owner, "seq": {"$gt": since_seq, "$lte": settled_seq}}
+        todos = await self.collection.find(
+            query, projection=CHANGE_PROJECTION, sort=[("seq", ASCENDING)], limit=limit + 1
+        ).to_list(length=limit + 1)
+        tombstones = await self.tombstones.find(
+            query, projection={"seq": 1, "deleted_at": 1}, sort=[("seq", ASCENDING)], limit=limit + 1
+        ).to_list(length=limit + 1)
+        changes = sorted([*todos, *tombstones], key=lambda change: change["seq"])
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+
+        if has_more:
+            # 続きの変更はトークンの発行後に行われたものなので、発行時刻は元のトークンのものを引き継ぐ
+            next_token = self._encode_sync_token(changes[-1]["seq"], issued_at)
+        else:
+            next_token = self._encode_sync_token(settled_seq, settled_at)
+        # deleted_atを持つのはトゥームストーンだけ
+        return {
+            "todos": [convert_document(change, TODO_FIELDS, TODO_DEFAULTS) for change in changes
+                      if "deleted_at" not in change],
+            "deleted": [str(change["_id"]) for change in changes if "deleted_at" in change],
+            "next_token": next_token,
+            "has_more": has_more,
+        }
+
+    @classmethod
+    def _settled_seq(cls, state: dict) -> tuple[int, int]:
+        """
+        それ以前の書き込みが全て完了しているとみなせるシーケンス番号を求める
+        WRITE_SETTLE_SECONDS以内に始まった書き込みのうち最も小さい番号の手前とし、無い場合は最後に割り当てた番号とする
+
+        :param state: todo_revisionの所有者のドキュメント
+        :return: シーケンス番号と、実行中の可能性がある最も古い書き込みの開始時刻(UNIX時間。無い場合は現在時刻)
+        """
+        now = datetime.now(timezone.utc)
+        running = cls._recent_writes(state, now)
+        if not running:
+            return state.get("seq", 0), int(now.timestamp())
+        return min(first for first, _ in running) - 1, int(min(at for _, at in running).timestamp())
+
+    @staticmethod
+    def _recent_writes(state: dict, now: datetime) -> list[tuple[int, datetime]]:
+        """
+        WRITE_SETTLE_SECONDS以内に始まった、実行中の可能性がある書き込みを取得する
+
+        :param state: todo_revisionの所有者のドキュメント
+        :param now: 現在時刻
+        :return: 書き込みの最初のシーケンス番号と開始時刻のリスト
+        """
+        writes = []
+        for write in state.get("recent", []):
+            # pymongoはタイムゾーン無しのUTCで日時を返す
+            started_at = write["at"].replace(tzinfo=write["at"].tzinfo or timezone.utc)
+            if (now - started_at).total_seconds() < WRITE_SETTLE_SECONDS:
+                writes.append((write["first"], started_at))
+        return writes
+
+    @staticmethod
+    def _encode_sync_token(seq: int, issued_at: int) -> str:
+        """
+        シーケンス番号と発行時刻から同期トークンを作成する
+
+        :param seq: クライアントに反映済みの最後のシーケンス番号
+        :param issued_at: シーケンス番号より後の変更が全て行われる前の時刻(UNIX時間)
+        :return: 同期トークン
+        """
+        return encode_cursor(f"{seq}.{issued_at}")
+
+    @staticmethod
+    def _decode_sync_token(token: str) -> tuple[int, int]:
+        """
+        同期トークンからシーケンス番号と発行時刻を取得する
+
+        :param token: 同期トークン
+        :return: シーケンス番号と発行時刻
+        :raises HTTPException: トークンが不正な場合
+        """
+        try:
+            seq, issued_at = decode_cursor(token).split(".")
+            return int(seq), int(issued_at)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid sync token") from None
+
+    async def update(self, owner: str, _id: str, data: dict, version: int | None = None) -> dict | bool:
         """
-        todoを更新する
+        todoを更新する。読み取りと書き込みを1回のアトミックな操作で行う
 
+        :param owner: 所有者
         :param _id: ドキュメントのID
         :param data: 更新データ
+        :param version: 更新前に期待するバージョン。指定した場合は一致する場合のみ更新する
         :return: 更新後データ
+        :raises HTTPException: バージョンが一致しない場合(412)
         """
-        todo = await self.collection.find_one({"_id": ObjectId(_id)})
+        seq = await self._begin_write(owner)
+        todo = await self.collection.find_one_and_update(
+            self._version_query(owner, _id, version),
+            {"$set": {**data, "updated_at": utc_now(), "seq": seq}, "$inc": {"version": 1}},
+            projection=TODO_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+        )
         if todo:
-            updated_todo = await self.collection.update_one({"_id": ObjectId(_id)}, {"$set": data})
-            if updated_todo.modified_count > 0:
-                new_todo = await self.collection.find_one({"_id": ObjectId(_id)})
-                return convert_document(new_todo, ["_id", "title", "description"])
+            await self._invalidate_singles(owner, {_id: seq})
+            updated = convert_document(todo, TODO_FIELDS, TODO_DEFAULTS)
+            self._publish(owner, todo_event("updated", updated))
+            return updated
+        await self._raise_if_version_mismatch(owner, _id, version)
         return False
 
-    async def delete(self, _id: str) -> bool:
+    async def delete(self, owner: str, _id: str, version: int | None = None) -> bool:
         """
         todoを削除する
+        :param owner: 所有者
         :param _id: ドキュメントのID
+        :param version: 削除前に期待するバージョン。指定した場合は一致する場合のみ削除する
         :return: 削除の成否
+        :raises HTTPException: バージョンが一致しない場合(412)
         """
-        todo = await self.collection.find_one({"_id": ObjectId(_id)})
+        seq = await self._begin_write(owner)
+        todo = await self.collection.find_one_and_delete(
+            self._version_query(owner, _id, version), projection={"_id": 1}
+        )
         if todo:
-            deleted_todo = await self.collection.delete_one({"_id": ObjectId(_id)})
-            if deleted_todo.deleted_count > 0:
-                return True
-            return False
+            await self._record_deletions(owner, {todo["_id"]: seq})
+            await self._invalidate_singles(owner, {_id: seq})
+            self._publish(owner, deleted_event(str(todo["_id"])))
+            return True
+        await self._raise_if_version_mismatch(owner, _id, version)
+        return False
+
+    async def bulk(self, owner: str, operations: list[dict]) -> list[dict]:
+        """
+        作成・更新・削除の操作をまとめて1回の順不同bulk_writeで実行する
+        更新・削除の対象の存在とバージョンは、事前に1回のクエリでまとめて確認する
+
+        :param owner: 所有者
+        :param operations: 操作のリスト。各操作はop, id, data, versionのキーを持つ
+        :return: 操作ごとの結果(index, op, status, id, version, detail)のリスト
+        """
+        results = [{"index": index, "op": operation["op"], "id": operation.get("id")}
+                   for index, operation in enumerate(operations)]
+        targets = self._bulk_targets(operations, results)
+        current_versions = await self._current_versions(owner, list(targets.values()))
+        if all("status" in result for result in results):
+            return results
+
+        # 操作の位置ごとにシーケンス番号を割り当てる。実行しなかった操作の番号は欠番になる
+        first_seq = await self._begin_write(owner, len(operations)) - len(operations) + 1
+        now = utc_now()
+        requests = []
+        request_indexes = []
+        for index, operation in enumerate(operations):
+            if "status" in results[index]:
+                continue
+            request = self._bulk_request(owner, operation, targets.get(index), current_versions, results[index],
+                                         first_seq + index, now)
+            if request is not None:
+                requests.append(request)
+                request_indexes.append(index)
+        if not requests:
+            return results
+
+        try:
+            write_result = (await self.collection.bulk_write(requests, ordered=False)).bulk_api_result
+        except BulkWriteError as e:
+            write_result = e.details
+            for error in write_result.get("writeErrors", []):
+                results[request_indexes[error["index"]]].update(
+                    status=409 if error.get("code") == 11000 else 400, version=None, detail=error.get("errmsg")
+                )
+        # 事前確認から書き込みまでの間に他のリクエストが更新・削除した場合だけ、結果を確認し直す
+        expected = sum(1 for index in request_indexes
+                       if operations[index]["op"] != "create" and results[index]["status"] < 300)
+        if write_result.get("nMatched", 0) + write_result.get("nRemoved", 0) < expected:
+            await self._reconcile_bulk(owner, operations, results, targets)
+        await self._record_deletions(owner, {targets[index]: first_seq + index for index in request_indexes
+                                             if operations[index]["op"] == "delete"
+                                             and results[index]["status"] == 200})
+        await self._invalidate_singles(owner, {str(targets[index]): first_seq + index for index in request_indexes
+                                               if index in targets and results[index]["status"] < 300})
+        self._publish(owner, *(self._bulk_event(operations[index], results[index], now) for index in request_indexes
+                               if results[index]["status"] < 300))
+        return results
+
+    @staticmethod
+    def _bulk_event(operation: dict, result: dict, now: datetime) -> dict:
+        """
+        成功した一括処理の1操作分の変更イベントを作成する
+        更新の場合、作成日時は読み取っていないのでイベントに含めない
+
+        :param operation: 操作
+        :param result: 操作の結果
+        :param now: 書き込んだ日時
+        :return: イベント
+        """
+        if operation["op"] == "delete":
+            return deleted_event(result["id"])
+        timestamps = {"created_at": now, "updated_at": now} if operation["op"] == "create" else {"updated_at": now}
+        todo = convert_document({"_id": result["id"], **operation["data"], "version": result["version"], **timestamps},
+                                TODO_FIELDS)
+        return todo_event("created" if operation["op"] == "create" else "updated", todo)
+
+    @staticmethod
+    def _bulk_targets(operations: list[dict], results: list[dict]) -> dict[int, ObjectId]:
+        """
+        更新・削除の対象IDを検証し、操作の位置とObjectIdの対応を作成する
+        不正な操作の結果には400を設定する
+
+        :param operations: 操作のリスト
+        :param results: 操作ごとの結果のリスト
+        :return: 操作の位置とObjectIdの辞書
+        """
+        targets = {}
+        for index, operation in enumerate(operations):
+            if operation["op"] == "create":
+                continue
+            try:
+                target = ObjectId(operation.get("id"))
+            except (InvalidId, TypeError):
+                results[index].update(status=400, detail="A valid id is required")
+                continue
+            if target in targets.values():
+                results[index].update(status=400, detail=f"Todo(id:{target}) appears more than once in the batch")
+                continue
+            targets[index] = target
+        return targets
+
+    async def _current_versions(self, owner: str, ids: list[ObjectId]) -> dict[ObjectId, int]:
+        """
+        指定したIDの所有者のドキュメントの現在のバージョンをまとめて取得する
+
+        :param owner: 所有者
+        :param ids: ObjectIdのリスト
+        :return: 存在するドキュメントのObjectIdとバージョンの辞書
+        """
+        if not ids:
+            return {}
+        documents = await self.collection.find(
+            {"owner": owner, "_id": {"$in": ids}}, projection={"version": 1}
+        ).to_list(length=len(ids))
+        return {document["_id"]: document.get("version", 0) for document in documents}
+
+    def _bulk_request(self, owner: str, operation: dict, target: ObjectId | None, current_versions: dict[ObjectId, int],
+                      result: dict, seq: int, now: datetime) -> InsertOne | UpdateOne | DeleteOne | None:
+        """
+        1操作分のbulk_writeリクエストを作成し、成功した場合の結果を設定する
+        実行できない操作の場合は失敗の結果を設定してNoneを返す
+
+        :param owner: 所有者
+        :param operation: 操作
+        :param target: 更新・削除の対象のObjectId
+        :param current_versions: 対象の現在のバージョン
+        :param result: 操作の結果
+        :param seq: 操作に割り当てたシーケンス番号
+        :param now: 書き込む日時
+        :return: bulk_writeリクエスト
+        """
+        data = operation.get("data")
+        version = operation.get("version")
+        if operation["op"] != "delete" and data is None:
+            result.update(status=400, detail="data is required")
+            return None
+        if operation["op"] == "create":
+            new_todo = {**data, "_id": ObjectId(), "owner": owner, "version": 1, "created_at": now, "updated_at": now,
+                        "seq": seq}
+            result.update(status=201, id=str(new_todo["_id"]), version=1)
+            return InsertOne(new_todo)
+        if target not in current_versions:
+            result.update(status=404, detail=f"Todo(id:{target}) not found")
+            return None
+        if version is not None and current_versions[target] != version:
+            result.update(status=412, detail=f"Todo(id:{target}) has been modified")
+            return None
+        if operation["op"] == "update":
+            result.update(status=200, version=current_versions[target] + 1)
+            return UpdateOne(self._version_query(owner, target, version),
+                             {"$set": {**data, "updated_at": now, "seq": seq}, "$inc": {"version": 1}})
+        result.update(status=200)
+        return DeleteOne(self._version_query(owner, target, version))
+
+    async def _reconcile_bulk(self, owner: str, operations: list[dict], results: list[dict],
+                              targets: dict[int, ObjectId]) -> None:
+        """
+        bulk_writeで一致しなかった更新・削除を特定し、結果を修正する
+
+        :param owner: 所有者
+        :param operations: 操作のリスト
+        :param results: 操作ごとの結果のリスト
+        :param targets: 操作の位置とObjectIdの辞書
+        :return: なし
+        """
+        applied = {index: target for index, target in targets.items() if results[index].get("status") == 200}
+        current_versions = await self._current_versions(owner, list(applied.values()))
+        for index, target in applied.items():
+            result = results[index]
+            if operations[index]["op"] == "delete":
+                if target in current_versions:
+                    result.update(status=412, detail=f"Todo(id:{target}) has been modified")
+            elif target not in current_versions:
+                result.update(status=404, version=None, detail=f"Todo(id:{target}) not found")
+            elif operations[index].get("version") is not None and current_versions[target] != result["version"]:
+                result.update(status=412, version=None, detail=f"Todo(id:{target}) has been modified")
+
+    @staticmethod
+    def _single_key(owner: str, _id: str) -> str:
+        """
+        単一のtodoのキャッシュキーを作成する
+
+        :param owner: 所有者
+        :param _id: ドキュメントのID
+        :return: キャッシュキー
+        """
+        # ObjectIdの16進数表記は大文字小文字を区別しないので、小文字に揃える
+        return f"todo:{owner}:{_id.lower()}"
+
+    async def _begin_write(self, owner: str, count: int = 1) -> int:
+        """
+        書き込みの前に、所有者の変更シーケンス番号を割り当ててリビジョンを進める
+        割り当てた最初の番号(first)と時刻(at)をrecentの配列に記録し、WRITE_SETTLE_SECONDSより古い記録は取り除く
+        書き込みの完了は記録しないので、DBへの追加の読み書きは書き込みごとにこの1回のパイプライン更新だけになる
+
+        :param owner: 所有者
+        :param count: 割り当てる番号の数
+        :return: 割り当てた最後のシーケンス番号
+        """
+        now = utc_now()
+        state = await self.revisions.find_one_and_update(
+            {"_id": owner},
+            [
+                {"$set": {
+                    "seq": {"$add": [{"$ifNull": ["$seq", 0]}, count]},
+                    "revision": {"$add": [{"$ifNull": ["$revision", 0]}, 1]},
+                    "recent": {"$filter": {
+                        "input": {"$ifNull": ["$recent", []]},
+                        "cond": {"$gt": ["$$this.at", now - timedelta(seconds=WRITE_SETTLE_SECONDS)]},
+                    }},
+                }},
+                # 割り当てた後のseqを参照するため、1件の配列は$mapで作る
+                {"$set": {"recent": {"$concatArrays": [
+                    "$recent",
+                    {"$map": {"input": [0], "in": {"first": {"$subtract": ["$seq", count - 1]},
+                                                   "at": {"$literal": now}}}},
+                ]}}},
+            ],
+            projection={"seq": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return state["seq"]
+
+    async def _record_deletions(self, owner: str, deleted: dict[ObjectId, int]) -> None:
+        """
+        削除したtodoのトゥームストーンを記録する
+        トゥームストーンはdeleted_atのTTLインデックスでTOMBSTONE_RETENTION_SECONDS後に削除される
+
+        :param owner: 所有者
+        :param deleted: 削除したドキュメントのObjectIdとシーケンス番号の辞書
+        :return: なし
+        """
+        if not deleted:
+            return
+        deleted_at = datetime.now(timezone.utc)
+        await self.tombstones.insert_many(
+            [{"_id": _id, "owner": owner, "seq": seq, "deleted_at": deleted_at} for _id, seq in deleted.items()],
+            ordered=False,
+        )
+
+    def _publish(self, owner: str, *events: dict) -> None:
+        """
+        変更イベントを配信し、プロセス内の転置インデックスにも反映する
+        キャッシュを無効にした後に呼ぶので、イベントを受けて再取得しても古い値は返らない
+
+        :param owner: 所有者
+        :param events: イベント
+        :return: なし
+        """
+        for event in events:
+            if self.search:
+                self.search.apply(owner, event)
+            if self.events:
+                self.events.publish(owner, event)
+
+    async def _invalidate_singles(self, owner: str, written: dict[str, int]) -> None:
+        """
+        書き込みの後に、更新・削除した単一のtodoのキャッシュを無効にする
+        値の無い書き込みのシーケンス番号の記録で置き換え、書き込み前に読み取りを始めたget_singleが古い値で上書きしないようにする
+        所有者のリストのキャッシュはキーにリビジョンを含むので、_begin_writeでリビジョンが進むと参照されなくなる(TTLで消える)
+
+        :param owner: 所有者
+        :param written: 更新・削除したドキュメントのIDと、その書き込みのシーケンス番号
+        :return: なし
+        """
+        if self.cache and written:
+            await asyncio.gather(*(self.cache.set_versioned(self._single_key(owner, _id), seq, None, CACHE_TTL_SECONDS)
+                                   for _id, seq in written.items()))
+
+    @staticmethod
+    def _version_query(owner: str, _id: str | ObjectId, version: int | None) -> dict:
+        """
+        所有者、IDとバージョンでドキュメントを特定するクエリを作成する
+
+        :param owner: 所有者
+        :param _id: ドキュメントのID
+        :param version: 期待するバージョン
+        :return: クエリ
+        """
+        query = {"_id": ObjectId(_id), "owner": owner}
+        if version is not None:
+            # versionフィールド導入前のドキュメントはバージョン0として扱う
+            query["version"] = version if version > 0 else {"$exists": False}
+        return query
+
+    async def _raise_if_version_mismatch(self, owner: str, _id: str, version: int | None) -> None:
+        """
+        更新・削除の対象が見つからなかった場合に、バージョン不一致によるものかを判定する
+        成功時には呼ばれないため、追加の読み取りは失敗時だけ発生する
+
+        :param owner: 所有者
+        :param _id: ドキュメントのID
+        :param version: 期待したバージョン
+        :return: なし
+        :raises HTTPException: ドキュメントは存在するがバージョンが一致しない場合(412)
+        """
+        if version is None:
+            return
+        if await self.collection.count_documents({"_id": ObjectId(_id), "owner": owner}, limit=1):
+            raise HTTPException(status_code=412, detail=f"Todo(id:{_id}) has been modified")
@@ -1,12 +1,25 @@
+import asyncio
+import logging
+
 from fastapi import HTTPException
 from motor import motor_asyncio
+from pymongo.errors import DuplicateKeyError
 from utils.auth import AuthJwtCsrf
-from utils.common import convert_document
-from utils.dependencies import connect_database
+from utils.common import convert_document, to_projection
+from utils.slow_queries import trace_queries
+
+USER_FIELDS = ["_id", "email"]
+# 認証に必要なフィールドだけを取得する
+CREDENTIAL_PROJECTION = to_projection(["email", "password"])
+
+logger = logging.getLogger(__name__)
+# 実行中のパスワードの再ハッシュのタスク。完了前にガベージコレクションされないように保持する
+rehash_tasks: set[asyncio.Task] = set()
 
 
+@trace_queries
 class UserService:
-    def __init__(self, db: motor_asyncio.AsyncIOMotorDatabase = connect_database()) -> None:
+    def __init__(self, db: motor_asyncio.AsyncIOMotorDatabase) -> None:
         """
         コンストラクタ
 
@@ -25,14 +38,16 @@ class UserService:
         """
         email = data.get("email")
         password = data.get("password")
-        user = await self.collection.find_one({"email": email})
+        hashed_password = await self.auth.hash_password_async(password)
+        registered_user = {"email": email, "password": hashed_password}
 
-        if user:
-            raise HTTPException(status_code=409, detail="User already exists")
-
-        user = await self.collection.insert_one({"email": email, "password": self.auth.hash_password(password)})
-        registered_user = await self.collection.find_one({"_id": user.inserted_id})
-        return convert_document(registered_user, ["_id", "email"])
+        # emailのユニークインデックスで重複を検出する
+        try:
+            user = await self.collection.insert_one(registered_user)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="User already exists") from None
+        registered_user["_id"] = user.inserted_id
+        return convert_document(registered_user, USER_FIELDS)
 
     @staticmethod
     def validate_password(password: str) -> None:
@@ -67,8 +82,35 @@ class UserService:
         """
         email = data.get("email")
         password = data.get("password")
-        user = await self.collection.find_one({"email": email})
+        user = await self.collection.find_one({"email": email}, projection=CREDENTIAL_PROJECTION)
 
-        if not user or not self.auth.verify_password(password, user["password"]):
+        if not user:
+            raise HTTPException(status_code=400, detail="Invalid email or password")
+        valid, needs_update = await self.auth.check_password_async(password, user["password"])
+        if not valid:
             raise HTTPException(status_code=400, detail="Invalid email or password")
+        # bcryptのコストを上げた場合は、ログインを待たせずに新しいコストでハッシュを作り直す
+        if needs_update:
+            task = asyncio.create_task(self.rehash_password(user["email"], password, user["password"]))
+            rehash_tasks.add(task)
+            task.add_done_callback(rehash_tasks.discard)
         return self.auth.encode_jwt(user["email"])
+
+    async def rehash_password(self, email: str, password: str, hashed_password: str) -> bool:
+        """
+        検証に成功したパスワードを現在の設定でハッシュ化し直して保存する
+        その間にパスワードが変更された場合は上書きしない。失敗してもログに出力するだけで、次回のログインで再び行う
+
+        :param email: メールアドレス
+        :param password: 検証に成功した平文のパスワード
+        :param hashed_password: 保存されているハッシュ
+        :return: 保存した場合はTrue
+        """
+        try:
+            new_hashed_password = await self.auth.hash_password_async(password)
+            result = await self.collection.update_one({"email": email, "password": hashed_password},
+                                                      {"$set": {"password": new_hashed_password}})
+        except Exception:
+            logger.warning("Failed to rehash a password", exc_info=True)
+            return False
+        return result.modified_count == 1
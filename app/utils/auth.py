@@ -1,14 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import hmac
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
-from typing import Literal
+from hashlib import sha256
+from typing import TYPE_CHECKING, Literal
 
 import jwt
 from decouple import config
 from fastapi import HTTPException, Request, Response
 from fastapi_csrf_protect import CsrfProtect
-from passlib.context import CryptContext
-from starlette.datastructures import Headers
+from jwt.algorithms import HMACAlgorithm
+from utils.password_cost import resolve_rounds
+from utils.worker_pool import BoundedWorkerPool
+
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
 
 JWT_SECRET_KEY = config("JWT_SECRET_KEY")
+# パスワードハッシュ計算用のワーカープール設定
+PASSWORD_HASH_EXECUTOR = config("PASSWORD_HASH_EXECUTOR", default="thread")
+PASSWORD_HASH_WORKERS = config("PASSWORD_HASH_WORKERS", default=os.cpu_count() or 1, cast=int)
+PASSWORD_HASH_MAX_QUEUE = config("PASSWORD_HASH_MAX_QUEUE", default=64, cast=int)
+# JWTの有効期間と、再発行を行う有効期限前の期間
+JWT_LIFETIME_SECONDS = config("JWT_LIFETIME_SECONDS", default=300, cast=int)
+JWT_REFRESH_WINDOW_SECONDS = config("JWT_REFRESH_WINDOW_SECONDS", default=60, cast=int)
+# 検証済みJWTのキャッシュの最大件数(0の場合はキャッシュしない)
+JWT_CACHE_MAX_ENTRIES = config("JWT_CACHE_MAX_ENTRIES", default=10000, cast=int)
+# JWTの署名鍵。リクエストごとに秘密鍵の文字列を変換しないように起動時に作成する
+JWT_SIGNING_KEY = HMACAlgorithm(HMACAlgorithm.SHA256).prepare_key(JWT_SECRET_KEY)
+# CSRFの検証が不要なメソッド
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+password_pool = BoundedWorkerPool(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_QUEUE)
+_password_rounds_lock = threading.Lock()
+
+
+@functools.cache
+def _resolved_password_rounds() -> int | None:
+    # gunicornのワーカーにはマスターで計測した値が環境変数で渡されるので、読み込み時の値ではなく呼び出し時に読む
+    return resolve_rounds(config("PASSWORD_HASH_ROUNDS", default=""))
+
+
+def get_password_rounds() -> int | None:
+    """
+    プロセスで使うbcryptのコストを取得する。最初の呼び出しで1回だけ決める(autoの場合はここで計測する)
+    計測には時間がかかるので、イベントループからはresolve_password_roundsを使う
+
+    :return: bcryptのコスト。未指定の場合はNone(passlibの既定値を使う)
+    """
+    with _password_rounds_lock:
+        return _resolved_password_rounds()
+
+
+async def resolve_password_rounds() -> int | None:
+    """
+    bcryptのコストを取得する。まだ決まっていない場合は、イベントループを止めないようにスレッドで計測する
+    起動時のウォームアップで呼ぶので、通常は最初のログインの前に決まっている
+
+    :return: bcryptのコスト。未指定の場合はNone
+    """
+    if _resolved_password_rounds.cache_info().currsize:
+        return _resolved_password_rounds()
+    return await asyncio.to_thread(get_password_rounds)
+
+
+@functools.cache
+def get_crypt_context(rounds: int | None) -> CryptContext:
+    """
+    パスワードハッシュのCryptContextを取得する
+    passlibのインポートとCryptContextの作成は、起動を遅らせないように最初の使用時に行う
+    bcryptのコストを指定した場合は、それより低いコストのハッシュをneeds_updateの対象にする
+    コストは親プロセスで決めて渡すので、プロセスプールのワーカーでも親プロセスと同じコストになる
+
+    :param rounds: bcryptのコスト。Noneの場合はpasslibの既定値を使う
+    :return: CryptContext
+    """
+    from passlib.context import CryptContext
+
+    if rounds is None:
+        return CryptContext(schemes=["bcrypt"], deprecated="auto")
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=rounds,
+                        bcrypt__min_rounds=rounds)
+
+
+def load_password_backend(rounds: int | None) -> str:
+    """
+    CryptContextを作成し、bcryptのバックエンドを読み込む(読み込み時の自己診断も行う)
+    ワーカーで実行すると、最初のログインを待たせずにワーカーとバックエンドを準備できる
+
+    :param rounds: bcryptのコスト
+    :return: バックエンドの名前
+    """
+    return get_crypt_context(rounds).handler().get_backend()
+
+
+def _hash_password(password: str, rounds: int | None) -> str:
+    """
+    ワーカーで実行するパスワードハッシュ化処理
+    プロセスプールに渡すため、pickle可能なモジュールレベルの関数にしている
+
+    :param password: 平文のパスワード
+    :param rounds: bcryptのコスト
+    :return: ハッシュ化されたパスワード
+    """
+    return get_crypt_context(rounds).hash(password)
+
+
+def _verify_password(plain_password: str, hashed_password: str, rounds: int | None) -> tuple[bool, bool]:
+    """
+    ワーカーで実行するパスワード検証処理。ハッシュを作り直すべきかも同じワーカーで判定する
+
+    :param plain_password: 平文のパスワード
+    :param hashed_password: ハッシュ化されたパスワード
+    :param rounds: bcryptのコスト
+    :return: 一致する場合はTrueと、一致してハッシュが現在のコストより弱い場合はTrue
+    """
+    ctx = get_crypt_context(rounds)
+    valid = ctx.verify(plain_password, hashed_password)
+    return valid, valid and ctx.needs_update(hashed_password)
+
+
+class VerifiedTokenCache:
+    """
+    署名と有効期限を検証済みのJWTのキャッシュ
+    - トークンそのものではなく、プロセスごとのランダムな鍵によるHMACダイジェストを保持する
+    - ダイジェストの比較は定数時間で行う
+    - 各エントリはトークンのexpで失効する。検証に失敗したトークンはキャッシュしない
+    """
+
+    def __init__(self, max_entries: int) -> None:
+        """
+        コンストラクタ
+
+        :param max_entries: 保持する最大件数
+        :return: なし
+        """
+        self.max_entries = max_entries
+        self._key = secrets.token_bytes(32)
+        self._entries: OrderedDict[bytes, tuple[bytes, str, float]] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def _digest(self, token: str) -> bytes:
+        """
+        トークンのダイジェストを計算する
+
+        :param token: JWT
+        :return: ダイジェスト
+        """
+        return hmac.new(self._key, token.encode("utf-8"), sha256).digest()
+
+    def get(self, token: str) -> tuple[str, float] | None:
+        """
+        検証済みのトークンのsubとexpを取得する
+
+        :param token: JWT
+        :return: subとexp。キャッシュに無い場合と有効期限切れの場合はNone
+        """
+        digest = self._digest(token)
+        # 辞書の検索にはダイジェストの先頭だけを使い、全体は定数時間で比較する
+        entry = self._entries.get(digest[:16])
+        if entry is None or not hmac.compare_digest(entry[0], digest):
+            self._misses += 1
+            return None
+        _, subject, expires_at = entry
+        if expires_at <= time.time():
+            del self._entries[digest[:16]]
+            self._misses += 1
+            return None
+        self._entries.move_to_end(digest[:16])
+        self._hits += 1
+        return subject, expires_at
+
+    def set(self, token: str, subject: str, expires_at: float) -> None:
+        """
+        検証に成功したトークンを保存する
+
+        :param token: JWT
+        :param subject: sub
+        :param expires_at: exp(UNIX時間)
+        :return: なし
+        """
+        if self.max_entries <= 0:
+            return
+        digest = self._digest(token)
+        self._entries[digest[:16]] = (digest, subject, expires_at)
+        self._entries.move_to_end(digest[:16])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        キャッシュを空にする
+
+        :return: なし
+        """
+        self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """
+        キャッシュのメトリクスを取得する
+
+        :return: メトリクスの辞書
+        """
+        return {"entries": len(self._entries), "hits": self._hits, "misses": self._misses}
+
+
+verified_tokens = VerifiedTokenCache(JWT_CACHE_MAX_ENTRIES)
+
+
+async def validate_csrf(request: Request, csrf_protect: CsrfProtect) -> None:
+    """
+    CookieのCSRFトークンの署名を検証し、ヘッダーのトークンと一致するか確認する
+    検証はfastapi-csrf-protectのvalidate_csrfにそのまま任せ、CsrfSettingsで読み込んだ設定を使う
+
+    :param request: リクエスト
+    :param csrf_protect: CsrfProtectインスタンス
+    :return: なし
+    :raises CsrfProtectError: トークンが無い、または一致しない場合
+    """
+    await csrf_protect.validate_csrf(request)
+
+
+class Principal:
+    """
+    リクエストの認証済みのユーザー
+    - email: メールアドレス(todoの所有者)
+    - new_token: 再発行したJWT。再発行しない場合はNone
+    """
+
+    __slots__ = ("email", "new_token")
+
+    def __init__(self, email: str, new_token: str | None) -> None:
+        """
+        コンストラクタ
+
+        :param email: メールアドレス
+        :param new_token: 再発行したJWT
+        :return: なし
+        """
+        self.email = email
+        self.new_token = new_token
 
 
 class AuthJwtCsrf:
@@ -16,8 +255,9 @@ class AuthJwtCsrf:
     SIGNATURE_EXPIRED_ERROR = "Signature has expired"
     INVALID_TOKEN_ERROR = "Invalid token"
 
-    def __init__(self) -> None:
-        self.ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    @property
+    def ctx(self) -> CryptContext:
+        return get_crypt_context(get_password_rounds())
 
     def hash_password(self, password: str) -> str:
         return self.ctx.hash(password)
@@ -25,6 +265,40 @@ class AuthJwtCsrf:
     def verify_password(self, plain_password: str, hashed_password: str) -> bool:
         return self.ctx.verify(plain_password, hashed_password)
 
+    @staticmethod
+    async def hash_password_async(password: str) -> str:
+        """
+        ワーカープールでパスワードをハッシュ化する。イベントループをブロックしない
+
+        :param password: 平文のパスワード
+        :return: ハッシュ化されたパスワード
+        """
+        return await password_pool.run(_hash_password, password, await resolve_password_rounds())
+
+    @staticmethod
+    async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+        """
+        ワーカープールでパスワードを検証する。イベントループをブロックしない
+
+        :param plain_password: 平文のパスワード
+        :param hashed_password: ハッシュ化されたパスワード
+        :return: 一致する場合はTrue
+        """
+        valid, _ = await AuthJwtCsrf.check_password_async(plain_password, hashed_password)
+        return valid
+
+    @staticmethod
+    async def check_password_async(plain_password: str, hashed_password: str) -> tuple[bool, bool]:
+        """
+        ワーカープールでパスワードを検証し、ハッシュが現在の設定(bcryptのコストなど)より弱いかも判定する
+
+        :param plain_password: 平文のパスワード
+        :param hashed_password: ハッシュ化されたパスワード
+        :return: 一致する場合はTrueと、一致してハッシュを作り直すべき場合はTrue
+        """
+        return await password_pool.run(_verify_password, plain_password, hashed_password,
+                                       await resolve_password_rounds())
+
     @staticmethod
     def encode_jwt(email: str) -> str:
         """
@@ -34,12 +308,12 @@ class AuthJwtCsrf:
         :return: エンコードされたJWT
         """
         payload = {
-            "exp": datetime.now(tz=timezone.utc) + timedelta(days=0, minutes=5),
+            "exp": datetime.now(tz=timezone.utc) + timedelta(seconds=JWT_LIFETIME_SECONDS),
             "iat": datetime.now(tz=timezone.utc),
             "sub": email
         }
 
-        return jwt.encode(payload, JWT_SECRET_KEY, algorithm="HS256")
+        return jwt.encode(payload, JWT_SIGNING_KEY, algorithm="HS256")
 
     @staticmethod
     def decode_jwt(token: str) -> str:
@@ -49,13 +323,29 @@ class AuthJwtCsrf:
         :param token: デコードするJWTトークン
         :return: メールアドレス
         """
+        subject, _ = AuthJwtCsrf.decode_jwt_claims(token)
+        return subject
+
+    @staticmethod
+    def decode_jwt_claims(token: str) -> tuple[str, float]:
+        """
+        JWTトークンをデコードしてメールアドレスと有効期限を取得する
+        検証済みのトークンはキャッシュから返し、署名の検証とJSONのデコードを省略する
+
+        :param token: デコードするJWTトークン
+        :return: メールアドレスと有効期限(UNIX時間)
+        """
+        cached = verified_tokens.get(token)
+        if cached:
+            return cached
         try:
-            payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
-            return payload["sub"]
+            payload = jwt.decode(token, JWT_SIGNING_KEY, algorithms=["HS256"], options={"require": ["exp", "sub"]})
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401, detail=AuthJwtCsrf.SIGNATURE_EXPIRED_ERROR) from None
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail=AuthJwtCsrf.INVALID_TOKEN_ERROR) from None
+        verified_tokens.set(token, payload["sub"], payload["exp"])
+        return payload["sub"], payload["exp"]
 
     def verify_jwt(self, request: Request) -> str:
         """
@@ -64,12 +354,31 @@ class AuthJwtCsrf:
         :param request: 検証するリクエスト
         :return: メールアドレス
         """
+        email = self.decode_jwt(self._get_token(request))
+        return email
+
+    def verify_jwt_claims(self, request: Request) -> tuple[str, float]:
+        """
+        JWTを検証し、メールアドレスと有効期限を取得する
+
+        :param request: 検証するリクエスト
+        :return: メールアドレスと有効期限(UNIX時間)
+        """
+        return self.decode_jwt_claims(self._get_token(request))
+
+    @staticmethod
+    def _get_token(request: Request) -> str:
+        """
+        CookieからJWTを取り出す
+
+        :param request: リクエスト
+        :return: JWT
+        """
         token = request.cookies.get("access_token")
         if not token:
             raise HTTPException(status_code=401, detail=AuthJwtCsrf.TOKEN_MISSING_ERROR)
         _, _, value = token.partition(" ")
-        email = self.decode_jwt(value)
-        return email
+        return value
 
     def update_jwt(self, request: Request) -> tuple[str, str]:
         """
@@ -82,28 +391,28 @@ class AuthJwtCsrf:
         new_token = self.encode_jwt(email)
         return email, new_token
 
-    def update_jwt_with_csrf(self, request: Request, csrf_protect: CsrfProtect, headers: Headers) -> str:
+    def refresh_jwt(self, request: Request) -> tuple[str, str | None]:
         """
-        CSRFの検証を行った上でJWTトークンを更新する
+        JWTを検証し、有効期限がJWT_REFRESH_WINDOW_SECONDS以内に迫っている場合だけ再発行する
 
         :param request: リクエスト
-        :param csrf_protect: CsrfProtectインスタンス
-        :param headers: リクエストヘッダー
-        :return: 更新されたJWTトークン
+        :return: メールアドレスと再発行したJWT。再発行しない場合はNone
         """
-        csrf_protect.validate_csrf(request)
-        email = self.verify_jwt(request)
-        new_token = self.encode_jwt(email)
-        return new_token
+        email, expires_at = self.verify_jwt_claims(request)
+        if expires_at - time.time() > JWT_REFRESH_WINDOW_SECONDS:
+            return email, None
+        return email, self.encode_jwt(email)
 
     @staticmethod
-    def set_jwt_cookie(response: Response, token: str) -> None:
+    def set_jwt_cookie(response: Response, token: str | None) -> None:
         """
-        CookieにJWTトークンを設定する
+        CookieにJWTトークンを設定する。トークンがNoneの場合は現在のCookieをそのまま使うので何もしない
 
         :param response: クッキーを設定するレスポンス
         :param token: JWTトークン
         """
+        if token is None:
+            return
         response.set_cookie(key="access_token", value=f"Bearer {token}", httponly=True, samesite="none", secure=True)
 
     @staticmethod
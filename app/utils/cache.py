@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Protocol
+
+from decouple import config
+
+# 保存済みの値より古いバージョンの値で上書きしないように、比較と保存を1回の操作で行うRedisのスクリプト
+# 値は[バージョン, 値]のJSONで保存する
+VERSIONED_SET_SCRIPT = """
+local current = redis.call("GET", KEYS[1])
+if current then
+  local version = tonumber(cjson.decode(current)[1])
+  if version and version > tonumber(ARGV[2]) then
+    return 0
+  end
+end
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[3])
+return 1
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(Protocol):
+    """
+    キャッシュのバックエンド
+    - 値はJSONに変換できるものに限る
+    """
+
+    async def get(self, key: str) -> Any | None:
+        ...
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        ...
+
+    async def set_versioned(self, key: str, version: int, value: Any, ttl: float) -> bool:
+        ...
+
+    async def delete(self, *keys: str) -> None:
+        ...
+
+    def stats(self) -> dict[str, int | str]:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class LRUTTLCache:
+    """
+    プロセス内のキャッシュ
+    - 件数が上限を超えた場合は最も長く使われていないものから削除する
+    - 有効期限が切れたものは取得時に削除する
+    """
+
+    def __init__(self, max_entries: int = 10000) -> None:
+        """
+        コンストラクタ
+
+        :param max_entries: 保持する最大件数
+        :return: なし
+        """
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    async def get(self, key: str) -> Any | None:
+        """
+        キャッシュから値を取得する
+
+        :param key: キー
+        :return: 値。存在しない場合と有効期限切れの場合はNone
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self._expirations += 1
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        キャッシュに値を保存する
+
+        :param key: キー
+        :param value: 値
+        :param ttl: 有効期間(秒)
+        :return: なし
+        """
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    async def set_versioned(self, key: str, version: int, value: Any, ttl: float) -> bool:
+        """
+        保存済みの値より新しいか同じバージョンの場合だけ、[バージョン, 値]を保存する
+        読み取りと書き込みの間に他の処理が入らないので、比較と保存はアトミックに行われる
+
+        :param key: キー
+        :param version: 値のバージョン
+        :param value: 値
+        :param ttl: 有効期間(秒)
+        :return: 保存した場合はTrue
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic() and entry[1][0] > version:
+            return False
+        await self.set(key, [version, value], ttl)
+        return True
+
+    async def delete(self, *keys: str) -> None:
+        """
+        キャッシュから値を削除する
+
+        :param keys: キー
+        :return: なし
+        """
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        キャッシュのメトリクスを取得する
+
+        :return: メトリクスの辞書
+        """
+        return {
+            "backend": "memory",
+            "entries": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+        }
+
+    async def close(self) -> None:
+        """
+        キャッシュを空にする
+
+        :return: なし
+        """
+        self._entries.clear()
+
+
+class RedisCache:
+    """
+    ネットワーク越しのキャッシュ。複数のワーカーやプロセスで共有できる
+    redis.asyncio.Redisと同じget/set/delete/acloseを持つクライアントを使う
+    """
+
+    def __init__(self, client: Any, prefix: str = "cache:") -> None:
+        """
+        コンストラクタ
+
+        :param client: redis.asyncio.Redis互換のクライアント
+        :param prefix: キーの接頭辞
+        :return: なし
+        """
+        self.client = client
+        self.prefix = prefix
+        self._hits = 0
+        self._misses = 0
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "cache:") -> RedisCache:
+        """
+        URLからRedisに接続するキャッシュを作成する。redisパッケージが必要
+
+        :param url: RedisのURL(例: redis://localhost:6379/0)
+        :param prefix: キーの接頭辞
+        :return: RedisCache
+        """
+        try:
+            from redis import asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("The redis package is required to use a redis:// cache URL") from e
+        return cls(redis_asyncio.from_url(url), prefix)
+
+    async def get(self, key: str) -> Any | None:
+        """
+        キャッシュから値を取得する
+
+        :param key: キー
+        :return: 値。存在しない場合はNone
+        """
+        value = await self.client.get(self.prefix + key)
+        if value is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        return json.loads(value)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        キャッシュに値を保存する
+
+        :param key: キー
+        :param value: 値
+        :param ttl: 有効期間(秒)
+        :return: なし
+        """
+        await self.client.set(self.prefix + key, json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    async def set_versioned(self, key: str, version: int, value: Any, ttl: float) -> bool:
+        """
+        保存済みの値より新しいか同じバージョンの場合だけ、[バージョン, 値]を保存する
+        比較と保存はVERSIONED_SET_SCRIPTで1回の操作として行う
+
+        :param key: キー
+        :param version: 値のバージョン
+        :param value: 値
+        :param ttl: 有効期間(秒)
+        :return: 保存した場合はTrue
+        """
+        stored = await self.client.eval(VERSIONED_SET_SCRIPT, 1, self.prefix + key, json.dumps([version, value]),
+                                        version, max(1, int(ttl * 1000)))
+        return bool(int(stored))
+
+    async def delete(self, *keys: str) -> None:
+        """
+        キャッシュから値を削除する
+
+        :param keys: キー
+        :return: なし
+        """
+        if keys:
+            await self.client.delete(*(self.prefix + key for key in keys))
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        キャッシュのメトリクスを取得する。削除件数はRedis側で管理されるため含まない
+
+        :return: メトリクスの辞書
+        """
+        return {"backend": "redis", "hits": self._hits, "misses": self._misses}
+
+    async def close(self) -> None:
+        """
+        接続を閉じる
+
+        :return: なし
+        """
+        await self.client.aclose()
+
+
+def create_cache() -> CacheBackend | None:
+    """
+    環境変数の設定からキャッシュを作成する
+    - CACHE_URL: redis://で始まる場合はRedis、未指定の場合はプロセス内のキャッシュを使う
+    - CACHE_MAX_ENTRIES: プロセス内のキャッシュの最大件数
+    - CACHE_ENABLED: falseの場合はキャッシュを使わない
+    プロセス内のキャッシュは他のワーカーの書き込みで無効にならないので、WEB_CONCURRENCYが2以上の場合は使わない
+
+    :return: キャッシュ。無効の場合はNone
+    """
+    if not config("CACHE_ENABLED", default=True, cast=bool):
+        return None
+    url = config("CACHE_URL", default="")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache.from_url(url)
+    if url:
+        raise ValueError(f"Unsupported CACHE_URL: {url}")
+    if config("WEB_CONCURRENCY", default=1, cast=int) > 1:
+        logger.warning("The in-process todo cache is disabled with multiple workers; set CACHE_URL to share a cache")
+        return None
+    return LRUTTLCache(config("CACHE_MAX_ENTRIES", default=10000, cast=int))
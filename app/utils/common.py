@@ -1,9 +1,29 @@
-def convert_document(document: dict, fields: list[str]) -> dict:
+from __future__ import annotations
+
+import binascii
+import json
+from base64 import b64decode, urlsafe_b64encode
+from collections.abc import AsyncIterator
+from datetime import datetime, timezone
+from typing import Any
+
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def convert_document(document: dict, fields: list[str], defaults: dict | None = None) -> dict:
     """
-    ドキュメントから指定されたフィールドを抽出し、_idをidに変換する
+    ドキュメントから指定されたフィールドを抽出し、_idをidに、日時をISO 8601の文字列に変換する
 
     :param document: MongoDBドキュメント
     :param fields: 抽出するフィールドのリスト
+    :param defaults: ドキュメントに無いフィールドの既定値
     :return: 変換されたドキュメントの辞書
     """
     serialized = {}
@@ -11,5 +31,107 @@ def convert_document(document: dict, fields: list[str]) -> dict:
         if field == "_id":
             serialized["id"] = str(document["_id"])
         elif field in document:
-            serialized[field] = document[field]
+            value = document[field]
+            serialized[field] = to_iso8601(value) if isinstance(value, datetime) else value
+        elif defaults and field in defaults:
+            serialized[field] = defaults[field]
     return serialized
+
+
+def to_projection(fields: list[str]) -> dict[str, int]:
+    """
+    convert_documentに渡すフィールドのリストからMongoDBのプロジェクションを作成する
+    使わないフィールドをMongoDBから送らせないようにする
+
+    :param fields: 取得するフィールドのリスト
+    :return: プロジェクション。_idがリストに無い場合は_idも除外する
+    """
+    projection = {field: 1 for field in fields}
+    projection.setdefault("_id", 0)
+    return projection
+
+
+def utc_now() -> datetime:
+    """
+    現在時刻をMongoDBに保存できるミリ秒の精度で取得する。保存した値と返す値を一致させるため
+
+    :return: UTCの現在時刻
+    """
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def to_iso8601(value: datetime) -> str:
+    """
+    日時をミリ秒までのISO 8601の文字列に変換する。タイムゾーンが無い日時(MongoDBから読んだ値)はUTCとする
+
+    :param value: 日時
+    :return: ISO 8601の文字列
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.isoformat(timespec="milliseconds")
+
+
+def dump_json(value: Any) -> bytes:
+    """
+    値をJSONのバイト列に変換する。orjsonがインストールされている場合はorjsonを使う
+
+    :param value: JSONに変換できる値(dict, list, str, int, float, bool, None)
+    :return: UTF-8のJSONのバイト列
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    dump_jsonで本文を作成するJSONレスポンス
+    jsonable_encoderによる変換を行わないので、JSONに変換できる値だけを渡す
+    """
+
+    def render(self, content: Any) -> bytes:
+        """
+        本文を作成する
+
+        :param content: JSONに変換できる値
+        :return: 本文
+        """
+        return dump_json(content)
+
+
+def encode_cursor(value: str) -> str:
+    """
+    ページングのカーソル値を不透明な文字列にエンコードする
+
+    :param value: カーソルとして使用する値(最後に返したドキュメントのIDなど)
+    :return: URLセーフなカーソル文字列
+    """
+    return urlsafe_b64encode(value.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    """
+    encode_cursorで作成したカーソル文字列を元の値にデコードする
+
+    :param cursor: カーソル文字列
+    :return: カーソルの値
+    :raises ValueError: カーソルの形式が不正な場合
+    """
+    padding = "=" * (-len(cursor) % 4)
+    try:
+        return b64decode(cursor + padding, altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+async def to_ndjson(documents: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    """
+    ドキュメントの非同期イテレータを改行区切りJSON(NDJSON)の行に変換する
+
+    :param documents: ドキュメントの非同期イテレータ
+    :return: 1ドキュメント1行のバイト列の非同期イテレータ
+    """
+    async for document in documents:
+        yield dump_json(document) + b"\n"
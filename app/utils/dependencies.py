@@ -1,16 +1,192 @@
-import certifi
+from __future__ import annotations
+
+from typing import Optional
+
 from decouple import config
+from fastapi import Depends, Request
+from fastapi_csrf_protect import CsrfProtect
 from motor import motor_asyncio
+from services.todo import TodoService
+from services.user import UserService
+from utils.auth import SAFE_METHODS, AuthJwtCsrf, Principal, validate_csrf
+from utils.cache import CacheBackend
+from utils.events import EventHub
+from utils.metrics import mongo_event_listeners
+from utils.rate_limit import AuthRateLimiter
+from utils.search import InvertedIndex
+from utils.slow_queries import slow_queries
 
 MONGO_API_KEY = config("MONGO_API_KEY")
 DATABASE_NAME = "API_DB"
 
 
-def connect_database() -> motor_asyncio.AsyncIOMotorDatabase:
+def mongo_client_options() -> dict:
+    """
+    環境変数からMongoDBクライアントの接続プール設定を作成する
+    - MONGO_MAX_POOL_SIZE: 接続プールの最大接続数
+    - MONGO_MIN_POOL_SIZE: 接続プールの最小接続数
+    - MONGO_MAX_IDLE_TIME_MS: アイドル状態の接続を閉じるまでの時間
+    - MONGO_WAIT_QUEUE_TIMEOUT_MS: 接続の空きを待つ最大時間
+    - MONGO_COMPRESSORS: 通信の圧縮方式(カンマ区切り。例: zstd,snappy,zlib)
+
+    :return: AsyncIOMotorClientに渡すオプション
+    """
+    options = {
+        "maxPoolSize": config("MONGO_MAX_POOL_SIZE", default=100, cast=int),
+        "minPoolSize": config("MONGO_MIN_POOL_SIZE", default=0, cast=int),
+    }
+    max_idle_time_ms = config("MONGO_MAX_IDLE_TIME_MS", default="")
+    if max_idle_time_ms:
+        options["maxIdleTimeMS"] = int(max_idle_time_ms)
+    wait_queue_timeout_ms = config("MONGO_WAIT_QUEUE_TIMEOUT_MS", default="")
+    if wait_queue_timeout_ms:
+        options["waitQueueTimeoutMS"] = int(wait_queue_timeout_ms)
+    compressors = config("MONGO_COMPRESSORS", default="")
+    if compressors:
+        options["compressors"] = compressors
+    return options
+
+
+def uses_memory_backend() -> bool:
     """
-    接続しているMongoDBクライアントからAPI データベースを取得する
+    MONGO_API_KEYがプロセス内のMongoDB互換の実装(memory://)を指しているか判定する
+
+    :return: memory://の場合はTrue
+    """
+    return MONGO_API_KEY.startswith("memory://")
+
+
+def connect_client() -> motor_asyncio.AsyncIOMotorClient:
+    """
+    MongoDBクライアントを作成する。プロセスごとにlifespanで1回だけ呼び出す
+    コマンドのレイテンシと接続プールのメトリクスを記録するリスナーと、遅いクエリのリスナーを登録する
+    MONGO_API_KEYがmemory://の場合は、負荷試験やローカルでの確認のために
+    プロセス内で動くMongoDB互換の実装(mongomock-motor)を使う
+
+    :return: MongoDBクライアント
+    """
+    if uses_memory_backend():
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError as e:
+            raise RuntimeError("The mongomock-motor package is required to use a memory:// MONGO_API_KEY") from e
+        return AsyncMongoMockClient()
+    # 接続する場合にだけ必要なので、インポートの時間を起動時に払わないようにここでインポートする
+    import certifi
+
+    return motor_asyncio.AsyncIOMotorClient(MONGO_API_KEY, tlsCAFile=certifi.where(),
+                                            event_listeners=[*mongo_event_listeners(), slow_queries],
+                                            **mongo_client_options())
 
+
+async def get_principal(request: Request, csrf_protect: CsrfProtect = Depends()) -> Principal:
+    """
+    リクエストを認証する。認証が必要なルートの依存関係で使う
+    - GET以外のメソッドではCSRFトークンを検証する
+    - JWTを検証し、有効期限が迫っている場合は再発行する
+    結果はrequest.state.principalに保存し、同じリクエストの他の依存関係ではそれを使う
+
+    :param request: リクエスト
+    :param csrf_protect: CsrfProtectインスタンス
+    :return: 認証済みのユーザー
+    """
+    principal = getattr(request.state, "principal", None)
+    if principal is None:
+        if request.method not in SAFE_METHODS:
+            await validate_csrf(request, csrf_protect)
+        principal = Principal(*AuthJwtCsrf().refresh_jwt(request))
+        request.state.principal = principal
+    return principal
+
+
+def get_database(request: Request) -> motor_asyncio.AsyncIOMotorDatabase:
+    """
+    lifespanで作成した共有クライアントからAPI データベースを取得する
+
+    :param request: リクエスト
     :return: API_DBデータベースのインスタンス
     """
-    mongo_client = motor_asyncio.AsyncIOMotorClient(MONGO_API_KEY, tlsCAFile=certifi.where())
+    mongo_client = getattr(request.app.state, "mongo_client", None)
+    if mongo_client is None:
+        raise RuntimeError("MongoDB client is not initialized. Run the app with its lifespan enabled.")
     return mongo_client[DATABASE_NAME]
+
+
+def get_todo_cache(request: Request) -> Optional[CacheBackend]:
+    """
+    lifespanで作成したtodoのキャッシュを取得する
+
+    :param request: リクエスト
+    :return: キャッシュ。作成されていない場合はNone
+    """
+    return getattr(request.app.state, "todo_cache", None)
+
+
+def get_event_hub(request: Request) -> EventHub:
+    """
+    lifespanで作成したtodoの変更イベントのEventHubを取得する
+
+    :param request: リクエスト
+    :return: EventHub
+    """
+    event_hub = getattr(request.app.state, "event_hub", None)
+    if event_hub is None:
+        raise RuntimeError("Event hub is not initialized. Run the app with its lifespan enabled.")
+    return event_hub
+
+
+def get_todo_events(request: Request) -> Optional[EventHub]:
+    """
+    TodoServiceが変更イベントを直接配信する先を取得する
+    変更ストリームから配信する場合は、同じイベントを二重に配信しないようにNoneになる
+
+    :param request: リクエスト
+    :return: EventHub。直接配信しない場合はNone
+    """
+    return getattr(request.app.state, "todo_events", None)
+
+
+def get_todo_search(request: Request) -> Optional[InvertedIndex]:
+    """
+    lifespanで作成したtodoの検索用の転置インデックスを取得する
+
+    :param request: リクエスト
+    :return: 転置インデックス。MongoDBのテキストインデックスで検索する場合はNone
+    """
+    return getattr(request.app.state, "todo_search", None)
+
+
+def get_auth_rate_limiter(request: Request) -> Optional[AuthRateLimiter]:
+    """
+    lifespanで作成したログインとユーザー登録の制限を取得する
+
+    :param request: リクエスト
+    :return: 制限。作成されていない場合はNone
+    """
+    return getattr(request.app.state, "auth_rate_limiter", None)
+
+
+def get_todo_service(db: motor_asyncio.AsyncIOMotorDatabase = Depends(get_database),
+                     cache: Optional[CacheBackend] = Depends(get_todo_cache),
+                     events: Optional[EventHub] = Depends(get_todo_events),
+                     search: Optional[InvertedIndex] = Depends(get_todo_search)) -> TodoService:
+    """
+    TodoServiceを取得する
+
+    :param db: DBインスタンス
+    :param cache: todoのキャッシュ
+    :param events: 変更イベントの配信先
+    :param search: 検索用の転置インデックス
+    :return: TodoService
+    """
+    return TodoService(db, cache, events, search)
+
+
+def get_user_service(db: motor_asyncio.AsyncIOMotorDatabase = Depends(get_database)) -> UserService:
+    """
+    UserServiceを取得する
+
+    :param db: DBインスタンス
+    :return: UserService
+    """
+    return UserService(db)
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+from hashlib import sha256
+
+from fastapi import HTTPException
+
+
+def make_etag(version: int) -> str:
+    """
+    バージョン番号から強いETagを作成する
+
+    :param version: ドキュメントのバージョン
+    :return: ETag
+    """
+    return f'"{version}"'
+
+
+def make_list_etag(owner: str, revision: int, *params: object) -> str:
+    """
+    所有者のリビジョンとクエリパラメーターからリストの強いETagを作成する
+    同じURLでも別のユーザーのリストと一致しないように所有者を含める
+
+    :param owner: 所有者
+    :param revision: 所有者のtodoのリビジョン
+    :param params: リストの内容を決めるクエリパラメーター
+    :return: ETag
+    """
+    digest = sha256(repr((owner, revision, *params)).encode("utf-8")).hexdigest()[:32]
+    return f'"{digest}"'
+
+
+def etag_matches(header: str | None, etag: str) -> bool:
+    """
+    If-None-Matchヘッダーが指定したETagと一致するか判定する(弱い比較)
+
+    :param header: If-None-Matchヘッダーの値
+    :param etag: 現在のETag
+    :return: 一致する場合はTrue
+    """
+    if header is None:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag.removeprefix("W/") in (candidate.removeprefix("W/") for candidate in candidates)
+
+
+def parse_if_match(header: str | None) -> int | None:
+    """
+    If-Matchヘッダーから期待するバージョンを取得する
+    - ヘッダーが無い場合と"*"の場合は、バージョンを問わないのでNoneを返す
+    - 弱いETagや解釈できない値は、どのバージョンとも一致しないので412とする
+
+    :param header: If-Matchヘッダーの値
+    :return: 期待するバージョン
+    :raises HTTPException: 一致し得ないETagが指定された場合(412)
+    """
+    if header is None:
+        return None
+    value = header.strip()
+    if value == "*":
+        return None
+    if len(value) > 2 and value[0] == value[-1] == '"' and value[1:-1].isdigit():
+        return int(value[1:-1])
+    raise HTTPException(status_code=412, detail="If-Match does not match the current version")
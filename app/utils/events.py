@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+
+from decouple import config
+from motor import motor_asyncio
+from pymongo.errors import OperationFailure, PyMongoError
+from utils.common import convert_document, dump_json
+
+SSE_MEDIA_TYPE = "text/event-stream"
+# 1接続あたりに溜められるイベントの最大件数(同じtodoのイベントはまとめて1件と数える)
+SUBSCRIPTION_MAX_EVENTS = config("TODO_EVENTS_MAX_QUEUE", default=100, cast=int)
+# 変更が無くても接続を維持するためにコメントを送る間隔
+SSE_HEARTBEAT_SECONDS = config("TODO_EVENTS_HEARTBEAT_SECONDS", default=15, cast=float)
+# 変更ストリームが切断された場合に再接続するまでの時間
+CHANGE_STREAM_RETRY_SECONDS = 1.0
+# 再開トークンが指す位置がoplogから消えている場合のエラーコード
+CHANGE_STREAM_HISTORY_LOST = 286
+EVENT_FIELDS = ["_id", "title", "description", "version", "created_at", "updated_at"]
+EVENT_DEFAULTS = {"version": 0, "created_at": None, "updated_at": None}
+RESYNC_EVENT = {"type": "resync"}
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """
+    1接続分のイベントのキュー
+    - 同じtodoのイベントが溜まっている場合は、最新のものだけを残す(coalesce)
+    - まとめても上限を超える場合は、溜まっているイベントを全て捨ててresyncイベントを1件だけ送る
+      クライアントはresyncを受け取ったら差分同期(GET /api/todos/changes)で追いつく
+    """
+
+    def __init__(self, owner: str, max_events: int = SUBSCRIPTION_MAX_EVENTS) -> None:
+        """
+        コンストラクタ
+
+        :param owner: 購読する所有者
+        :param max_events: 溜められるイベントの最大件数
+        :return: なし
+        """
+        self.owner = owner
+        self.max_events = max(1, max_events)
+        self._events: OrderedDict[str, dict] = OrderedDict()
+        self._overflowed = False
+        self._ready = asyncio.Event()
+        self.coalesced = 0
+        self.overflows = 0
+
+    def put(self, event: dict) -> None:
+        """
+        イベントをキューに追加する。待たずに戻る
+
+        :param event: イベント
+        :return: なし
+        """
+        if self._overflowed:
+            return
+        key = event["id"]
+        if key in self._events:
+            del self._events[key]
+            self.coalesced += 1
+        elif len(self._events) >= self.max_events:
+            self.overflows += 1
+            self.resync()
+            return
+        self._events[key] = event
+        self._ready.set()
+
+    def resync(self) -> None:
+        """
+        溜まっているイベントを捨てて、次にresyncイベントを送る
+
+        :return: なし
+        """
+        self._events.clear()
+        self._overflowed = True
+        self._ready.set()
+
+    async def get(self) -> dict:
+        """
+        次のイベントを取得する。イベントが無い場合は届くまで待つ
+
+        :return: イベント
+        """
+        await self._ready.wait()
+        if self._overflowed:
+            self._overflowed = False
+            self._ready.clear()
+            return RESYNC_EVENT
+        _, event = self._events.popitem(last=False)
+        if not self._events:
+            self._ready.clear()
+        return event
+
+
+class EventHub:
+    """
+    プロセス内でtodoの変更イベントを所有者の購読者に配信する
+    publishは待たずに戻るので、遅い購読者が書き込みを遅らせることはない
+    """
+
+    def __init__(self, max_events: int = SUBSCRIPTION_MAX_EVENTS) -> None:
+        """
+        コンストラクタ
+
+        :param max_events: 1接続あたりに溜められるイベントの最大件数
+        :return: なし
+        """
+        self.max_events = max_events
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self._published = 0
+        self._coalesced = 0
+        self._overflows = 0
+
+    def subscribe(self, owner: str) -> Subscription:
+        """
+        所有者のイベントを購読する。不要になったらunsubscribeを呼ぶ
+
+        :param owner: 所有者
+        :return: 購読
+        """
+        subscription = Subscription(owner, self.max_events)
+        self._subscriptions.setdefault(owner, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        購読を解除する
+
+        :param subscription: 購読
+        :return: なし
+        """
+        subscriptions = self._subscriptions.get(subscription.owner)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.owner]
+        self._coalesced += subscription.coalesced
+        self._overflows += subscription.overflows
+
+    def publish(self, owner: str, event: dict) -> int:
+        """
+        所有者の全ての購読者にイベントを配信する
+
+        :param owner: 所有者
+        :param event: イベント(type, idと、作成・更新の場合はtodoを持つ)
+        :return: 配信した購読者の数
+        """
+        self._published += 1
+        subscriptions = self._subscriptions.get(owner, ())
+        for subscription in subscriptions:
+            subscription.put(event)
+        return len(subscriptions)
+
+    def resync_all(self) -> None:
+        """
+        全ての購読者にresyncイベントを送る。配信できなかったイベントがある場合に使う
+
+        :return: なし
+        """
+        for subscriptions in self._subscriptions.values():
+            for subscription in subscriptions:
+                subscription.resync()
+
+    def stats(self) -> dict[str, int]:
+        """
+        配信のメトリクスを取得する
+
+        :return: メトリクスの辞書
+        """
+        subscriptions = [subscription for owners in self._subscriptions.values() for subscription in owners]
+        return {
+            "subscribers": len(subscriptions),
+            "published": self._published,
+            "coalesced": self._coalesced + sum(subscription.coalesced for subscription in subscriptions),
+            "overflows": self._overflows + sum(subscription.overflows for subscription in subscriptions),
+        }
+
+
+def todo_event(event_type: str, todo: dict) -> dict:
+    """
+    作成・更新のイベントを作成する
+
+    :param event_type: created, updated
+    :param todo: convert_documentで変換したtodo
+    :return: イベント
+    """
+    return {"type": event_type, "id": todo["id"], "todo": todo}
+
+
+def deleted_event(_id: str) -> dict:
+    """
+    削除のイベントを作成する
+
+    :param _id: todoのID
+    :return: イベント
+    """
+    return {"type": "deleted", "id": _id}
+
+
+def format_sse(event: dict) -> bytes:
+    """
+    イベントをServer-Sent Eventsの形式に変換する
+
+    :param event: イベント
+    :return: 1イベント分のバイト列
+    """
+    return f"event: {event['type']}\ndata: ".encode() + dump_json(event) + b"\n\n"
+
+
+async def to_sse(hub: EventHub, owner: str, max_seconds: float,
+                 heartbeat_seconds: float = SSE_HEARTBEAT_SECONDS) -> AsyncIterator[bytes]:
+    """
+    所有者のイベントを購読し、Server-Sent Eventsとして送り続ける
+    - 購読は送信の開始時に行い、接続が切れたら解除する
+    - max_secondsが過ぎたら終了する。EventSourceは自動で再接続するので、その際に認証をやり直せる
+
+    :param hub: EventHub
+    :param owner: 所有者
+    :param max_seconds: 接続を維持する最大時間
+    :param heartbeat_seconds: 接続維持のコメントを送る間隔
+    :return: Server-Sent Eventsのバイト列の非同期イテレータ
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_seconds
+    subscription = hub.subscribe(owner)
+    try:
+        # 再接続までの待ち時間をクライアントに指示する
+        yield b"retry: 1000\n\n"
+        while (remaining := deadline - loop.time()) > 0:
+            try:
+                event = await asyncio.wait_for(subscription.get(), min(heartbeat_seconds, remaining))
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            yield format_sse(event)
+    finally:
+        hub.unsubscribe(subscription)
+
+
+def change_to_event(change: dict) -> tuple[str, dict] | None:
+    """
+    todo, todo_tombstoneコレクションの変更ストリームのイベントを所有者とイベントに変換する
+    todoの削除は所有者が分からないため、同時に作成されるトゥームストーンの挿入を削除のイベントとする
+
+    :param change: 変更ストリームのイベント
+    :return: 所有者とイベント。対象外の変更の場合はNone
+    """
+    collection = change.get("ns", {}).get("coll")
+    document = change.get("fullDocument")
+    if document is None or "owner" not in document:
+        return None
+    if collection == "todo_tombstone" and change["operationType"] == "insert":
+        return document["owner"], deleted_event(str(document["_id"]))
+    if collection == "todo":
+        event_type = "created" if change["operationType"] == "insert" else "updated"
+        return document["owner"], todo_event(event_type, convert_document(document, EVENT_FIELDS, EVENT_DEFAULTS))
+    return None
+
+
+async def watch_changes(db: motor_asyncio.AsyncIOMotorDatabase, hub: EventHub) -> None:
+    """
+    MongoDBの変更ストリームを購読し、EventHubに配信する。キャンセルされるまで続ける
+    他のワーカーやプロセスでの書き込みも配信できる。変更ストリームにはレプリカセットが必要
+
+    :param db: DBインスタンス
+    :param hub: EventHub
+    :return: なし
+    """
+    pipeline = [
+        {"$match": {
+            "ns.coll": {"$in": ["todo", "todo_tombstone"]},
+            "operationType": {"$in": ["insert", "update", "replace"]},
+        }},
+        # イベントに使うフィールドだけを送らせる。_id(再開トークン)はそのまま残る
+        {"$project": {"operationType": 1, "ns": 1, "fullDocument.owner": 1,
+                      **{f"fullDocument.{field}": 1 for field in EVENT_FIELDS}}},
+    ]
+    resume_token = None
+    while True:
+        resume_token = await _follow_changes(db, pipeline, hub, resume_token)
+        await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+
+async def _follow_changes(db: motor_asyncio.AsyncIOMotorDatabase, pipeline: list[dict], hub: EventHub,
+                          resume_token: dict | None) -> dict | None:
+    """
+    変更ストリームが終了するか失敗するまで、変更をEventHubに配信する
+
+    :param db: DBインスタンス
+    :param pipeline: 変更ストリームのパイプライン
+    :param hub: EventHub
+    :param resume_token: 再開トークン。Noneの場合は最新の位置から開始する
+    :return: 次に再開する位置の再開トークン
+    """
+    try:
+        async with db.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+            async for change in stream:
+                resume_token = stream.resume_token
+                converted = change_to_event(change)
+                if converted is not None:
+                    hub.publish(*converted)
+    except PyMongoError as e:
+        logger.exception("Todo change stream failed. Retrying")
+        if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_HISTORY_LOST:
+            # 途中の変更を配信できないので、最新の位置から再開してクライアントには差分同期で追いつかせる
+            hub.resync_all()
+            return None
+    return resume_token
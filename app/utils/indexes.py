@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import sys
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from itertools import product
+from typing import Any, get_args
+
+from bson import ObjectId
+from decouple import config
+from motor import motor_asyncio
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from schemas.todo import TodoSort
+
+# 削除の記録(トゥームストーン)を保持する期間。これより古い同期トークンは410で拒否する
+# TTLインデックスの作成後に変更した場合は、ensure_indexesがcollModでインデックスの期間を変更する
+TOMBSTONE_RETENTION_SECONDS = config("TODO_TOMBSTONE_RETENTION_SECONDS", default=7 * 24 * 60 * 60, cast=int)
+
+# コレクション名とインデックスの定義
+INDEXES: dict[str, list[IndexModel]] = {
+    "user": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "todo": [
+        IndexModel([("owner", ASCENDING), ("_id", ASCENDING)], name="owner_id"),
+        IndexModel([("owner", ASCENDING), ("seq", ASCENDING)], name="owner_seq"),
+        # リストの並べ替え(sort)ごとのインデックス。同じ値の場合は_idの順にしてキーセットページングに使う
+        IndexModel([("owner", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)], name="owner_created_at"),
+        IndexModel([("owner", ASCENDING), ("updated_at", ASCENDING), ("_id", ASCENDING)], name="owner_updated_at"),
+        IndexModel([("owner", ASCENDING), ("title", ASCENDING), ("_id", ASCENDING)], name="owner_title"),
+        # 所有者で絞り込んでから検索する。語幹の処理をせず、プロセス内の転置インデックスと一致の判定を揃える
+        IndexModel([("owner", ASCENDING), ("title", TEXT), ("description", TEXT)], name="owner_text",
+                   default_language="none"),
+    ],
+    "todo_tombstone": [
+        IndexModel([("owner", ASCENDING), ("seq", ASCENDING)], name="owner_seq"),
+        # 保持期間を過ぎたトゥームストーンはMongoDBが自動で削除する
+        IndexModel([("deleted_at", ASCENDING)], name="deleted_at_ttl", expireAfterSeconds=TOMBSTONE_RETENTION_SECONDS),
+    ],
+}
+
+# 正しさがインデックスに依存するコレクション(ユーザー登録はemailのユニークインデックスで重複を検出する)
+# lifespanでリクエストの受け付け前に作成する
+REQUIRED_COLLECTIONS = ("user",)
+
+# サービスが発行するクエリの形(コレクション名, フィルター, ソート)。checkで実行計画を検証する
+# リストを取得するクエリは、list_query_shapesでTodoServiceから作成する
+QUERY_SHAPES: list[tuple[str, dict, list[tuple[str, int]] | None]] = [
+    ("user", {"email": "user@example.com"}, None),
+    ("todo", {"_id": ObjectId(), "owner": "user@example.com"}, None),
+    ("todo", {"owner": "user@example.com", "seq": {"$gt": 0, "$lte": 1}}, [("seq", ASCENDING)]),
+    ("todo", {"owner": "user@example.com", "$text": {"$search": "milk"}}, None),
+    ("todo_tombstone", {"owner": "user@example.com", "seq": {"$gt": 0, "$lte": 1}}, [("seq", ASCENDING)]),
+]
+
+
+class CollectionScanError(Exception):
+    """クエリの実行計画がコレクション全体のスキャン(COLLSCAN)になっている"""
+
+
+class UnsupportedQueryError(Exception):
+    """定義されたインデックスでは並べ替えられないクエリ。実行するとメモリ上での並べ替えになる"""
+
+
+def find_supporting_index(collection_name: str, equality: list[str], sort: list[tuple[str, int]],
+                          ranges: tuple[str, ...] = ()) -> tuple[str, list[str]]:
+    """
+    一致条件と並べ替えをインデックスだけで処理できる、定義されたインデックスを探す
+    インデックスのキーが一致条件のフィールド(順不同)、並べ替えのフィールド(全て同じ向きか全て逆向き)の順に
+    始まる場合に使える(Equality, Sort, Rangeの順)
+
+    :param collection_name: コレクション名
+    :param equality: 一致条件のフィールド
+    :param sort: 並べ替えのフィールドと向き
+    :param ranges: 範囲条件のフィールド
+    :return: インデックス名と、インデックスに含まれない範囲条件のフィールド(取得したドキュメントで絞り込まれる)
+    :raises UnsupportedQueryError: 並べ替えに使えるインデックスが無い場合
+    """
+    for index in INDEXES.get(collection_name, []):
+        keys = list(index.document["key"].items())
+        if any(direction not in (ASCENDING, DESCENDING) for _, direction in keys):
+            continue
+        prefix, rest = keys[:len(equality)], keys[len(equality):len(equality) + len(sort)]
+        if {field for field, _ in prefix} != set(equality) or [field for field, _ in rest] != [f for f, _ in sort]:
+            continue
+        directions = {direction * sort_direction for (_, direction), (_, sort_direction) in zip(rest, sort)}
+        if len(directions) <= 1:
+            fields = {field for field, _ in keys}
+            return index.document["name"], [field for field in ranges if field not in fields]
+    raise UnsupportedQueryError(f"No index on {collection_name} supports filtering on {equality} sorted by {sort}")
+
+
+async def ensure_indexes(db: motor_asyncio.AsyncIOMotorDatabase,
+                         collections: Iterable[str] | None = None) -> dict[str, list[str]]:
+    """
+    定義されたインデックスを作成する。既に同じ定義のインデックスがある場合は何もしない
+    TTLインデックスの期間だけが異なる場合は、作り直さずにcollModで期間を変更する
+    (create_indexesはオプションの異なる同名のインデックスをIndexOptionsConflictで拒否するため)
+
+    :param db: DBインスタンス
+    :param collections: 作成するコレクション名。Noneの場合は全てのコレクション
+    :return: コレクション名と作成(確認)したインデックス名の辞書
+    """
+    created = {}
+    for collection_name, indexes in INDEXES.items():
+        if indexes and (collections is None or collection_name in collections):
+            await _update_ttl(db, collection_name, indexes)
+            created[collection_name] = await db[collection_name].create_indexes(indexes)
+    return created
+
+
+async def _update_ttl(db: motor_asyncio.AsyncIOMotorDatabase, collection_name: str,
+                      indexes: list[IndexModel]) -> None:
+    """
+    既存のTTLインデックスの期間が定義と異なる場合に、collModで定義の期間に変更する
+
+    :param db: DBインスタンス
+    :param collection_name: コレクション名
+    :param indexes: コレクションのインデックスの定義
+    :return: なし
+    """
+    ttl = {index.document["name"]: index.document["expireAfterSeconds"] for index in indexes
+           if "expireAfterSeconds" in index.document}
+    if not ttl:
+        return
+    existing = await db[collection_name].index_information()
+    for name, seconds in ttl.items():
+        current = existing.get(name, {}).get("expireAfterSeconds")
+        if current is not None and current != seconds:
+            await db.command({"collMod": collection_name, "index": {"name": name, "expireAfterSeconds": seconds}})
+
+
+def find_collection_scans(plan: Any) -> list[dict]:
+    """
+    explainの結果からCOLLSCANのステージを探す
+
+    :param plan: explainの結果(またはその一部)
+    :return: COLLSCANのステージのリスト
+    """
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in find_collection_scans(item)]
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan] if plan.get("stage") == "COLLSCAN" else []
+    for key, value in plan.items():
+        # 却下された実行計画は対象外
+        if key != "rejectedPlans":
+            stages.extend(find_collection_scans(value))
+    return stages
+
+
+async def assert_index_used(collection: motor_asyncio.AsyncIOMotorCollection, query: dict,
+                            sort: list[tuple[str, int]] | None = None) -> dict:
+    """
+    クエリの実行計画を取得し、COLLSCANになっていないことを検証する
+
+    :param collection: コレクション
+    :param query: フィルター
+    :param sort: ソート
+    :return: explainの結果
+    :raises CollectionScanError: 実行計画がCOLLSCANの場合
+    """
+    cursor = collection.find(query, sort=sort)
+    plan = await cursor.explain()
+    if find_collection_scans(plan.get("queryPlanner", {}).get("winningPlan")):
+        raise CollectionScanError(f"{collection.name}.find({query}, sort={sort}) uses COLLSCAN")
+    return plan
+
+
+def list_query_shapes() -> list[tuple[str, dict, list[tuple[str, int]]]]:
+    """
+    todoのリストのクエリの形を、TodoServiceがクエリを作成する処理から全ての組み合わせについて作成する
+    並べ替え(無しと全てのTodoSort)、次ページカーソルの有無、作成日時と、タイトルの前方一致での絞り込みの有無を組み合わせる
+
+    :return: QUERY_SHAPESと同じ形式のクエリの形のリスト
+    """
+    # サービスがINDEXESを参照するので、循環インポートにならないようにここでインポートする
+    from services.todo import TodoService
+
+    now = datetime.now(timezone.utc)
+    sample = {"id": str(ObjectId()), "created_at": now.isoformat(), "updated_at": now.isoformat(), "title": "milk"}
+    shapes = []
+    for order in (None, *get_args(TodoSort)):
+        field = "_id" if order is None else order.lstrip("-")
+        for after, created, title_prefix in product((None, TodoService._encode_list_cursor(sample, field)),
+                                                    (False, True), (False, True)):
+            filters = {"sort": order}
+            if created:
+                filters.update(created_after=now, created_before=now)
+            if title_prefix:
+                filters["title_prefix"] = "milk"
+            query, sort, _ = TodoService._list_query("user@example.com", after, filters)
+            shapes.append(("todo", query, sort))
+    return shapes
+
+
+async def check_query_plans(db: motor_asyncio.AsyncIOMotorDatabase) -> list[str]:
+    """
+    QUERY_SHAPESとtodoのリストの全てのクエリについてCOLLSCANにならないか検証する
+
+    :param db: DBインスタンス
+    :return: COLLSCANになったクエリのエラーメッセージのリスト
+    """
+    errors = [await _collection_scan_error(db[collection_name], query, sort)
+              for collection_name, query, sort in [*QUERY_SHAPES, *list_query_shapes()]]
+    return [error for error in errors if error is not None]
+
+
+async def _collection_scan_error(collection: motor_asyncio.AsyncIOMotorCollection, query: dict,
+                                 sort: list[tuple[str, int]] | None) -> str | None:
+    """
+    クエリがCOLLSCANになる場合のエラーメッセージを取得する
+
+    :param collection: コレクション
+    :param query: フィルター
+    :param sort: ソート
+    :return: エラーメッセージ。インデックスを使う場合はNone
+    """
+    try:
+        await assert_index_used(collection, query, sort)
+    except CollectionScanError as e:
+        return str(e)
+    return None
+
+
+async def _run(command: str) -> int:
+    """
+    CLIのコマンドを実行する
+
+    :param command: ensureまたはcheck
+    :return: 終了コード
+    """
+    # サービスがINDEXESを参照するので、循環インポートにならないようにここでインポートする
+    from utils.dependencies import DATABASE_NAME, connect_client
+
+    mongo_client = connect_client()
+    try:
+        db = mongo_client[DATABASE_NAME]
+        if command == "ensure":
+            for collection_name, names in (await ensure_indexes(db)).items():
+                print(f"{collection_name}: {', '.join(names)}")
+            return 0
+        errors = await check_query_plans(db)
+        for error in errors:
+            print(error, file=sys.stderr)
+        return 1 if errors else 0
+    finally:
+        mongo_client.close()
+
+
+def main() -> None:
+    """
+    インデックスの作成(ensure)と実行計画の検証(check)を行うCLI
+
+    :return: なし
+    """
+    parser = argparse.ArgumentParser(description="Manage MongoDB indexes")
+    parser.add_argument("command", choices=["ensure", "check"])
+    args = parser.parse_args()
+    sys.exit(asyncio.run(_run(args.command)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,471 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections.abc import Iterable
+from typing import Any
+
+from pymongo import monitoring
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from utils.slow_queries import query_route
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# レイテンシのヒストグラムのバケット(秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# どのルートにも一致しなかったリクエストのルート名。生のパスをラベルにしないようにまとめる
+UNMATCHED_ROUTE = "<unmatched>"
+# stats()の値のうち起動からの累積の回数。カウンター(名前の末尾に_total)として出力し、それ以外はゲージにする
+CUMULATIVE_STATS = frozenset({
+    "hits", "misses", "evictions", "expirations", "published", "coalesced", "overflows", "rejected", "rejected_ip",
+    "rejected_email", "completed",
+})
+
+
+def _escape(value: str) -> str:
+    """
+    ラベルの値をテキスト形式用にエスケープする
+
+    :param value: ラベルの値
+    :return: エスケープした値
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[Any]) -> str:
+    """
+    ラベルをテキスト形式の{name="value",...}に変換する
+
+    :param names: ラベル名
+    :param values: ラベルの値
+    :return: ラベルの文字列。ラベルが無い場合は空文字
+    """
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _prepend_labels(labels: str, extra: str) -> str:
+    """
+    ラベルの文字列の先頭にラベルを追加する
+
+    :param labels: _format_labelsで変換したラベルの文字列
+    :param extra: 追加するname="value"の文字列。空の場合は追加しない
+    :return: ラベルの文字列
+    """
+    if not extra:
+        return labels
+    return "{" + extra + ("," + labels[1:] if labels else "}")
+
+
+def _format_value(value: float) -> str:
+    """
+    値をテキスト形式に変換する
+
+    :param value: 値
+    :return: 値の文字列
+    """
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    """
+    ラベルごとの値を持つメトリクスの基底クラス
+    pymongoのリスナーはワーカースレッドから呼ばれるので、値の更新はロックで保護する
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        """
+        コンストラクタ
+
+        :param name: メトリクス名
+        :param documentation: 説明
+        :param labelnames: ラベル名
+        :return: なし
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """
+        出力するサンプルを取得する
+
+        :return: (サンプル名, ラベル文字列, 値)のリスト
+        """
+        with self._lock:
+            return [(self.name, _format_labels(self.labelnames, labels), value)
+                    for labels, value in sorted(self._values.items())]
+
+    def render(self, constant_labels: str = "") -> str:
+        """
+        テキスト形式に変換する
+
+        :param constant_labels: 全てのサンプルの先頭に追加するname="value"の文字列
+        :return: HELP, TYPEとサンプルの行
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{_prepend_labels(labels, constant_labels)} {_format_value(value)}"
+                     for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """増加のみする値"""
+
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        """
+        値を増やす
+
+        :param labels: ラベルの値(labelnamesと同じ順)
+        :param amount: 増やす量
+        :return: なし
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """増減する値"""
+
+    kind = "gauge"
+
+    def set(self, labels: tuple, value: float) -> None:
+        """
+        値を設定する
+
+        :param labels: ラベルの値
+        :param value: 値
+        :return: なし
+        """
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """値の分布をバケットごとの件数、合計と件数で記録する"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        """
+        コンストラクタ
+
+        :param name: メトリクス名
+        :param documentation: 説明
+        :param labelnames: ラベル名
+        :param buckets: バケットの上限(昇順)
+        :return: なし
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple, value: float) -> None:
+        """
+        値を記録する
+
+        :param labels: ラベルの値
+        :param value: 値
+        :return: なし
+        """
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # バケット(+Infを含む)ごとの件数と合計
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        """
+        出力するサンプルを取得する。バケットの件数は累積にする
+
+        :return: (サンプル名, ラベル文字列, 値)のリスト
+        """
+        with self._lock:
+            values = sorted((labels, list(counts), total) for labels, (counts, total) in self._values.items())
+        samples = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _format_labels((*self.labelnames, "le"), (*labels, bound))
+                samples.append((f"{self.name}_bucket", bucket_labels, cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            samples.append((f"{self.name}_sum", label_text, total))
+            samples.append((f"{self.name}_count", label_text, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """アプリのメトリクス"""
+
+    def __init__(self) -> None:
+        """
+        コンストラクタ
+
+        :return: なし
+        """
+        self.http_requests = Counter("http_requests_total", "HTTP requests by route template and status.",
+                                     ("method", "route", "status"))
+        self.http_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route template.",
+                                       ("method", "route"))
+        self.http_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being handled.",
+                                    ("method",))
+        self.mongo_duration = Histogram("mongodb_command_duration_seconds",
+                                        "MongoDB command latency by command and collection.",
+                                        ("command", "collection"))
+        self.mongo_failures = Counter("mongodb_command_failures_total", "Failed MongoDB commands.",
+                                      ("command", "collection"))
+        self.pool_connections = Gauge("mongodb_pool_connections", "Open connections in the MongoDB pool.",
+                                      ("address",))
+        self.pool_checked_out = Gauge("mongodb_pool_checked_out_connections",
+                                      "Connections checked out of the MongoDB pool.", ("address",))
+        self.pool_checkout_failures = Counter("mongodb_pool_checkout_failures_total",
+                                              "Failed connection checkouts from the MongoDB pool.",
+                                              ("address", "reason"))
+        self.metrics: list[Metric] = [
+            self.http_requests, self.http_duration, self.http_in_flight, self.mongo_duration, self.mongo_failures,
+            self.pool_connections, self.pool_checked_out, self.pool_checkout_failures,
+        ]
+
+    def render(self, stats: dict[str, dict[str, Any]] | None = None) -> str:
+        """
+        全てのメトリクスをテキスト形式に変換する
+        - 値はプロセスごとに持つので、全てのサンプルにプロセスIDのpidラベルを付け、ワーカーごとの系列に分ける
+          ワーカーが再起動した場合も、カウンターの値が減るのではなく新しい系列になる
+        - stats()の値のうち、CUMULATIVE_STATSはカウンター、それ以外の数値はゲージ、文字列はラベルにする
+
+        :param stats: 追加で出力する統計(名前とstats()の戻り値の辞書)
+        :return: テキスト形式のメトリクス
+        """
+        # gunicornはインポートの後にワーカーをforkするので、出力するたびにプロセスIDを取得する
+        worker = f'pid="{os.getpid()}"'
+        blocks = [metric.render(worker) for metric in self.metrics]
+        for prefix, values in (stats or {}).items():
+            labelnames = tuple(key for key, value in values.items() if isinstance(value, str))
+            labels = tuple(values[key] for key in labelnames)
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    if key in CUMULATIVE_STATS:
+                        metric = Counter(f"{prefix}_{key}_total", f"{prefix} {key}.", labelnames)
+                        metric.inc(labels, value)
+                    else:
+                        metric = Gauge(f"{prefix}_{key}", f"{prefix} {key}.", labelnames)
+                        metric.set(labels, value)
+                    blocks.append(metric.render(worker))
+        return "\n".join(blocks) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def route_template(scope: Scope) -> str:
+    """
+    リクエストが一致したルートのパスのテンプレート(例: /api/todos/{_id})を取得する
+    ルーターが照合の結果をscope["route"]に設定するので、ルートを照合し直さない
+    メソッドだけが一致しない場合(405)も、ルーターはそのルートを設定する
+
+    :param scope: ASGIのスコープ
+    :return: ルートのパス。ルーティングの前か、一致しない場合はUNMATCHED_ROUTE
+    """
+    return getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+
+
+class RouteLabel:
+    """
+    遅いクエリのログに出力するルート(例: GET /api/todos/{_id})
+    ミドルウェアはルーティングの前にquery_routeを設定するので、文字列にするときにルーターの結果を読む
+    """
+
+    __slots__ = ("scope",)
+
+    def __init__(self, scope: Scope) -> None:
+        """
+        コンストラクタ
+
+        :param scope: ASGIのスコープ
+        :return: なし
+        """
+        self.scope = scope
+
+    def __str__(self) -> str:
+        """
+        メソッドとルートのテンプレート
+
+        :return: ルート
+        """
+        return f"{self.scope['method']} {route_template(self.scope)}"
+
+
+class MetricsMiddleware:
+    """
+    リクエスト数とレイテンシをルートのテンプレートごとに、処理中のリクエスト数をメソッドごとに記録するASGIミドルウェア
+    生のパスではなくテンプレートをラベルにするので、IDごとに系列が増えることはない
+    テンプレートはルーティングの後にscope["route"]から取得する
+    """
+
+    def __init__(self, app: ASGIApp, registry: MetricsRegistry = metrics) -> None:
+        """
+        コンストラクタ
+
+        :param app: 次のASGIアプリ
+        :param registry: 記録先
+        :return: なし
+        """
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        リクエストを処理して記録する
+
+        :param scope: ASGIのスコープ
+        :param receive: ASGIのreceive
+        :param send: ASGIのsend
+        :return: なし
+        """
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.registry.http_in_flight.inc((method,))
+        token = query_route.set(RouteLabel(scope))
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            query_route.reset(token)
+            labels = (method, route_template(scope))
+            self.registry.http_duration.observe(labels, time.perf_counter() - started)
+            self.registry.http_in_flight.inc((method,), -1)
+            self.registry.http_requests.inc((*labels, str(status)))
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """MongoDBのコマンドのレイテンシをコマンドとコレクションごとに記録する"""
+
+    def __init__(self, registry: MetricsRegistry = metrics) -> None:
+        """
+        コンストラクタ
+
+        :param registry: 記録先
+        :return: なし
+        """
+        self.registry = registry
+        self._collections: dict[tuple, str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        """
+        コマンドの対象のコレクションを記録する。完了のイベントにはコマンドの内容が含まれないため
+
+        :param event: イベント
+        :return: なし
+        """
+        # getMoreはコマンド名の値がカーソルIDなので、collectionから取得する
+        key = "collection" if event.command_name == "getMore" else event.command_name
+        collection = event.command.get(key)
+        self._collections[(event.request_id, event.connection_id)] = collection if isinstance(collection, str) else ""
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        """
+        成功したコマンドのレイテンシを記録する
+
+        :param event: イベント
+        :return: なし
+        """
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        self.registry.mongo_duration.observe((event.command_name, collection), event.duration_micros / 1_000_000)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        """
+        失敗したコマンドのレイテンシと件数を記録する
+
+        :param event: イベント
+        :return: なし
+        """
+        collection = self._collections.pop((event.request_id, event.connection_id), "")
+        self.registry.mongo_duration.observe((event.command_name, collection), event.duration_micros / 1_000_000)
+        self.registry.mongo_failures.inc((event.command_name, collection))
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """MongoDBの接続プールの接続数と貸出中の接続数を記録する"""
+
+    def __init__(self, registry: MetricsRegistry = metrics) -> None:
+        """
+        コンストラクタ
+
+        :param registry: 記録先
+        :return: なし
+        """
+        self.registry = registry
+
+    @staticmethod
+    def _address(event: monitoring._PoolEvent) -> tuple[str]:
+        """
+        イベントのサーバーのアドレスをラベルにする
+
+        :param event: イベント
+        :return: ラベルの値
+        """
+        host, port = event.address
+        return (f"{host}:{port}",)
+
+    def pool_created(self, event: monitoring.PoolCreatedEvent) -> None:
+        self.registry.pool_connections.inc(self._address(event), 0)
+
+    def pool_ready(self, event: monitoring.PoolReadyEvent) -> None:
+        pass
+
+    def pool_cleared(self, event: monitoring.PoolClearedEvent) -> None:
+        pass
+
+    def pool_closed(self, event: monitoring.PoolClosedEvent) -> None:
+        pass
+
+    def connection_created(self, event: monitoring.ConnectionCreatedEvent) -> None:
+        self.registry.pool_connections.inc(self._address(event))
+
+    def connection_ready(self, event: monitoring.ConnectionReadyEvent) -> None:
+        pass
+
+    def connection_closed(self, event: monitoring.ConnectionClosedEvent) -> None:
+        self.registry.pool_connections.inc(self._address(event), -1)
+
+    def connection_check_out_started(self, event: monitoring.ConnectionCheckOutStartedEvent) -> None:
+        pass
+
+    def connection_check_out_failed(self, event: monitoring.ConnectionCheckOutFailedEvent) -> None:
+        self.registry.pool_checkout_failures.inc((*self._address(event), str(event.reason)))
+
+    def connection_checked_out(self, event: monitoring.ConnectionCheckedOutEvent) -> None:
+        self.registry.pool_checked_out.inc(self._address(event))
+
+    def connection_checked_in(self, event: monitoring.ConnectionCheckedInEvent) -> None:
+        self.registry.pool_checked_out.inc(self._address(event), -1)
+
+
+def mongo_event_listeners() -> list[monitoring._EventListener]:
+    """
+    MongoDBクライアントに登録するメトリクスのリスナーを作成する
+
+    :return: リスナーのリスト
+    """
+    return [CommandMetricsListener(), PoolMetricsListener()]
@@ -0,0 +1,99 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+from typing import Callable
+
+from decouple import config
+
+# bcryptのコスト(rounds)。数値を指定した場合はそのまま使い、autoの場合は起動したホストで計測して決める
+# 未指定の場合はpasslibの既定値を使う
+PASSWORD_HASH_ROUNDS = config("PASSWORD_HASH_ROUNDS", default="")
+# autoの場合に、1回のパスワードのハッシュ計算(=ログイン1回のCPU時間)にかけてよい時間(ミリ秒)
+PASSWORD_HASH_TARGET_MS = config("PASSWORD_HASH_TARGET_MS", default=250, cast=float)
+# 計測で決めるコストの範囲。下限より速くはしない
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+# 計測に使うコスト。計測が短すぎて誤差が大きくならず、長すぎて起動を遅らせない値にする
+PROBE_ROUNDS = 10
+PROBE_SAMPLES = 3
+
+logger = logging.getLogger(__name__)
+
+
+def measure_rounds(rounds: int, samples: int = PROBE_SAMPLES) -> float:
+    """
+    bcryptのハッシュ計算にかかる時間を計測する。他の処理の影響を除くため最も短い時間を使う
+
+    :param rounds: bcryptのコスト
+    :param samples: 計測する回数
+    :return: 1回のハッシュ計算にかかった時間(ミリ秒)
+    """
+    from passlib.hash import bcrypt
+
+    handler = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        handler.hash("password-cost-calibration")
+        timings.append((time.perf_counter() - started) * 1000)
+    return min(timings)
+
+
+def calibrate_rounds(target_ms: float, measure: Callable[[int], float] = measure_rounds) -> int:
+    """
+    ハッシュ計算の時間が目標を超えない最大のbcryptのコストを求める
+    bcryptはコストが1増えるごとに計算時間が2倍になるので、PROBE_ROUNDSの計測結果から推定する
+
+    :param target_ms: 1回のハッシュ計算の目標時間(ミリ秒)
+    :param measure: コストを受け取り計算時間(ミリ秒)を返す計測関数
+    :return: bcryptのコスト(MIN_ROUNDS〜MAX_ROUNDS)
+    """
+    probe_ms = measure(PROBE_ROUNDS)
+    rounds = PROBE_ROUNDS
+    while rounds < MAX_ROUNDS and probe_ms * 2 ** (rounds + 1 - PROBE_ROUNDS) <= target_ms:
+        rounds += 1
+    if rounds == MIN_ROUNDS and probe_ms > target_ms:
+        logger.warning("bcrypt rounds=%d takes %.1fms, over the %.0fms budget; using the minimum",
+                       MIN_ROUNDS, probe_ms, target_ms)
+    return max(MIN_ROUNDS, rounds)
+
+
+def resolve_rounds(value: str = PASSWORD_HASH_ROUNDS, target_ms: float = PASSWORD_HASH_TARGET_MS) -> int | None:
+    """
+    設定からbcryptのコストを決める
+
+    :param value: PASSWORD_HASH_ROUNDSの値(数値、autoまたは空)
+    :param target_ms: autoの場合の目標時間(ミリ秒)
+    :return: bcryptのコスト。未指定の場合はNone(passlibの既定値を使う)
+    """
+    if not value:
+        return None
+    if value != "auto":
+        return int(value)
+    started = time.perf_counter()
+    rounds = calibrate_rounds(target_ms)
+    logger.info("Calibrated bcrypt rounds=%d for a %.0fms budget in %.0fms", rounds, target_ms,
+                (time.perf_counter() - started) * 1000)
+    return rounds
+
+
+def main() -> None:
+    """
+    このホストでbcryptのコストごとの計算時間を計測し、目標時間に合うPASSWORD_HASH_ROUNDSを表示するCLI
+
+    :return: なし
+    """
+    parser = argparse.ArgumentParser(description="Calibrate the bcrypt cost for a login latency budget")
+    parser.add_argument("--target-ms", type=float, default=PASSWORD_HASH_TARGET_MS,
+                        help="time one password hash may take")
+    args = parser.parse_args()
+    rounds = calibrate_rounds(args.target_ms)
+    for candidate in range(max(MIN_ROUNDS, rounds - 1), min(MAX_ROUNDS, rounds + 1) + 1):
+        print(f"rounds={candidate}: {measure_rounds(candidate, samples=1):.1f}ms")
+    print(f"PASSWORD_HASH_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    main()
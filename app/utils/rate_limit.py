@@ -0,0 +1,289 @@
+from __future__ import annotations
+
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Protocol
+
+from decouple import config
+from fastapi import HTTPException
+
+# 1回の操作でトークンバケットを更新するRedisのスクリプト。時刻はワーカー間でずれないようにRedisのTIMEを使う
+# 満タンに戻るまでの時間が過ぎたバケットは、存在しない(満タンの)バケットと同じなので有効期限で削除する
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local retry_after = 0
+if tokens >= cost then
+  tokens = tokens - cost
+else
+  retry_after = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+def take_token(tokens: float, updated_at: float, now: float, capacity: float, rate: float,
+               cost: float = 1) -> tuple[float, float]:
+    """
+    トークンバケットを補充してからトークンを取り出す。TOKEN_BUCKET_SCRIPTと同じ計算を行う
+
+    :param tokens: 前回の更新時のトークン数
+    :param updated_at: 前回の更新時刻(秒)
+    :param now: 現在時刻(秒)
+    :param capacity: バケットの容量(連続して許可する回数)
+    :param rate: 1秒あたりに補充するトークン数
+    :param cost: 取り出すトークン数
+    :return: 更新後のトークン数と、取り出せなかった場合に次に取り出せるまでの秒数(取り出せた場合は0)
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class RateLimitBackend(Protocol):
+    """
+    トークンバケットを保持するバックエンド
+    """
+
+    async def take(self, key: str, capacity: int, rate: float, cost: float = 1) -> float:
+        ...
+
+    def stats(self) -> dict[str, int | str]:
+        ...
+
+    async def close(self) -> None:
+        ...
+
+
+class TokenBucketTable:
+    """
+    プロセス内のトークンバケットの表
+    - キーのハッシュで分けたシャードごとに件数の上限を持ち、超えた場合は最も長く使われていないバケットを削除する
+      削除は追加したシャードの中だけで済むので、大量の異なるキー(IPアドレスなど)が来ても一定のメモリとコストで済む
+    - 削除されたバケットは次に使われたときに満タンから始まる
+    """
+
+    def __init__(self, max_entries: int = 100000, shards: int = 16) -> None:
+        """
+        コンストラクタ
+
+        :param max_entries: 保持する最大件数(全シャードの合計)
+        :param shards: シャードの数
+        :return: なし
+        """
+        self._shards: list[OrderedDict[str, tuple[float, float]]] = [OrderedDict() for _ in range(max(1, shards))]
+        self.max_entries_per_shard = max(1, max_entries // len(self._shards))
+        self._evictions = 0
+
+    async def take(self, key: str, capacity: int, rate: float, cost: float = 1) -> float:
+        """
+        キーのバケットからトークンを取り出す
+
+        :param key: キー
+        :param capacity: バケットの容量
+        :param rate: 1秒あたりに補充するトークン数
+        :param cost: 取り出すトークン数
+        :return: 取り出せなかった場合は次に取り出せるまでの秒数。取り出せた場合は0
+        """
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        tokens, updated_at = shard.get(key, (capacity, now))
+        tokens, retry_after = take_token(tokens, updated_at, now, capacity, rate, cost)
+        shard[key] = (tokens, now)
+        shard.move_to_end(key)
+        if len(shard) > self.max_entries_per_shard:
+            shard.popitem(last=False)
+            self._evictions += 1
+        return retry_after
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        バケットの表のメトリクスを取得する
+
+        :return: メトリクスの辞書
+        """
+        return {
+            "backend": "memory",
+            "entries": sum(len(shard) for shard in self._shards),
+            "evictions": self._evictions,
+        }
+
+    async def close(self) -> None:
+        """
+        全てのバケットを削除する
+
+        :return: なし
+        """
+        for shard in self._shards:
+            shard.clear()
+
+
+class RedisTokenBuckets:
+    """
+    Redisに保持するトークンバケット。全てのワーカーやプロセスで同じ制限を共有できる
+    redis.asyncio.Redisと同じeval/acloseを持つクライアントを使う
+    """
+
+    def __init__(self, client: Any, prefix: str = "ratelimit:") -> None:
+        """
+        コンストラクタ
+
+        :param client: redis.asyncio.Redis互換のクライアント
+        :param prefix: キーの接頭辞
+        :return: なし
+        """
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "ratelimit:") -> RedisTokenBuckets:
+        """
+        URLからRedisに接続するバックエンドを作成する。redisパッケージが必要
+
+        :param url: RedisのURL(例: redis://localhost:6379/0)
+        :param prefix: キーの接頭辞
+        :return: RedisTokenBuckets
+        """
+        try:
+            from redis import asyncio as redis_asyncio
+        except ImportError as e:
+            raise RuntimeError("The redis package is required to use a redis:// rate limit URL") from e
+        return cls(redis_asyncio.from_url(url), prefix)
+
+    async def take(self, key: str, capacity: int, rate: float, cost: float = 1) -> float:
+        """
+        キーのバケットからトークンを取り出す
+
+        :param key: キー
+        :param capacity: バケットの容量
+        :param rate: 1秒あたりに補充するトークン数
+        :param cost: 取り出すトークン数
+        :return: 取り出せなかった場合は次に取り出せるまでの秒数。取り出せた場合は0
+        """
+        retry_after = await self.client.eval(TOKEN_BUCKET_SCRIPT, 1, self.prefix + key, capacity, rate, cost)
+        return float(retry_after)
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        バックエンドのメトリクスを取得する。件数はRedis側で管理されるため含まない
+
+        :return: メトリクスの辞書
+        """
+        return {"backend": "redis"}
+
+    async def close(self) -> None:
+        """
+        接続を閉じる
+
+        :return: なし
+        """
+        await self.client.aclose()
+
+
+def parse_limit(value: str) -> tuple[int, float]:
+    """
+    制限の設定(回数/秒数。例: 5/60)を解析する
+
+    :param value: 制限の設定
+    :return: バケットの容量と、1秒あたりに補充するトークン数
+    """
+    count, _, seconds = value.partition("/")
+    capacity, period = int(count), float(seconds or 1)
+    if capacity <= 0 or period <= 0:
+        raise ValueError(f"Invalid rate limit: {value}")
+    return capacity, capacity / period
+
+
+class AuthRateLimiter:
+    """
+    ログインとユーザー登録の回数をクライアントのIPアドレスとメールアドレスごとに制限する
+    パスワードのハッシュ計算の前に確認し、大量の試行でCPUを使い切らないようにする
+    """
+
+    def __init__(self, backend: RateLimitBackend, ip_limit: tuple[int, float],
+                 email_limit: tuple[int, float]) -> None:
+        """
+        コンストラクタ
+
+        :param backend: トークンバケットのバックエンド
+        :param ip_limit: IPアドレスごとのバケットの容量と補充の速さ
+        :param email_limit: メールアドレスごとのバケットの容量と補充の速さ
+        :return: なし
+        """
+        self.backend = backend
+        self.ip_limit = ip_limit
+        self.email_limit = email_limit
+        self._rejected = {"ip": 0, "email": 0}
+
+    async def check(self, client_ip: str | None, email: str) -> None:
+        """
+        IPアドレスとメールアドレスのバケットからトークンを取り出す
+        IPアドレスで拒否した場合は、メールアドレスのトークンは使わない
+
+        :param client_ip: クライアントのIPアドレス。不明な場合はNone
+        :param email: メールアドレス
+        :return: なし
+        :raises HTTPException: いずれかのバケットが空の場合(429)
+        """
+        checks = [("email", email.strip().lower(), self.email_limit)]
+        if client_ip:
+            checks.insert(0, ("ip", client_ip, self.ip_limit))
+        for kind, value, (capacity, rate) in checks:
+            retry_after = await self.backend.take(f"{kind}:{value}", capacity, rate)
+            if retry_after > 0:
+                self._rejected[kind] += 1
+                raise HTTPException(status_code=429, detail="Too many requests",
+                                    headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        制限のメトリクスを取得する
+        - rejected_ip, rejected_email: IPアドレスとメールアドレスで拒否した回数
+
+        :return: メトリクスの辞書
+        """
+        return {**self.backend.stats(), "rejected_ip": self._rejected["ip"], "rejected_email": self._rejected["email"]}
+
+    async def close(self) -> None:
+        """
+        バックエンドを閉じる
+
+        :return: なし
+        """
+        await self.backend.close()
+
+
+def create_auth_rate_limiter() -> AuthRateLimiter | None:
+    """
+    環境変数の設定からログインとユーザー登録の制限を作成する
+    - AUTH_RATE_LIMIT_ENABLED: falseの場合は制限しない
+    - AUTH_RATE_LIMIT_IP: IPアドレスごとの制限(回数/秒数)
+    - AUTH_RATE_LIMIT_EMAIL: メールアドレスごとの制限(回数/秒数)
+    - AUTH_RATE_LIMIT_URL: redis://で始まる場合はRedis、未指定の場合はプロセス内の表を使う
+    - AUTH_RATE_LIMIT_MAX_ENTRIES, AUTH_RATE_LIMIT_SHARDS: プロセス内の表の最大件数とシャードの数
+
+    :return: 制限。無効の場合はNone
+    """
+    if not config("AUTH_RATE_LIMIT_ENABLED", default=True, cast=bool):
+        return None
+    url = config("AUTH_RATE_LIMIT_URL", default="")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        backend: RateLimitBackend = RedisTokenBuckets.from_url(url)
+    elif url:
+        raise ValueError(f"Unsupported AUTH_RATE_LIMIT_URL: {url}")
+    else:
+        backend = TokenBucketTable(config("AUTH_RATE_LIMIT_MAX_ENTRIES", default=100000, cast=int),
+                                   config("AUTH_RATE_LIMIT_SHARDS", default=16, cast=int))
+    return AuthRateLimiter(backend, parse_limit(config("AUTH_RATE_LIMIT_IP", default="20/60")),
+                           parse_limit(config("AUTH_RATE_LIMIT_EMAIL", default="5/60")))
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import heapq
+import re
+from collections import Counter
+
+from motor import motor_asyncio
+
+# 検索の対象にするフィールド。MongoDBのテキストインデックスと同じ
+SEARCH_FIELDS = ["title", "description"]
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    文字列を検索語に分割する。テキストインデックス(default_language: none)と同じく、語幹の処理はしない
+
+    :param text: 文字列
+    :return: 小文字にした検索語のリスト
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class InvertedIndex:
+    """
+    所有者ごとの転置インデックス(検索語 -> todoのIDと出現回数)
+    テキストインデックスを使えないプロセス内のストレージ(memory://)の代わりに使う
+    検索のコストはコレクションの件数ではなく、検索語に一致した件数で決まる
+    """
+
+    def __init__(self) -> None:
+        """
+        コンストラクタ
+
+        :return: なし
+        """
+        self._postings: dict[str, dict[str, dict[str, int]]] = {}
+        self._terms: dict[str, dict[str, Counter]] = {}
+
+    def add(self, owner: str, todo: dict) -> None:
+        """
+        todoを登録する。既に登録されている場合は置き換える
+
+        :param owner: 所有者
+        :param todo: id, title, descriptionを持つtodo
+        :return: なし
+        """
+        self.remove(owner, todo["id"])
+        terms = Counter(token for field in SEARCH_FIELDS for token in tokenize(todo.get(field) or ""))
+        self._terms.setdefault(owner, {})[todo["id"]] = terms
+        postings = self._postings.setdefault(owner, {})
+        for term, count in terms.items():
+            postings.setdefault(term, {})[todo["id"]] = count
+
+    def remove(self, owner: str, _id: str) -> None:
+        """
+        todoを削除する
+
+        :param owner: 所有者
+        :param _id: todoのID
+        :return: なし
+        """
+        terms = self._terms.get(owner, {}).pop(_id, None)
+        if not terms:
+            return
+        postings = self._postings[owner]
+        for term in terms:
+            ids = postings[term]
+            del ids[_id]
+            if not ids:
+                del postings[term]
+
+    def apply(self, owner: str, event: dict) -> None:
+        """
+        todoの変更イベントを反映する
+
+        :param owner: 所有者
+        :param event: created, updated, deletedのイベント
+        :return: なし
+        """
+        if event["type"] == "deleted":
+            self.remove(owner, event["id"])
+        else:
+            self.add(owner, event["todo"])
+
+    def search(self, owner: str, query: str, offset: int, limit: int) -> list[str]:
+        """
+        いずれかの検索語を含むtodoを、検索語の出現回数の合計が多い順(同じ場合はID順)に取得する
+
+        :param owner: 所有者
+        :param query: 検索文字列
+        :param offset: 読み飛ばす件数
+        :param limit: 最大件数
+        :return: todoのIDのリスト
+        """
+        postings = self._postings.get(owner, {})
+        scores: Counter = Counter()
+        for term in set(tokenize(query)):
+            scores.update(postings.get(term, {}))
+        ranked = heapq.nsmallest(offset + limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [_id for _id, _ in ranked[offset:]]
+
+    async def rebuild(self, collection: motor_asyncio.AsyncIOMotorCollection) -> None:
+        """
+        コレクションの全てのtodoからインデックスを作り直す。起動時に呼び出す
+
+        :param collection: todoのコレクション
+        :return: なし
+        """
+        self._postings.clear()
+        self._terms.clear()
+        async for todo in collection.find({}, projection={"owner": 1, **{field: 1 for field in SEARCH_FIELDS}}):
+            self.add(todo["owner"], {**todo, "id": str(todo["_id"])})
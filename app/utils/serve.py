@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import os
+import warnings
+from typing import Any, ClassVar
+
+from decouple import config
+from fastapi import FastAPI
+from gunicorn.app.base import BaseApplication
+from utils.password_cost import resolve_rounds
+
+with warnings.catch_warnings():
+    # uvicorn.workersはuvicorn-workerパッケージへの移行を促す警告を出すが、固定しているバージョンでは使える
+    warnings.simplefilter("ignore", DeprecationWarning)
+    from uvicorn.workers import UvicornWorker
+
+# 全てのワーカーで合計したMongoDBの接続プールの最大接続数
+MONGO_CONNECTION_BUDGET = config("MONGO_CONNECTION_BUDGET", default=100, cast=int)
+# ワーカーを再起動するまでに処理するリクエスト数(0の場合は再起動しない)と、再起動が重ならないように加えるばらつき
+SERVE_MAX_REQUESTS = config("SERVE_MAX_REQUESTS", default=10000, cast=int)
+SERVE_MAX_REQUESTS_JITTER = config("SERVE_MAX_REQUESTS_JITTER", default=SERVE_MAX_REQUESTS // 10, cast=int)
+# X-Forwarded-ForとX-Forwarded-Protoを信頼する接続元(カンマ区切り、*は全て)
+# 既定ではプロキシの後ろで動かす前提で全て信頼する。信頼しないとクライアントのIPアドレスが全てプロキシのものになり、
+# ログインのIPアドレスごとの制限が全員で1つになる。
+# クライアントが直接接続できる場合は、X-Forwarded-Forを偽装されないようにプロキシのアドレスだけにする
+FORWARDED_ALLOW_IPS = config("FORWARDED_ALLOW_IPS", default="*")
+# SIGTERMを受け取ってから処理中のリクエストの完了を待つ最大時間(秒)
+SERVE_GRACEFUL_TIMEOUT = config("SERVE_GRACEFUL_TIMEOUT", default=30, cast=int)
+# ワーカーを強制終了する前に、残ったリクエスト(イベントストリームなど)をキャンセルしてlifespanを終了させる猶予(秒)
+SHUTDOWN_MARGIN_SECONDS = 5
+
+
+def cpu_count() -> int:
+    """
+    プロセスが使えるCPUの数を取得する。コンテナなどでCPUが制限されている場合は、その数になる
+
+    :return: CPUの数
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def worker_count() -> int:
+    """
+    ワーカープロセスの数を取得する(WEB_CONCURRENCY)
+    非同期のワーカーは1つで1コアを使い切れるので、既定ではCPUの数と同じにする
+
+    :return: ワーカーの数
+    """
+    return max(1, config("WEB_CONCURRENCY", default=cpu_count(), cast=int))
+
+
+def worker_environment(workers: int) -> dict[str, str]:
+    """
+    ワーカーに引き継ぐ環境変数を作成する
+    - WEB_CONCURRENCY: ワーカーの数。複数のワーカーではプロセス内のtodoのキャッシュを使わない(utils.cache.create_cache)
+    - MONGO_MAX_POOL_SIZE: MONGO_CONNECTION_BUDGETをワーカーの数で割った接続数(監視用の接続は含まない)
+    - MONGO_MIN_POOL_SIZE: 最大接続数を超えないようにする
+    - PASSWORD_HASH_WORKERS: 設定されていない場合は、CPUの数をワーカーの数で割った数にする
+      各ワーカーがCPUの数だけハッシュ計算のスレッドを作ると、コア数を超えて奪い合うため
+    - PASSWORD_HASH_ROUNDS: autoの場合はここで1回だけ計測した値にする。ワーカーごとに計測すると値がずれ、
+      ワーカーによってハッシュの作り直しが必要と判定されるため
+
+    :param workers: ワーカーの数
+    :return: 環境変数
+    """
+    max_pool_size = max(1, MONGO_CONNECTION_BUDGET // workers)
+    min_pool_size = min(config("MONGO_MIN_POOL_SIZE", default=0, cast=int), max_pool_size)
+    hash_workers = config("PASSWORD_HASH_WORKERS", default=max(1, cpu_count() // workers), cast=int)
+    environment = {
+        "WEB_CONCURRENCY": str(workers),
+        "MONGO_MAX_POOL_SIZE": str(max_pool_size),
+        "MONGO_MIN_POOL_SIZE": str(min_pool_size),
+        "PASSWORD_HASH_WORKERS": str(hash_workers),
+    }
+    if config("PASSWORD_HASH_ROUNDS", default="") == "auto":
+        environment["PASSWORD_HASH_ROUNDS"] = str(resolve_rounds("auto"))
+    return environment
+
+
+class TunedUvicornWorker(UvicornWorker):
+    """
+    終了時に処理中のリクエストを待つuvicornのワーカー
+    イベントループとHTTPパーサーはUvicornWorkerの既定(auto)のまま、インストールされていればuvloopとhttptoolsを使う
+    """
+
+    CONFIG_KWARGS: ClassVar[dict[str, Any]] = {**UvicornWorker.CONFIG_KWARGS, "lifespan": "on"}
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        """
+        コンストラクタ
+        SIGTERMを受け取ると、新しい接続の受け付けを止めて処理中のリクエストの完了を待つ
+        gunicornが強制終了する前に残ったリクエストをキャンセルし、lifespanの終了処理(接続プールを閉じるなど)を実行する
+
+        :return: なし
+        """
+        super().__init__(*args, **kwargs)
+        self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - SHUTDOWN_MARGIN_SECONDS)
+
+
+def gunicorn_options(workers: int) -> dict[str, Any]:
+    """
+    gunicornの設定を作成する
+    - bind: HOSTとPORT(既定は0.0.0.0:8000)
+    - max_requests: 処理したリクエスト数でワーカーを再起動し、メモリの増加を抑える
+    - graceful_timeout: SIGTERMを受け取ってから処理中のリクエストを待つ時間
+    - forwarded_allow_ips: X-Forwarded-Forからクライアントのアドレスを取得するプロキシ
+    アプリはワーカーごとにフォーク後に読み込む(MongoDBクライアントはフォークをまたいで共有できないため)
+
+    :param workers: ワーカーの数
+    :return: gunicornの設定
+    """
+    options = {
+        "bind": f"{config('HOST', default='0.0.0.0')}:{config('PORT', default=8000, cast=int)}",
+        "workers": workers,
+        "worker_class": TunedUvicornWorker,
+        "max_requests": SERVE_MAX_REQUESTS,
+        "max_requests_jitter": SERVE_MAX_REQUESTS_JITTER,
+        "graceful_timeout": SERVE_GRACEFUL_TIMEOUT,
+        "keepalive": config("SERVE_KEEPALIVE", default=5, cast=int),
+        "forwarded_allow_ips": FORWARDED_ALLOW_IPS,
+        "preload_app": False,
+        "accesslog": "-",
+    }
+    # ワーカーのハートビートのファイルを、ディスクへの書き込みで止まらないメモリ上に置く
+    if os.path.isdir("/dev/shm"):
+        options["worker_tmp_dir"] = "/dev/shm"
+    return options
+
+
+class ServeApplication(BaseApplication):
+    """
+    設定をコードで渡すgunicornのアプリケーション
+    """
+
+    def __init__(self, options: dict[str, Any]) -> None:
+        """
+        コンストラクタ
+
+        :param options: gunicornの設定
+        :return: なし
+        """
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        """
+        gunicornの設定を反映する
+
+        :return: なし
+        """
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self) -> FastAPI:
+        """
+        アプリを読み込む。ワーカーのプロセスで呼ばれる
+
+        :return: FastAPIインスタンス
+        """
+        from main import app
+
+        return app
+
+
+def main() -> None:
+    """
+    本番用にgunicornとuvicornのワーカーでアプリを起動する
+    ワーカーの数、接続プールの大きさ、イベントループを環境とCPUの数から決める
+
+    :return: なし
+    """
+    workers = worker_count()
+    # ワーカーはフォーク後にアプリを読み込むので、環境変数で設定を引き継ぐ
+    os.environ.update(worker_environment(workers))
+    ServeApplication(gunicorn_options(workers)).run()
+
+
+if __name__ == "__main__":
+    main()
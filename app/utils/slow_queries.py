@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import logging
+import random
+from contextvars import ContextVar
+from typing import Any, Callable, TypeVar
+
+from decouple import config
+from motor import motor_asyncio
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+# この時間(ミリ秒)以上かかったコマンドを遅いクエリとしてログに出力する
+SLOW_QUERY_MS = config("MONGO_SLOW_QUERY_MS", default=100, cast=float)
+# 遅いクエリのうちexplainで実行計画を取得する割合(0〜1)
+SLOW_QUERY_EXPLAIN_RATE = config("MONGO_SLOW_QUERY_EXPLAIN_RATE", default=0.1, cast=float)
+# 同時に実行するexplainの最大数。遅いクエリが続いてもexplainでDBの負荷を増やさないようにする
+MAX_PENDING_EXPLAINS = 4
+# explainで実行計画を取得できるコマンド
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# explainに渡す際に取り除く、セッションや読み書きの設定のフィールド
+SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+
+# クエリを発行したルート(例: GET /api/todos/{_id}。遅いクエリのログに出力するときにstr()で文字列にする)と、
+# サービスのメソッド(例: TodoService.get_single)
+query_route: ContextVar[object] = ContextVar("query_route", default="")
+query_operation: ContextVar[str] = ContextVar("query_operation", default="")
+
+logger = logging.getLogger(__name__)
+
+ServiceClass = TypeVar("ServiceClass", bound=type)
+
+
+def trace_queries(cls: ServiceClass) -> ServiceClass:
+    """
+    サービスの公開の非同期メソッドを、実行中にquery_operationを設定するようにするクラスデコレーター
+    Motorはコンテキスト変数を引き継いでpymongoを実行するので、遅いクエリのログにメソッド名を出力できる
+
+    :param cls: サービスのクラス
+    :return: 同じクラス
+    """
+    for name, method in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(method):
+            setattr(cls, name, _traced(f"{cls.__name__}.{name}", method))
+    return cls
+
+
+def _traced(operation: str, method: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    メソッドの実行中にquery_operationを設定する
+
+    :param operation: メソッド名
+    :param method: 非同期メソッド
+    :return: ラップしたメソッド
+    """
+
+    @functools.wraps(method)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = query_operation.set(operation)
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            query_operation.reset(token)
+
+    return wrapper
+
+
+def _find_key(document: Any, key: str) -> Any:
+    """
+    explainの結果から最初に見つかったキーの値を取得する
+    find以外(aggregateなど)ではqueryPlannerやexecutionStatsが入れ子になるため
+
+    :param document: explainの結果(またはその一部)
+    :param key: キー
+    :return: 値。見つからない場合はNone
+    """
+    if isinstance(document, dict):
+        if key in document:
+            return document[key]
+        values = document.values()
+    elif isinstance(document, list):
+        values = document
+    else:
+        return None
+    for value in values:
+        found = _find_key(value, key)
+        if found is not None:
+            return found
+    return None
+
+
+def summarize_plan(plan: dict | None) -> str:
+    """
+    実行計画のステージを外側から順に並べた文字列にする(例: FETCH > IXSCAN(owner_id))
+
+    :param plan: winningPlan
+    :return: 実行計画の要約
+    """
+    stages = []
+    while isinstance(plan, dict):
+        # Slot Based Engineの場合はqueryPlanの中に実行計画がある
+        plan = plan.get("queryPlan", plan)
+        stage = plan.get("stage", "?")
+        stages.append(f"{stage}({plan['indexName']})" if "indexName" in plan else stage)
+        inputs = plan.get("inputStages") or [plan.get("inputStage")]
+        plan = inputs[0]
+    return " > ".join(stages) or "unknown"
+
+
+def explain_command(command: dict) -> dict:
+    """
+    モニタリングで受け取ったコマンドからexplainのコマンドを作成する
+
+    :param command: コマンド
+    :return: explainのコマンド
+    """
+    target = {key: value for key, value in command.items() if not key.startswith("$") and key not in SESSION_FIELDS}
+    return {"explain": target, "verbosity": "executionStats"}
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    しきい値以上かかったMongoDBのコマンドを、発行したルートとサービスのメソッドと共にログに出力する
+    一部のコマンドはexplainを非同期に実行し、採用された実行計画と調べたキー・ドキュメント数も出力する
+    DBのプロファイラーを有効にしなくても、インデックスが無いクエリを見つけられる
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS, explain_rate: float = SLOW_QUERY_EXPLAIN_RATE) -> None:
+        """
+        コンストラクタ
+
+        :param threshold_ms: 遅いクエリとするしきい値(ミリ秒)
+        :param explain_rate: explainを実行する割合
+        :return: なし
+        """
+        self.threshold_micros = threshold_ms * 1000
+        self.explain_rate = explain_rate
+        self._started: dict[tuple, tuple[str, str, str, dict | None]] = {}
+        self._client: motor_asyncio.AsyncIOMotorClient | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    def bind(self, client: motor_asyncio.AsyncIOMotorClient) -> None:
+        """
+        explainを実行するクライアントとイベントループを設定する。lifespanで呼び出す
+        設定していない場合は、遅いクエリのログだけを出力する
+
+        :param client: MongoDBクライアント
+        :return: なし
+        """
+        self._client = client
+        self._loop = asyncio.get_running_loop()
+
+    async def close(self) -> None:
+        """
+        実行中のexplainをキャンセルし、クライアントの設定を解除する
+
+        :return: なし
+        """
+        self._client = None
+        self._loop = None
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        """
+        コマンドを発行したルートとメソッドを記録する。pymongoを実行するスレッドで呼ばれる
+
+        :param event: イベント
+        :return: なし
+        """
+        if event.command_name == "explain":
+            return
+        collection = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        command = event.command if event.command_name in EXPLAINABLE_COMMANDS else None
+        self._started[(event.request_id, event.connection_id)] = (
+            collection if isinstance(collection, str) else "", query_route.get(), query_operation.get(), command
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        """
+        成功したコマンドが遅い場合はログに出力する
+
+        :param event: イベント
+        :return: なし
+        """
+        self._finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        """
+        失敗したコマンドが遅い場合はログに出力する
+
+        :param event: イベント
+        :return: なし
+        """
+        self._finished(event)
+
+    def _finished(self, event: monitoring.CommandSucceededEvent | monitoring.CommandFailedEvent) -> None:
+        """
+        遅いコマンドをログに出力する。一部はexplainを予約し、その結果と共に出力する
+
+        :param event: イベント
+        :return: なし
+        """
+        started = self._started.pop((event.request_id, event.connection_id), None)
+        if started is None or event.duration_micros < self.threshold_micros:
+            return
+        collection, route, operation, command = started
+        route = str(route)
+        message = (f"Slow MongoDB command: {event.command_name} {event.database_name}.{collection} "
+                   f"took {event.duration_micros / 1000:.1f}ms (route={route or '-'}, operation={operation or '-'})")
+        loop = self._loop
+        if (command is None or loop is None or len(self._tasks) >= MAX_PENDING_EXPLAINS
+                or random.random() >= self.explain_rate):
+            logger.warning(message)
+            return
+        loop.call_soon_threadsafe(self._schedule_explain, event.database_name, explain_command(command), message)
+
+    def _schedule_explain(self, database_name: str, command: dict, message: str) -> None:
+        """
+        explainのタスクを作成する。イベントループのスレッドで呼ばれる
+
+        :param database_name: データベース名
+        :param command: explainのコマンド
+        :param message: 遅いクエリのログのメッセージ
+        :return: なし
+        """
+        if self._client is None or len(self._tasks) >= MAX_PENDING_EXPLAINS:
+            logger.warning(message)
+            return
+        task = asyncio.create_task(self._explain(self._client[database_name], command, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _explain(db: motor_asyncio.AsyncIOMotorDatabase, command: dict, message: str) -> None:
+        """
+        explainを実行し、実行計画と共にログに出力する
+
+        :param db: DBインスタンス
+        :param command: explainのコマンド
+        :param message: 遅いクエリのログのメッセージ
+        :return: なし
+        """
+        try:
+            result = await db.command(command)
+        except PyMongoError as e:
+            logger.warning("%s; explain failed: %s", message, e)
+            return
+        stats = _find_key(result, "executionStats") or {}
+        logger.warning("%s; plan=%s keysExamined=%s docsExamined=%s", message,
+                       summarize_plan(_find_key(result, "winningPlan")),
+                       stats.get("totalKeysExamined", "?"), stats.get("totalDocsExamined", "?"))
+
+
+slow_queries = SlowQueryListener()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections.abc import Awaitable
+
+from motor import motor_asyncio
+from utils.auth import load_password_backend, password_pool, resolve_password_rounds
+from utils.indexes import ensure_indexes
+
+logger = logging.getLogger(__name__)
+
+
+async def _timed(timings: dict[str, float], name: str, awaitable: Awaitable) -> None:
+    """
+    処理の完了を待ち、かかった時間を記録する。失敗してもログに出力して続ける
+
+    :param timings: 処理名とかかった時間(秒)の辞書
+    :param name: 処理名
+    :param awaitable: 処理
+    :return: なし
+    """
+    started = time.perf_counter()
+    try:
+        await awaitable
+    except Exception:
+        logger.exception("Warm-up step %s failed", name)
+        return
+    timings[name] = time.perf_counter() - started
+
+
+async def _load_password_backend() -> str:
+    """
+    bcryptのコストを決め(autoの場合は計測する)、ワーカーでそのコストのバックエンドを読み込む
+    以降のハッシュ計算と検証は、全てここで決めたコストを使う
+
+    :return: バックエンドの名前
+    """
+    return await password_pool.run(load_password_backend, await resolve_password_rounds())
+
+
+async def warm_up(db: motor_asyncio.AsyncIOMotorDatabase, ensure: bool = False) -> dict[str, float]:
+    """
+    最初のリクエストが払うはずの初期化をまとめて先に行う。lifespanからバックグラウンドで実行する
+    - MongoDBへの接続を確立する(ensureがTrueの場合は、そのままインデックスを作成する)
+    - bcryptのコストを決め、パスワードハッシュのワーカーを起動してbcryptのバックエンドを読み込む
+
+    :param db: DBインスタンス
+    :param ensure: 定義されたインデックスを作成するかどうか
+    :return: 処理名とかかった時間(秒)の辞書。失敗した処理は含まない
+    """
+    timings: dict[str, float] = {}
+    await asyncio.gather(
+        _timed(timings, "ensure_indexes" if ensure else "mongo", ensure_indexes(db) if ensure else db.command("ping")),
+        _timed(timings, "password_hash", _load_password_backend()),
+    )
+    logger.info("Warm-up finished: %s", {name: round(seconds, 3) for name, seconds in timings.items()})
+    return timings
@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import functools
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Literal
+
+from fastapi import HTTPException
+
+PoolKind = Literal["thread", "process"]
+
+
+class BoundedWorkerPool:
+    """
+    CPU負荷の高い同期処理をイベントループの外で実行するワーカープール
+    - 実行中と待機中の合計がワーカー数+キュー上限を超えた場合は503を返して受け付けない
+    - stats()でキューの深さなどのメトリクスを取得できる
+    """
+
+    def __init__(self, kind: PoolKind = "thread", max_workers: int = 1, max_queue: int = 0) -> None:
+        """
+        コンストラクタ。Executorは最初の実行時に作成する
+
+        :param kind: "thread"(スレッドプール)または"process"(プロセスプール)
+        :param max_workers: ワーカー数
+        :param max_queue: ワーカーの空きを待てるタスクの最大数
+        :return: なし
+        """
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown worker pool kind: {kind}")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: Executor | None = None
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+
+    def _get_executor(self) -> Executor:
+        """
+        Executorを取得する。未作成の場合は作成する
+
+        :return: Executor
+        """
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="worker-pool")
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        関数をワーカーで実行し、結果を待つ
+        プロセスプールの場合、fnと引数はpickle可能である必要がある
+
+        :param fn: 実行する関数
+        :return: 関数の戻り値
+        :raises HTTPException: キューが上限に達している場合(503)
+        """
+        if self._pending >= self.max_workers + self.max_queue:
+            self._rejected += 1
+            raise HTTPException(status_code=503, detail="Server is busy", headers={"Retry-After": "1"})
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), functools.partial(fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+            self._completed += 1
+
+    def stats(self) -> dict[str, int | str]:
+        """
+        プールのメトリクスを取得する
+        - running: 実行中のタスク数
+        - queued: ワーカーの空きを待っているタスク数
+        - rejected: キューが上限に達して拒否したタスク数
+        - completed: 完了したタスク数
+
+        :return: メトリクスの辞書
+        """
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": min(self._pending, self.max_workers),
+            "queued": max(0, self._pending - self.max_workers),
+            "rejected": self._rejected,
+            "completed": self._completed,
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Executorを停止する。再度runを呼んだ場合は新しいExecutorを作成する
+
+        :param wait: 実行中のタスクの完了を待つかどうか
+        :return: なし
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,365 @@
+"""
+アプリ全体(create_app)にHTTPで負荷をかけ、エンドポイントごとのレイテンシとスループットを計測する
+- 既定ではアプリをプロセス内で起動し、httpxのASGITransportで直接リクエストを送る
+  MongoDBはMONGO_API_KEYが未設定の場合、プロセス内のMongoDB互換の実装(memory://)を使う
+  ローカルのmongodで計測する場合はMONGO_API_KEY=mongodb://localhost:27017 を指定する
+- --urlを指定した場合は、起動済みのサーバー(uvicorn main:app など)にリクエストを送る
+- 結果はJSONで出力するので、コミット間で比較できる
+
+実行方法(リポジトリのルートで実行する):
+    PYTHONPATH=app python benchmarks/load_test.py --clients 50 --duration 10 --output result.json
+    PYTHONPATH=app python benchmarks/load_test.py --mix "list=8,get=4,create=1" --duration 30
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from contextlib import AsyncExitStack
+from typing import Any
+from uuid import uuid4
+
+import httpx
+
+DEFAULT_MIX = "login=1,create=2,list=4,get=4,update=2,delete=1"
+ROUTES = {
+    "login": "POST /api/login",
+    "create": "POST /api/todo",
+    "list": "GET /api/todos",
+    "get": "GET /api/todos/{_id}",
+    "update": "PUT /api/todos/{_id}",
+    "delete": "DELETE /api/todos/{_id}",
+}
+PASSWORD = "LoadTest-Password-123!"
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    """
+    "login=1,list=4"の形式のリクエストの割合を解析する
+
+    :param mix: リクエストの割合
+    :return: 操作名と重みの辞書
+    :raises ValueError: 不明な操作や不正な重みが指定された場合
+    """
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.strip().partition("=")
+        if name not in ROUTES:
+            raise ValueError(f"Unknown operation: {name}. Choose from {', '.join(ROUTES)}")
+        weights[name] = int(weight or 1)
+        if weights[name] < 0:
+            raise ValueError(f"Weight must not be negative: {item}")
+    if not any(weights.values()):
+        raise ValueError("At least one operation needs a positive weight")
+    return weights
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """
+    最近接順位法でパーセンタイルを求める
+
+    :param sorted_values: 昇順に並べた値
+    :param percent: パーセント(0から100)
+    :return: パーセンタイル。値が無い場合は0
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class Recorder:
+    """操作ごとのレイテンシとエラーを記録する"""
+
+    def __init__(self) -> None:
+        """
+        コンストラクタ
+
+        :return: なし
+        """
+        self.latencies: dict[str, list[float]] = {name: [] for name in ROUTES}
+        self.errors: dict[str, dict[str, int]] = {name: {} for name in ROUTES}
+        self.recording = False
+
+    async def request(self, name: str, client: httpx.AsyncClient, method: str, url: str,
+                      expected: tuple[int, ...] = (200,), **kwargs: Any) -> httpx.Response | None:
+        """
+        リクエストを送り、レイテンシを記録する
+
+        :param name: 操作名
+        :param client: HTTPクライアント
+        :param method: HTTPメソッド
+        :param url: URL
+        :param expected: 成功とみなすステータスコード
+        :return: レスポンス。通信エラーの場合はNone
+        """
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            response = None
+            error = type(e).__name__
+        else:
+            error = None if response.status_code in expected else str(response.status_code)
+        if self.recording:
+            self.latencies[name].append(time.perf_counter() - started)
+            if error:
+                self.errors[name][error] = self.errors[name].get(error, 0) + 1
+        return response
+
+    def summary(self, elapsed: float) -> dict[str, dict[str, Any]]:
+        """
+        操作ごとの集計結果を作成する
+
+        :param elapsed: 計測時間(秒)
+        :return: 操作名と集計結果の辞書
+        """
+        summary = {}
+        for name, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            values = sorted(latencies)
+            summary[name] = {
+                "route": ROUTES[name],
+                "count": len(values),
+                "errors": sum(self.errors[name].values()),
+                "error_codes": self.errors[name],
+                "rps": round(len(values) / elapsed, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3),
+            }
+        return summary
+
+
+class VirtualUser:
+    """1人のユーザーとして、自分のtodoに対する操作を順番に実行する"""
+
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, rng: random.Random) -> None:
+        """
+        コンストラクタ
+
+        :param client: ユーザー専用のHTTPクライアント(Cookieを保持する)
+        :param recorder: Recorder
+        :param rng: 乱数生成器
+        :return: なし
+        """
+        self.client = client
+        self.recorder = recorder
+        self.rng = rng
+        self.email = f"load-{uuid4().hex}@example.com"
+        self.csrf_headers: dict[str, str] = {}
+        self.todos: dict[str, int] = {}
+
+    async def setup(self, initial_todos: int) -> None:
+        """
+        CSRFトークンを取得し、ユーザー登録とログインを行い、初期のtodoを作成する
+
+        :param initial_todos: 作成するtodoの件数
+        :return: なし
+        """
+        response = await self.client.get("/api/csrf-token")
+        response.raise_for_status()
+        self.csrf_headers = {"X-CSRF-Token": response.json()["csrf_token"]}
+        body = {"email": self.email, "password": PASSWORD}
+        (await self.client.post("/api/register", json=body, headers=self.csrf_headers)).raise_for_status()
+        await self.login()
+        for _ in range(initial_todos):
+            await self.create()
+
+    async def login(self) -> None:
+        """ログインする"""
+        await self.recorder.request("login", self.client, "POST", "/api/login", headers=self.csrf_headers,
+                                    json={"email": self.email, "password": PASSWORD})
+
+    async def create(self) -> None:
+        """todoを作成する"""
+        response = await self.recorder.request(
+            "create", self.client, "POST", "/api/todo", expected=(201,), headers=self.csrf_headers,
+            json={"title": f"Todo {self.rng.randrange(1_000_000)}", "description": "load test"},
+        )
+        if response is not None and response.status_code == 201:
+            todo = response.json()
+            self.todos[todo["id"]] = todo["version"]
+
+    async def list(self) -> None:
+        """todoのリストを取得する"""
+        await self.recorder.request("list", self.client, "GET", "/api/todos")
+
+    async def get(self) -> None:
+        """単一のtodoを取得する"""
+        _id = self.rng.choice(list(self.todos))
+        await self.recorder.request("get", self.client, "GET", f"/api/todos/{_id}")
+
+    async def update(self) -> None:
+        """バージョンを指定してtodoを更新する"""
+        _id = self.rng.choice(list(self.todos))
+        response = await self.recorder.request(
+            "update", self.client, "PUT", f"/api/todos/{_id}",
+            headers={**self.csrf_headers, "If-Match": f'"{self.todos[_id]}"'},
+            json={"title": f"Updated {self.rng.randrange(1_000_000)}", "description": "load test"},
+        )
+        if response is not None and response.status_code == 200:
+            self.todos[_id] = response.json()["version"]
+
+    async def delete(self) -> None:
+        """todoを削除する"""
+        _id = self.rng.choice(list(self.todos))
+        response = await self.recorder.request("delete", self.client, "DELETE", f"/api/todos/{_id}",
+                                               headers=self.csrf_headers)
+        if response is not None and response.status_code == 200:
+            del self.todos[_id]
+
+    async def run(self, weights: dict[str, int], deadline: float) -> None:
+        """
+        期限まで、重みに従って選んだ操作を繰り返す
+        対象のtodoが無い場合は、代わりにtodoを作成する
+
+        :param weights: 操作名と重みの辞書
+        :param deadline: 終了時刻(time.perf_counterの値)
+        :return: なし
+        """
+        names = list(weights)
+        counts = list(weights.values())
+        while time.perf_counter() < deadline:
+            name = self.rng.choices(names, counts)[0]
+            if name in ("get", "update", "delete") and not self.todos:
+                name = "create"
+            await getattr(self, name)()
+
+
+async def run_load(base_url: str, transport: httpx.AsyncBaseTransport | None, clients: int, duration: float,
+                   weights: dict[str, int], initial_todos: int, seed: int) -> dict[str, Any]:
+    """
+    仮想ユーザーを同時に動かして計測する
+
+    :param base_url: ベースURL
+    :param transport: プロセス内で実行する場合のASGITransport
+    :param clients: 同時に動かす仮想ユーザー数
+    :param duration: 計測時間(秒)
+    :param weights: 操作名と重みの辞書
+    :param initial_todos: 仮想ユーザーごとに最初に作成するtodoの件数
+    :param seed: 乱数のシード
+    :return: 操作ごとの集計結果と全体の集計結果
+    """
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with AsyncExitStack() as stack:
+        users = []
+        for index in range(clients):
+            client = await stack.enter_async_context(
+                httpx.AsyncClient(base_url=base_url, transport=transport, limits=limits, timeout=60)
+            )
+            users.append(VirtualUser(client, recorder, random.Random(seed + index)))
+        # 準備(ユーザー登録と初期データの作成)は計測しない
+        await asyncio.gather(*(user.setup(initial_todos) for user in users))
+        recorder.recording = True
+        started = time.perf_counter()
+        await asyncio.gather(*(user.run(weights, started + duration) for user in users))
+        elapsed = time.perf_counter() - started
+    endpoints = recorder.summary(elapsed)
+    total = sum(endpoint["count"] for endpoint in endpoints.values())
+    return {
+        "endpoints": endpoints,
+        "total": {
+            "count": total,
+            "errors": sum(endpoint["errors"] for endpoint in endpoints.values()),
+            "rps": round(total / elapsed, 2),
+            "elapsed_seconds": round(elapsed, 3),
+        },
+    }
+
+
+def git_revision() -> str | None:
+    """
+    計測したコミットを取得する
+
+    :return: コミットのハッシュ。取得できない場合はNone
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main_async(args: argparse.Namespace) -> dict[str, Any]:
+    """
+    引数に従って計測する
+
+    :param args: コマンドライン引数
+    :return: 計測の条件と結果
+    """
+    weights = parse_mix(args.mix)
+    options = (args.clients, args.duration, weights, args.initial_todos, args.seed)
+    if args.url:
+        result = await run_load(args.url, None, *options)
+        backend = "external"
+    else:
+        # アプリの設定は読み込み時に決まるので、mainを読み込む前に環境変数を設定する
+        os.environ.setdefault("MONGO_API_KEY", "memory://")
+        for key in ("CSRF_SECRET_KEY", "JWT_SECRET_KEY"):
+            os.environ.setdefault(key, "load-test-secret")
+        os.environ.setdefault("ENVIRONMENT", "development")
+        # 仮想ユーザーは全員同じアドレスから繰り返しログインするので、ログイン試行回数の制限を無効にする
+        os.environ.setdefault("AUTH_RATE_LIMIT_ENABLED", "false")
+        from main import create_app
+
+        app = create_app()
+        async with app.router.lifespan_context(app):
+            # CookieはSecure属性付きなので、httpsとして送る
+            result = await run_load("https://loadtest.local", httpx.ASGITransport(app=app), *options)
+        backend = "memory" if os.environ["MONGO_API_KEY"].startswith("memory://") else "mongodb"
+    return {
+        "config": {
+            "target": args.url or "in-process",
+            "backend": backend,
+            "clients": args.clients,
+            "duration_seconds": args.duration,
+            "mix": weights,
+            "initial_todos": args.initial_todos,
+            "seed": args.seed,
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "git_revision": git_revision()},
+        **result,
+    }
+
+
+def main() -> None:
+    """
+    負荷試験のCLI
+
+    :return: なし
+    """
+    parser = argparse.ArgumentParser(description="Run an HTTP load test against the todo API")
+    parser.add_argument("--clients", type=int, default=50, help="number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=10, help="measurement time in seconds")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--initial-todos", type=int, default=5, help="todos each user creates before measuring")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--url", help="base URL of a running server. Runs the app in-process when omitted")
+    parser.add_argument("--output", help="write the JSON result to this file instead of stdout")
+    args = parser.parse_args()
+    try:
+        parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    result = json.dumps(asyncio.run(main_async(args)), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(result + "\n")
+    else:
+        sys.stdout.write(result + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+todoのリストのレスポンス作成にかかるCPU時間を、変更前と変更後の方法で比較する
+- before: response_model=list[Todo]による検証・変換と、標準のJSONResponseによる変換(FastAPIの既定の処理)
+- after: サービスの戻り値をそのままFastJSONResponseで変換する
+
+実行方法(リポジトリのルートで実行する):
+    PYTHONPATH=app python benchmarks/serialization.py
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from schemas.todo import Todo
+from services.todo import TODO_DEFAULTS, TODO_FIELDS
+from utils.common import FastJSONResponse, convert_document, orjson
+
+SIZES = [10, 100, 1000, 10000]
+# 1回の計測で処理する合計件数の目安。件数が少ない場合は繰り返して計測する
+ITEMS_PER_MEASUREMENT = 100000
+TODO_LIST_FIELD = create_model_field(name="Response_fetch_todos", type_=list[Todo], mode="serialization")
+
+
+def make_todos(count: int) -> list[dict]:
+    """
+    サービスが返すものと同じ形のtodoのリストを、サービスと同じconvert_documentで作成する
+
+    :param count: 件数
+    :return: todoのリスト
+    """
+    created_at = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    documents = [{"_id": ObjectId(), "title": f"Todo {index}", "description": "買い物に行く" * 4, "version": index % 7,
+                  "created_at": created_at, "updated_at": created_at + timedelta(seconds=index)}
+                 for index in range(count)]
+    return [convert_document(document, TODO_FIELDS, TODO_DEFAULTS) for document in documents]
+
+
+def parse_body(body: bytes) -> list[dict]:
+    """
+    本文を読み込み、日時を比較できるように変換する
+    変更前(pydantic)はZ、変更後はミリ秒と+00:00で表すため、文字列ではなく日時として比べる
+
+    :param body: 本文
+    :return: todoのリスト
+    """
+    todos = json.loads(body)
+    for todo in todos:
+        for field in ("created_at", "updated_at"):
+            if todo.get(field) is not None:
+                todo[field] = datetime.fromisoformat(todo[field])
+    return todos
+
+
+async def before(todos: list[dict]) -> bytes:
+    """
+    FastAPIの既定の処理でレスポンスの本文を作成する
+
+    :param todos: todoのリスト
+    :return: 本文
+    """
+    content = await serialize_response(field=TODO_LIST_FIELD, response_content=todos)
+    return JSONResponse(content).body
+
+
+async def after(todos: list[dict]) -> bytes:
+    """
+    FastJSONResponseでレスポンスの本文を作成する
+
+    :param todos: todoのリスト
+    :return: 本文
+    """
+    return FastJSONResponse(todos).body
+
+
+async def measure(render: Callable[[list[dict]], Awaitable[bytes]], todos: list[dict]) -> float:
+    """
+    1件あたりのCPU時間を計測する
+
+    :param render: 本文を作成する関数
+    :param todos: todoのリスト
+    :return: 1件あたりのCPU時間(マイクロ秒)
+    """
+    repeat = max(1, ITEMS_PER_MEASUREMENT // len(todos))
+    await render(todos)
+    started = time.process_time()
+    for _ in range(repeat):
+        await render(todos)
+    return (time.process_time() - started) / (repeat * len(todos)) * 1_000_000
+
+
+async def run() -> list[dict[str, Any]]:
+    """
+    件数ごとに変更前と変更後を計測する
+
+    :return: 件数ごとの計測結果
+    """
+    results = []
+    for size in SIZES:
+        todos = make_todos(size)
+        # 変更前後で同じJSONになることを確認してから計測する
+        assert parse_body(await before(todos)) == parse_body(await after(todos))
+        before_us = await measure(before, todos)
+        after_us = await measure(after, todos)
+        results.append({"items": size, "before_us_per_item": round(before_us, 3),
+                        "after_us_per_item": round(after_us, 3), "speedup": round(before_us / after_us, 1)})
+    return results
+
+
+def main() -> None:
+    """
+    計測結果を表示する
+
+    :return: なし
+    """
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    print(f"{'items':>6} {'before(us/item)':>16} {'after(us/item)':>15} {'speedup':>8}")
+    for result in asyncio.run(run()):
+        print(f"{result['items']:>6} {result['before_us_per_item']:>16} {result['after_us_per_item']:>15} "
+              f"{result['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
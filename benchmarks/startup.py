@@ -0,0 +1,102 @@
+"""
+アプリのコールドスタートにかかる時間を計測する
+新しいPythonプロセスでmainをインポートし、lifespanを開始して最初のレスポンスを受け取るまでを計る
+- process: プロセスの起動から最初のレスポンスまで(インタープリターの起動を含む)
+- import: mainのインポート
+- first_response: mainのインポート開始から最初のレスポンスまで(lifespanの開始を含む)
+
+実行方法(リポジトリのルートで実行する):
+    PYTHONPATH=app python benchmarks/startup.py --runs 5 --output startup.json
+MONGO_API_KEYが無い場合はプロセス内のMongoDB互換の実装(memory://)を使う
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+APP_DIR = Path(__file__).resolve().parent.parent / "app"
+# 子プロセスで実行する計測のスクリプト。計測に使うhttpxなどは計測の開始前にインポートする
+PROBE = """
+import asyncio
+import json
+import time
+
+from httpx import ASGITransport, AsyncClient
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+
+async def first_response() -> None:
+    async with main.app.router.lifespan_context(main.app):
+        async with AsyncClient(transport=ASGITransport(app=main.app), base_url="https://startup.local") as client:
+            response = await client.get(PATH)
+            response.raise_for_status()
+            print(json.dumps({"import": imported - started, "first_response": time.perf_counter() - started}))
+
+
+asyncio.run(first_response())
+"""
+
+
+def measure_once(path: str) -> dict[str, float]:
+    """
+    新しいプロセスで1回計測する
+
+    :param path: 最初に要求するパス
+    :return: 計測結果(秒)
+    """
+    env = {**os.environ, "PYTHONPATH": str(APP_DIR)}
+    env.setdefault("MONGO_API_KEY", "memory://")
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", PROBE.replace("PATH", repr(path))], cwd=APP_DIR, env=env,
+                               capture_output=True, text=True, check=True)
+    elapsed = time.perf_counter() - started
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {"process": elapsed, **result}
+
+
+def summarize(samples: list[dict[str, float]]) -> dict[str, Any]:
+    """
+    計測結果を項目ごとの中央値・最小値・最大値(ミリ秒)にまとめる
+
+    :param samples: 計測結果のリスト
+    :return: 集計結果
+    """
+    return {name: {"median_ms": round(statistics.median(sample[name] for sample in samples) * 1000, 1),
+                   "min_ms": round(min(sample[name] for sample in samples) * 1000, 1),
+                   "max_ms": round(max(sample[name] for sample in samples) * 1000, 1)}
+            for name in samples[0]}
+
+
+def main() -> None:
+    """
+    計測を繰り返し、結果をJSONで出力する
+
+    :return: なし
+    """
+    parser = argparse.ArgumentParser(description="Measure cold start time of the app")
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh processes to measure")
+    parser.add_argument("--path", default="/api/csrf-token", help="path of the first request")
+    parser.add_argument("--output", help="file to write the JSON result to (default: stdout)")
+    args = parser.parse_args()
+    # 1回目はバイトコードのキャッシュを作成するので計測に含めない
+    measure_once(args.path)
+    result = {"runs": args.runs, "path": args.path,
+              "results": summarize([measure_once(args.path) for _ in range(args.runs)])}
+    text = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[2]
+
+
+def test_load_test_logins_are_not_rate_limited() -> None:
+    """
+    負荷試験をプロセス内で実行しても、繰り返しのログインがログイン試行回数の制限で429にならないことを確認する
+    アプリの設定は読み込み時に決まるので、テストとは別のプロセスで実行する
+    """
+    env = {**os.environ, "MONGO_API_KEY": "memory://", "PASSWORD_HASH_ROUNDS": "4", "PYTHONPATH": str(ROOT / "app")}
+    env.pop("AUTH_RATE_LIMIT_ENABLED", None)
+    completed = subprocess.run(
+        [sys.executable, str(ROOT / "benchmarks" / "load_test.py"), "--clients", "4", "--duration", "1",
+         "--mix", "login=4,list=1", "--initial-todos", "1"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True, timeout=120,
+    )
+
+    result = json.loads(completed.stdout)
+    login = result["endpoints"]["login"]
+    # 1ユーザーあたりの既定の制限(60秒に5回)を超える回数ログインしている
+    assert login["count"] > 4 * 5
+    assert login["error_codes"] == {}
+    assert result["total"]["errors"] == 0
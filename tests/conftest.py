@@ -1,21 +1,36 @@
+from collections.abc import Iterator
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 from httpx import ASGITransport, AsyncClient
-
 from main import app
+from utils.auth import AuthJwtCsrf
+from utils.dependencies import get_todo_service, get_user_service
 
 
 @pytest.fixture
-def mock_user_service(mocker):
+def mock_user_service() -> Iterator[MagicMock]:
     """
     UserService をモックし、authenticate と register メソッドが期待される値を返すように設定するフィクスチャ。
+    get_user_service の依存性をオーバーライドして、ルーターにモックを注入する。
+    """
+    mock_service = MagicMock()
+    mock_service.authenticate = AsyncMock(side_effect=lambda user: AuthJwtCsrf.encode_jwt(user["email"]))
+    mock_service.register = AsyncMock(side_effect=lambda user: {"email": user["email"]})
+    app.dependency_overrides[get_user_service] = lambda: mock_service
+    yield mock_service
+    app.dependency_overrides.pop(get_user_service, None)
+
+
+@pytest.fixture
+def mock_todo_service() -> Iterator[MagicMock]:
+    """
+    TodoService をモックし、get_todo_service の依存性をオーバーライドするフィクスチャ。
     """
     mock_service = MagicMock()
-    mock_service.authenticate = AsyncMock(return_value="jwt_token")
-    mock_service.register = AsyncMock(return_value={"email": "test@example.com"})
-    mocker.patch("services.user.UserService", return_value=mock_service)
-    return mock_service
+    app.dependency_overrides[get_todo_service] = lambda: mock_service
+    yield mock_service
+    app.dependency_overrides.pop(get_todo_service, None)
 
 
 @pytest.fixture
@@ -1,7 +1,14 @@
+import asyncio
+import threading
 from datetime import datetime
+from unittest.mock import MagicMock
 
 import pytest
+from fastapi import HTTPException
 from httpx import AsyncClient
+from main import app
+from utils.rate_limit import AuthRateLimiter, TokenBucketTable
+from utils.worker_pool import BoundedWorkerPool
 
 # @pytest.mark.asyncio
 # async def test_generate_csrf_token(async_client: AsyncClient):
@@ -115,3 +122,70 @@ async def test_get_user_refresh_jwt(async_client: AsyncClient, mock_user_service
     assert response.status_code == 200, "Failed to get user info"
     assert "email" in response.json(), "Email not in response"
     assert response.json()["email"] == "test@example.com", "Email does not match"
+
+
+@pytest.mark.asyncio
+async def test_login_rate_limited_before_hashing(async_client: AsyncClient, mock_user_service: MagicMock) -> None:
+    csrf_token = (await async_client.get("/api/csrf-token")).json()["csrf_token"]
+    headers = {"X-CSRF-Token": csrf_token}
+    user_data = {"email": "test@example.com", "password": "password"}
+    app.state.auth_rate_limiter = AuthRateLimiter(TokenBucketTable(), ip_limit=(10, 0.01), email_limit=(1, 0.01))
+    try:
+        assert (await async_client.post("/api/login", json=user_data, headers=headers)).status_code == 200
+        response = await async_client.post("/api/login", json=user_data, headers=headers)
+        register_response = await async_client.post("/api/register", json=user_data, headers=headers)
+    finally:
+        del app.state.auth_rate_limiter
+
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "100"
+    assert register_response.status_code == 429
+    # 拒否したリクエストではパスワードを検証・ハッシュ化しない
+    assert mock_user_service.authenticate.await_count == 1
+    mock_user_service.register.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_auth_returns_503_when_hash_queue_is_full(async_client: AsyncClient,
+                                                       mock_user_service: MagicMock) -> None:
+    csrf_token = (await async_client.get("/api/csrf-token")).json()["csrf_token"]
+    headers = {"X-CSRF-Token": csrf_token}
+    user_data = {"email": "test@example.com", "password": "password"}
+    # ワーカー1つ・キューなしのプールを実行中のタスクで埋める
+    pool = BoundedWorkerPool("thread", max_workers=1)
+    release = threading.Event()
+    busy = asyncio.create_task(pool.run(release.wait))
+    await asyncio.sleep(0)
+
+    async def hash_in_pool(user: dict) -> str:
+        return await pool.run(str, user["password"])
+
+    mock_user_service.authenticate.side_effect = hash_in_pool
+    mock_user_service.register.side_effect = hash_in_pool
+    try:
+        login_response = await async_client.post("/api/login", json=user_data, headers=headers)
+        register_response = await async_client.post("/api/register", json=user_data, headers=headers)
+    finally:
+        release.set()
+        await busy
+        pool.shutdown()
+
+    for response in (login_response, register_response):
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+    assert pool.stats()["rejected"] == 2
+
+
+@pytest.mark.asyncio
+async def test_auth_failures_keep_returning_message(async_client: AsyncClient, mock_user_service: MagicMock) -> None:
+    csrf_token = (await async_client.get("/api/csrf-token")).json()["csrf_token"]
+    headers = {"X-CSRF-Token": csrf_token}
+    user_data = {"email": "test@example.com", "password": "password"}
+    mock_user_service.authenticate.side_effect = HTTPException(status_code=400, detail="Invalid email or password")
+
+    response = await async_client.post("/api/login", json=user_data, headers=headers)
+
+    # 429と503以外の失敗は、これまで通り200とメッセージで返す
+    assert response.status_code == 200
+    assert response.json() == {"message": "400: Invalid email or password"}
+    assert "access_token" not in response.cookies
@@ -0,0 +1,350 @@
+import asyncio
+import os
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from fastapi import HTTPException
+from httpx import AsyncClient
+from main import app
+from pydantic import TypeAdapter
+from pytest import MonkeyPatch
+from schemas.todo import Todo
+from utils.auth import AuthJwtCsrf
+from utils.dependencies import get_event_hub
+from utils.events import EventHub, Subscription, deleted_event, format_sse
+
+
+async def login(async_client: AsyncClient) -> dict[str, str]:
+    # CSRFトークンを取得し、ログイン済みのCookieを設定する
+    csrf_response = await async_client.get("/api/csrf-token")
+    token = AuthJwtCsrf.encode_jwt("test@example.com")
+    async_client.cookies.set("access_token", f'"Bearer {token}"', domain="testserver.local", path="/")
+    return {"X-CSRF-Token": csrf_response.json()["csrf_token"]}
+
+
+@pytest.mark.asyncio
+async def test_fetch_todos_with_next_cursor(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_revision = AsyncMock(return_value=1)
+    mock_todo_service.get_todos = AsyncMock(return_value=([{"id": "1", "title": "Test", "description": "Test",
+                                                            "version": 0}], "next"))
+
+    response = await async_client.get("/api/todos?limit=1")
+
+    assert response.status_code == 200
+    # サービスの戻り値はresponse_modelで再検証しないので、スキーマと一致していることをここで確認する
+    assert TypeAdapter(list[Todo]).validate_python(response.json())
+    assert response.json() == [{"id": "1", "title": "Test", "description": "Test", "version": 0}]
+    assert response.headers["X-Next-Cursor"] == "next"
+    # ETagに使ったリビジョンをリストのキャッシュにも使う
+    mock_todo_service.get_todos.assert_awaited_with("test@example.com", 1, None, {}, 1)
+    mock_todo_service.get_revision.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_fetch_single_sets_etag(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_single = AsyncMock(return_value={"id": "1", "title": "Test", "description": "Test",
+                                                           "version": 3})
+
+    response = await async_client.get("/api/todos/1")
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"3"'
+
+
+@pytest.mark.asyncio
+async def test_update_single_with_if_match(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    headers = await login(async_client)
+    mock_todo_service.update = AsyncMock(return_value={"id": "1", "title": "New", "description": "Test",
+                                                       "version": 4})
+
+    response = await async_client.put("/api/todos/1", json={"title": "New", "description": "Test"},
+                                      headers={**headers, "If-Match": '"3"'})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"4"'
+    mock_todo_service.update.assert_awaited_with("test@example.com", "1", {"title": "New", "description": "Test"}, 3)
+
+
+@pytest.mark.asyncio
+async def test_update_single_with_stale_if_match(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    headers = await login(async_client)
+    mock_todo_service.update = AsyncMock(side_effect=HTTPException(status_code=412, detail="modified"))
+
+    response = await async_client.put("/api/todos/1", json={"title": "New", "description": "Test"},
+                                      headers={**headers, "If-Match": '"2"'})
+
+    assert response.status_code == 412
+
+
+@pytest.mark.asyncio
+async def test_delete_single_with_if_match(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    headers = await login(async_client)
+    mock_todo_service.delete = AsyncMock(return_value=True)
+
+    response = await async_client.delete("/api/todos/1", headers={**headers, "If-Match": '"3"'})
+
+    assert response.status_code == 200
+    mock_todo_service.delete.assert_awaited_with("test@example.com", "1", 3)
+
+
+@pytest.mark.asyncio
+async def test_batch(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    headers = await login(async_client)
+    mock_todo_service.bulk = AsyncMock(return_value=[
+        {"index": 0, "op": "create", "status": 201, "id": "1", "version": 1},
+        {"index": 1, "op": "delete", "status": 404, "id": "2", "detail": "Todo(id:2) not found"},
+    ])
+
+    response = await async_client.post("/api/todos:batch", headers=headers, json={"operations": [
+        {"op": "create", "data": {"title": "Test", "description": "Test"}},
+        {"op": "delete", "id": "2"},
+    ]})
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == [201, 404]
+    owner, operations = mock_todo_service.bulk.call_args.args
+    assert owner == "test@example.com"
+    assert operations[0] == {"op": "create", "id": None, "data": {"title": "Test", "description": "Test"},
+                             "version": None}
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_todo_service")
+async def test_batch_with_unknown_operation(async_client: AsyncClient) -> None:
+    headers = await login(async_client)
+
+    response = await async_client.post("/api/todos:batch", headers=headers, json={"operations": [{"op": "upsert"}]})
+
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_todo_service")
+async def test_fetch_todos_without_login(async_client: AsyncClient) -> None:
+    response = await async_client.get("/api/todos")
+
+    assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_fetch_single_does_not_reissue_fresh_token(async_client: AsyncClient,
+                                                         mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_single = AsyncMock(return_value={"id": "1", "title": "Test", "description": "Test"})
+
+    response = await async_client.get("/api/todos/1")
+
+    assert response.status_code == 200
+    assert "set-cookie" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_fetch_todos_not_modified(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_revision = AsyncMock(return_value=1)
+    mock_todo_service.get_todos = AsyncMock(return_value=([], None))
+
+    response = await async_client.get("/api/todos")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    # リビジョンが変わっていなければ、リストを読み取らずに304を返す
+    response = await async_client.get("/api/todos", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert mock_todo_service.get_todos.await_count == 1
+
+    # 書き込みでリビジョンが変わると、新しいリストを返す
+    mock_todo_service.get_revision = AsyncMock(return_value=2)
+    response = await async_client.get("/api/todos", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+    # 実行中の可能性がある書き込みがある間は、ETagを付けずにリストを返す
+    mock_todo_service.get_revision = AsyncMock(return_value=None)
+    response = await async_client.get("/api/todos", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+
+
+@pytest.mark.asyncio
+async def test_fetch_single_not_modified(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_single = AsyncMock(return_value={"id": "1", "title": "Test", "description": "Test",
+                                                           "version": 3})
+
+    response = await async_client.get("/api/todos/1", headers={"If-None-Match": '"3"'})
+    assert response.status_code == 304
+
+    response = await async_client.get("/api/todos/1", headers={"If-None-Match": '"2"'})
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_fetch_changes(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    changes = {"todos": [{"id": "1", "title": "Test", "description": "Test", "version": 2}], "deleted": ["2"],
+               "next_token": "token", "has_more": False}
+    mock_todo_service.get_changes = AsyncMock(return_value=changes)
+    mock_todo_service.get_single = AsyncMock(return_value=False)
+
+    response = await async_client.get("/api/todos/changes", params={"since": "previous", "limit": 10})
+
+    assert response.status_code == 200
+    assert response.json() == changes
+    mock_todo_service.get_changes.assert_awaited_once_with("test@example.com", "previous", 10)
+    mock_todo_service.get_single.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_events(async_client: AsyncClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    await login(async_client)
+    hub = EventHub()
+    app.dependency_overrides[get_event_hub] = lambda: hub
+    monkeypatch.setattr("routers.todo.EVENT_STREAM_SECONDS", 0.2)
+    subscribed = asyncio.Event()
+    subscribe = hub.subscribe
+
+    def subscribe_and_notify(owner: str) -> Subscription:
+        subscription = subscribe(owner)
+        subscribed.set()
+        return subscription
+
+    monkeypatch.setattr(hub, "subscribe", subscribe_and_notify)
+
+    async def publish() -> None:
+        await subscribed.wait()
+        hub.publish("test@example.com", deleted_event("1"))
+        hub.publish("other@example.com", deleted_event("2"))
+
+    try:
+        publisher = asyncio.create_task(publish())
+        response = await async_client.get("/api/todos/events")
+        await publisher
+    finally:
+        app.dependency_overrides.pop(get_event_hub, None)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert format_sse(deleted_event("1")).decode() in response.text
+    assert '"2"' not in response.text
+    assert hub.stats()["subscribers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_create_keeps_status_and_headers(async_client: AsyncClient, mock_todo_service: MagicMock,
+                                               monkeypatch: pytest.MonkeyPatch) -> None:
+    # 有効期限が近いトークンでログインし、JWTが再発行されるようにする
+    monkeypatch.setattr("utils.auth.JWT_LIFETIME_SECONDS", 30)
+    headers = await login(async_client)
+    monkeypatch.undo()
+    mock_todo_service.register = AsyncMock(return_value={"id": "1", "title": "Test", "description": "Test",
+                                                          "version": 1})
+
+    response = await async_client.post("/api/todo", json={"title": "Test", "description": "Test"}, headers=headers)
+
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert response.headers["ETag"] == '"1"'
+    assert "access_token" in response.headers["set-cookie"]
+    assert response.json() == {"id": "1", "title": "Test", "description": "Test", "version": 1}
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(async_client: AsyncClient, mock_todo_service: MagicMock,
+                                monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr("routers.metrics.METRICS_ENABLED", True)
+    await login(async_client)
+    mock_todo_service.get_single = AsyncMock(return_value={"id": "1", "title": "Test", "description": "Test",
+                                                           "version": 0})
+    await async_client.get("/api/todos/1")
+
+    response = await async_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    pid = os.getpid()
+    assert f'http_requests_total{{pid="{pid}",method="GET",route="/api/todos/{{_id}}",status="200"}}' in response.text
+    assert f'password_pool_running{{pid="{pid}",kind=' in response.text
+    assert "# TYPE jwt_cache_hits_total counter" in response.text
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_requires_flag_and_token(async_client: AsyncClient, monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr("routers.metrics.METRICS_ENABLED", False)
+    assert (await async_client.get("/metrics")).status_code == 404
+
+    monkeypatch.setattr("routers.metrics.METRICS_ENABLED", True)
+    monkeypatch.setattr("routers.metrics.METRICS_TOKEN", "secret")
+    response = await async_client.get("/metrics")
+    assert response.status_code == 401
+    assert response.headers["WWW-Authenticate"] == "Bearer"
+    assert (await async_client.get("/metrics", headers={"Authorization": "Bearer wrong"})).status_code == 401
+    assert (await async_client.get("/metrics", headers={"Authorization": "Bearer secret"})).status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_search_todos(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.search_todos = AsyncMock(return_value=([{"id": "1", "title": "milk", "description": "",
+                                                                "version": 1}], "next"))
+
+    response = await async_client.get("/api/todos/search?q=milk&limit=1")
+
+    assert response.status_code == 200
+    assert response.json() == [{"id": "1", "title": "milk", "description": "", "version": 1}]
+    assert response.headers["X-Next-Cursor"] == "next"
+    mock_todo_service.search_todos.assert_awaited_with("test@example.com", "milk", 1, None)
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_todo_service")
+async def test_search_todos_requires_query(async_client: AsyncClient) -> None:
+    await login(async_client)
+
+    response = await async_client.get("/api/todos/search?q=")
+
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_fetch_todos_with_filters(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    await login(async_client)
+    mock_todo_service.get_revision = AsyncMock(return_value=1)
+    mock_todo_service.get_todos = AsyncMock(return_value=([], None))
+
+    response = await async_client.get("/api/todos?sort=-created_at&title_prefix=Buy"
+                                      "&created_after=2024-01-01T00:00:00%2B00:00")
+
+    assert response.status_code == 200
+    filters = mock_todo_service.get_todos.call_args.args[3]
+    assert filters["sort"] == "-created_at"
+    assert filters["title_prefix"] == "Buy"
+    assert filters["created_after"].isoformat() == "2024-01-01T00:00:00+00:00"
+    assert "created_before" not in filters
+
+
+@pytest.mark.asyncio
+@pytest.mark.usefixtures("mock_todo_service")
+async def test_fetch_todos_with_unknown_sort(async_client: AsyncClient) -> None:
+    await login(async_client)
+
+    response = await async_client.get("/api/todos?sort=description")
+
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_create_requires_csrf_token(async_client: AsyncClient, mock_todo_service: MagicMock) -> None:
+    headers = await login(async_client)
+    mock_todo_service.register = AsyncMock()
+
+    missing = await async_client.post("/api/todo", json={"title": "New", "description": "Test"})
+    wrong = await async_client.post("/api/todo", json={"title": "New", "description": "Test"},
+                                    headers={"X-CSRF-Token": headers["X-CSRF-Token"][::-1]})
+
+    assert missing.status_code == 422
+    assert wrong.status_code == 401
+    mock_todo_service.register.assert_not_awaited()
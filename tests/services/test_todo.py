@@ -1,8 +1,23 @@
+from __future__ import annotations
+
+import time
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta, timezone
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 from bson import ObjectId
-from services.todo import TodoService
+from fastapi import HTTPException
+from mongomock_motor import AsyncMongoMockClient
+from motor import motor_asyncio
+from pytest import MonkeyPatch
+from services.todo import CHANGE_PROJECTION, TODO_PROJECTION, TOMBSTONE_RETENTION_SECONDS, TodoService
+from utils.cache import LRUTTLCache
+from utils.common import decode_cursor, encode_cursor
+from utils.events import EventHub, deleted_event, todo_event
+from utils.search import InvertedIndex
+
+OWNER = "test@example.com"
 
 
 @pytest.fixture
@@ -13,6 +28,9 @@ def mock_db() -> MagicMock:
     mock_collection = AsyncMock()
     # コレクションをモックDBに割り当てて返す
     mock_db.todo = mock_collection
+    mock_db.todo_revision = AsyncMock()
+    mock_db.todo_revision.find_one_and_update.return_value = {"_id": OWNER, "seq": 1}
+    mock_db.todo_tombstone = AsyncMock()
     return mock_db
 
 
@@ -20,16 +38,19 @@ def mock_db() -> MagicMock:
 async def test_register(mock_db: MagicMock) -> None:
     service = TodoService(mock_db)
 
-    mock_db.todo.insert_one.return_value.inserted_id = ObjectId()
-    mock_db.todo.find_one.return_value = {
-        "_id": ObjectId(), "title": "Test", "description": "Test description"
-    }
+    inserted_id = ObjectId()
+    mock_db.todo.insert_one.return_value.inserted_id = inserted_id
 
     data = {"title": "Test", "description": "Test description"}
-    result = await service.register(data)
+    result = await service.register(OWNER, data)
 
+    assert result["id"] == str(inserted_id)
     assert result["title"] == data["title"]
     assert result["description"] == data["description"]
+    assert result["version"] == 1
+    assert mock_db.todo.insert_one.call_args.args[0]["owner"] == OWNER
+    # 登録後の再取得は行わない
+    mock_db.todo.find_one.assert_not_called()
 
 
 @pytest.mark.asyncio
@@ -48,11 +69,67 @@ async def test_get_todos(mock_db: MagicMock) -> None:
 
     service = TodoService(mock_db)
 
-    result = await service.get_todos()
+    result, next_cursor = await service.get_todos(OWNER)
 
     assert len(result) == 2
     assert result[0]["title"] == "Test 1"
     assert result[1]["title"] == "Test 2"
+    assert next_cursor is None
+
+
+@pytest.mark.asyncio
+async def test_get_todos_with_next_page(mock_db: MagicMock) -> None:
+    mock_collection = MagicMock()
+    ids = [ObjectId() for _ in range(3)]
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = [{"_id": _id, "title": "Test", "description": "Test"} for _id in ids]
+    mock_collection.find.return_value = mock_cursor
+    mock_db.todo = mock_collection
+
+    service = TodoService(mock_db)
+
+    # limit+1件返ってきた場合は、limit件だけ返して次ページカーソルを付ける
+    result, next_cursor = await service.get_todos(OWNER, limit=2)
+
+    assert [todo["id"] for todo in result] == [str(ids[0]), str(ids[1])]
+    assert decode_cursor(next_cursor) == str(ids[1])
+
+    # 次ページは最後に返したIDより後ろを取得する
+    await service.get_todos(OWNER, limit=2, after=next_cursor)
+    query = mock_collection.find.call_args.args[0]
+    assert query == {"owner": OWNER, "_id": {"$gt": ids[1]}}
+    assert mock_collection.find.call_args.kwargs["limit"] == 3
+
+
+@pytest.mark.asyncio
+async def test_get_todos_with_invalid_cursor(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await service.get_todos(OWNER, after="invalid")
+    assert exc_info.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_iter_todos(mock_db: MagicMock) -> None:
+    documents = [
+        {"_id": ObjectId(), "title": "Test 1", "description": "Test description 1"},
+        {"_id": ObjectId(), "title": "Test 2", "description": "Test description 2"}
+    ]
+
+    async def cursor() -> AsyncIterator[dict]:
+        for document in documents:
+            yield document
+
+    mock_collection = MagicMock()
+    mock_collection.find.return_value = cursor()
+    mock_db.todo = mock_collection
+
+    service = TodoService(mock_db)
+
+    result = [todo async for todo in service.iter_todos(OWNER)]
+
+    assert [todo["title"] for todo in result] == ["Test 1", "Test 2"]
 
 
 @pytest.mark.asyncio
@@ -64,8 +141,9 @@ async def test_get_single(mock_db: MagicMock) -> None:
         "_id": _id, "title": "Test", "description": "Test description"
     }
 
-    result = await service.get_single(str(_id))
+    result = await service.get_single(OWNER, str(_id))
 
+    mock_db.todo.find_one.assert_awaited_with({"_id": _id, "owner": OWNER}, projection=CHANGE_PROJECTION)
     assert result["title"] == "Test"
     assert result["description"] == "Test description"
 
@@ -75,30 +153,662 @@ async def test_update(mock_db: MagicMock) -> None:
     service = TodoService(mock_db)
 
     _id = ObjectId()
-    mock_db.todo.find_one.return_value = {
-        "_id": _id, "title": "Test", "description": "Test description"
-    }
-    mock_db.todo.update_one.return_value.modified_count = 1
-    mock_db.todo.find_one.return_value = {
-        "_id": _id, "title": "Updated Test", "description": "Updated description"
+    mock_db.todo.find_one_and_update.return_value = {
+        "_id": _id, "title": "Updated Test", "description": "Updated description", "version": 2
     }
 
-    result = await service.update(str(_id), {"title": "Updated Test", "description": "Updated description"})
+    result = await service.update(OWNER, str(_id), {"title": "Updated Test", "description": "Updated description"})
 
     assert result["title"] == "Updated Test"
     assert result["description"] == "Updated description"
+    assert result["version"] == 2
+    query, update = mock_db.todo.find_one_and_update.call_args.args
+    assert query == {"_id": _id, "owner": OWNER}
+    assert update["$inc"] == {"version": 1}
 
 
 @pytest.mark.asyncio
-async def test_delete(mock_db: MagicMock) -> None:
+async def test_update_with_version(mock_db: MagicMock) -> None:
     service = TodoService(mock_db)
 
     _id = ObjectId()
-    mock_db.todo.find_one.return_value = {
-        "_id": _id, "title": "Test", "description": "Test description"
+    mock_db.todo.find_one_and_update.return_value = {
+        "_id": _id, "title": "Updated Test", "description": "Updated description", "version": 4
     }
-    mock_db.todo.delete_one.return_value.deleted_count = 1
 
-    result = await service.delete(str(_id))
+    await service.update(OWNER, str(_id), {"title": "Updated Test"}, version=3)
+
+    query, _ = mock_db.todo.find_one_and_update.call_args.args
+    assert query == {"_id": _id, "owner": OWNER, "version": 3}
+
+
+@pytest.mark.asyncio
+async def test_update_with_version_mismatch(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    mock_db.todo.find_one_and_update.return_value = None
+    mock_db.todo.count_documents.return_value = 1
+
+    with pytest.raises(HTTPException) as exc_info:
+        await service.update(OWNER, str(ObjectId()), {"title": "Updated Test"}, version=3)
+    assert exc_info.value.status_code == 412
+
+
+@pytest.mark.asyncio
+async def test_update_not_found(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    mock_db.todo.find_one_and_update.return_value = None
+    mock_db.todo.count_documents.return_value = 0
+
+    result = await service.update(OWNER, str(ObjectId()), {"title": "Updated Test"}, version=3)
+
+    assert result is False
+
+
+@pytest.mark.asyncio
+async def test_delete(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    _id = ObjectId()
+    mock_db.todo.find_one_and_delete.return_value = {"_id": _id}
+
+    result = await service.delete(OWNER, str(_id))
 
     assert result is True
+    mock_db.todo.count_documents.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_delete_with_version_mismatch(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    mock_db.todo.find_one_and_delete.return_value = None
+    mock_db.todo.count_documents.return_value = 1
+
+    with pytest.raises(HTTPException) as exc_info:
+        await service.delete(OWNER, str(ObjectId()), version=1)
+    assert exc_info.value.status_code == 412
+
+
+@pytest.mark.asyncio
+async def test_bulk(mock_db: MagicMock) -> None:
+    mock_collection = AsyncMock()
+    updated_id, deleted_id, missing_id, stale_id = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = [{"_id": updated_id, "version": 2}, {"_id": deleted_id, "version": 1},
+                                        {"_id": stale_id, "version": 5}]
+    mock_collection.find = MagicMock(return_value=mock_cursor)
+    mock_collection.bulk_write.return_value.bulk_api_result = {"nInserted": 1, "nMatched": 1, "nRemoved": 1}
+    mock_db.todo = mock_collection
+
+    service = TodoService(mock_db)
+
+    data = {"title": "Test", "description": "Test description"}
+    result = await service.bulk(OWNER, [
+        {"op": "create", "data": data},
+        {"op": "update", "id": str(updated_id), "data": data},
+        {"op": "delete", "id": str(deleted_id), "version": 1},
+        {"op": "delete", "id": str(missing_id)},
+        {"op": "update", "id": str(stale_id), "data": data, "version": 4},
+        {"op": "update", "id": "invalid", "data": data},
+    ])
+
+    assert [r["status"] for r in result] == [201, 200, 200, 404, 412, 400]
+    assert result[0]["version"] == 1
+    assert result[1]["version"] == 3
+    # 事前確認1回とbulk_write1回だけで処理する
+    mock_collection.find.assert_called_once()
+    requests = mock_collection.bulk_write.call_args.args[0]
+    assert len(requests) == 3
+    assert mock_collection.bulk_write.call_args.kwargs["ordered"] is False
+    # シーケンス番号は6件分をまとめて割り当て、削除した分だけトゥームストーンを記録する
+    begin = mock_db.todo_revision.find_one_and_update.call_args.args[1]
+    assert begin[0]["$set"]["seq"] == {"$add": [{"$ifNull": ["$seq", 0]}, 6]}
+    tombstones = mock_db.todo_tombstone.insert_many.call_args.args[0]
+    assert [(tombstone["_id"], tombstone["owner"]) for tombstone in tombstones] == [(deleted_id, OWNER)]
+
+
+@pytest.mark.asyncio
+async def test_bulk_with_concurrent_delete(mock_db: MagicMock) -> None:
+    mock_collection = AsyncMock()
+    _id = ObjectId()
+    before, after = AsyncMock(), AsyncMock()
+    before.to_list.return_value = [{"_id": _id, "version": 1}]
+    after.to_list.return_value = []
+    mock_collection.find = MagicMock(side_effect=[before, after])
+    mock_collection.bulk_write.return_value.bulk_api_result = {"nMatched": 0}
+    mock_db.todo = mock_collection
+
+    service = TodoService(mock_db)
+
+    result = await service.bulk(OWNER, [{"op": "update", "id": str(_id), "data": {"title": "Test"}}])
+
+    assert result[0]["status"] == 404
+
+
+@pytest.mark.asyncio
+async def test_get_single_with_cache(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db, LRUTTLCache())
+
+    _id = ObjectId()
+    mock_db.todo.find_one.return_value = {"_id": _id, "title": "Test", "description": "Test description"}
+
+    first = await service.get_single(OWNER, str(_id))
+    second = await service.get_single(OWNER, str(_id))
+
+    assert first == second
+    mock_db.todo.find_one.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_update_invalidates_cache(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db, LRUTTLCache())
+
+    _id = ObjectId()
+    mock_db.todo.find_one.return_value = {"_id": _id, "title": "Test", "description": "Test description"}
+    mock_db.todo.find_one_and_update.return_value = {"_id": _id, "title": "Updated", "description": "Test"}
+
+    await service.get_single(OWNER, str(_id))
+    await service.update(OWNER, str(_id), {"title": "Updated"})
+    await service.get_single(OWNER, str(_id))
+
+    assert mock_db.todo.find_one.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_single_does_not_cache_value_read_before_write() -> None:
+    service = TodoService(AsyncMongoMockClient()["API_DB"], LRUTTLCache())
+    registered = await service.register(OWNER, {"title": "Old", "description": ""})
+    find_one = service.collection.find_one
+
+    async def find_one_then_update(*args: object, **kwargs: object) -> dict:
+        # 古いドキュメントを読んだ後、キャッシュに保存する前に更新が完了する
+        todo = await find_one(*args, **kwargs)
+        await service.update(OWNER, registered["id"], {"title": "New", "description": ""})
+        return todo
+
+    service.collection.find_one = find_one_then_update
+    assert (await service.get_single(OWNER, registered["id"]))["title"] == "Old"
+    service.collection.find_one = find_one
+
+    assert (await service.get_single(OWNER, registered["id"]))["title"] == "New"
+    assert (await service.get_single(OWNER, registered["id"]))["title"] == "New"
+
+
+@pytest.mark.asyncio
+async def test_get_todos_with_cache(mock_db: MagicMock) -> None:
+    mock_collection = AsyncMock()
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = [{"_id": ObjectId(), "title": "Test", "description": "Test"}]
+    mock_collection.find = MagicMock(return_value=mock_cursor)
+    mock_db.todo = mock_collection
+    mock_db.todo_revision = AsyncMongoMockClient()["API_DB"]["todo_revision"]
+
+    cache = LRUTTLCache()
+    service = TodoService(mock_db, cache)
+
+    await service.get_todos(OWNER)
+    result, _ = await service.get_todos(OWNER)
+    assert result[0]["title"] == "Test"
+    assert mock_collection.find.call_count == 1
+
+    # 他のユーザーの書き込みではキャッシュは無効にならない
+    await service.register("other@example.com", {"title": "Other", "description": "Other"})
+    await service.get_todos(OWNER)
+    assert mock_collection.find.call_count == 1
+
+    # 所有者の書き込みでリストのキャッシュは無効になる
+    await service.register(OWNER, {"title": "New", "description": "New"})
+    await service.get_todos(OWNER)
+    assert mock_collection.find.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_list_cache_follows_revision_across_workers(monkeypatch: MonkeyPatch) -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    # 書き込みの完了を待たずにリビジョンを使えるようにする
+    monkeypatch.setattr("services.todo.WRITE_SETTLE_SECONDS", 0)
+    # ワーカーごとにプロセス内のキャッシュを持ち、DBだけを共有する
+    writer, reader = TodoService(db, LRUTTLCache()), TodoService(db, LRUTTLCache())
+    await writer.register(OWNER, {"title": "First", "description": ""})
+    assert len((await reader.get_todos(OWNER))[0]) == 1
+
+    await writer.register(OWNER, {"title": "Second", "description": ""})
+    revision = await reader.get_revision(OWNER)
+    todos, _ = await reader.get_todos(OWNER, revision=revision)
+    assert [todo["title"] for todo in todos] == ["First", "Second"]
+
+
+@pytest.mark.asyncio
+async def test_get_revision(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    mock_db.todo_revision.find_one.return_value = {"_id": OWNER, "revision": 7}
+    assert await service.get_revision(OWNER) == 7
+
+    mock_db.todo_revision.find_one.return_value = None
+    assert await service.get_revision(OWNER) == 0
+
+    # 実行中の可能性がある書き込みがある間は、リストに反映済みのリビジョンが決まらない
+    recent = [{"first": 8, "at": datetime.now(timezone.utc).replace(tzinfo=None)}]
+    mock_db.todo_revision.find_one.return_value = {"_id": OWNER, "revision": 8, "recent": recent}
+    assert await service.get_revision(OWNER) is None
+
+
+@pytest.mark.asyncio
+async def test_writes_increment_revision_in_one_update(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    _id = ObjectId()
+    mock_db.todo.insert_one.return_value.inserted_id = _id
+    mock_db.todo.find_one_and_update.return_value = {"_id": _id, "title": "Test", "description": "Test"}
+    mock_db.todo.find_one_and_delete.return_value = {"_id": _id}
+
+    await service.register(OWNER, {"title": "Test", "description": "Test"})
+    await service.update(OWNER, str(_id), {"title": "Test"})
+    await service.delete(OWNER, str(_id))
+
+    # 番号の割り当てとリビジョンの更新は、書き込みごとに1回の更新で行う
+    assert mock_db.todo_revision.find_one_and_update.await_count == 3
+    mock_db.todo_revision.update_one.assert_not_awaited()
+    begin = mock_db.todo_revision.find_one_and_update.call_args.args[1]
+    assert begin[0]["$set"]["revision"] == {"$add": [{"$ifNull": ["$revision", 0]}, 1]}
+
+
+@pytest.mark.asyncio
+async def test_writes_assign_seq(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    _id = ObjectId()
+    mock_db.todo_revision.find_one_and_update.return_value = {"_id": OWNER, "seq": 7}
+    mock_db.todo.find_one_and_update.return_value = {"_id": _id, "title": "Test", "description": "Test", "seq": 7}
+    mock_db.todo.find_one_and_delete.return_value = {"_id": _id}
+
+    result = await service.register(OWNER, {"title": "Test", "description": "Test"})
+    assert mock_db.todo.insert_one.call_args.args[0]["seq"] == 7
+    assert "seq" not in result
+
+    await service.update(OWNER, str(_id), {"title": "Test"})
+    assert mock_db.todo.find_one_and_update.call_args.args[1]["$set"]["seq"] == 7
+
+    await service.delete(OWNER, str(_id))
+    tombstone = mock_db.todo_tombstone.insert_many.call_args.args[0][0]
+    assert (tombstone["_id"], tombstone["owner"], tombstone["seq"]) == (_id, OWNER, 7)
+
+
+@pytest.mark.asyncio
+async def test_failed_delete_does_not_record_tombstone(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    mock_db.todo.find_one_and_delete.return_value = None
+
+    assert await service.delete(OWNER, str(ObjectId())) is False
+    mock_db.todo_tombstone.insert_many.assert_not_awaited()
+
+
+def changes_db(mock_db: MagicMock, state: dict, todos: list[dict], tombstones: list[dict]) -> MagicMock:
+    mock_db.todo_revision.find_one.return_value = state
+    todo_cursor = AsyncMock()
+    todo_cursor.to_list.return_value = todos
+    mock_db.todo.find = MagicMock(return_value=todo_cursor)
+    tombstone_cursor = AsyncMock()
+    tombstone_cursor.to_list.return_value = tombstones
+    mock_db.todo_tombstone.find = MagicMock(return_value=tombstone_cursor)
+    return mock_db
+
+
+def sync_token(seq: int, issued_at: int | None = None) -> str:
+    return encode_cursor(f"{seq}.{issued_at or int(time.time())}")
+
+
+@pytest.mark.asyncio
+async def test_get_changes_without_token(mock_db: MagicMock) -> None:
+    service = TodoService(changes_db(mock_db, {"_id": OWNER, "seq": 5}, [], []))
+
+    result = await service.get_changes(OWNER, None)
+
+    assert result["todos"] == []
+    assert result["deleted"] == []
+    assert decode_cursor(result["next_token"]).split(".")[0] == "5"
+    mock_db.todo.find.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_get_changes(mock_db: MagicMock) -> None:
+    updated_id, deleted_id = ObjectId(), ObjectId()
+    deleted_at = datetime.now(timezone.utc)
+    service = TodoService(changes_db(
+        mock_db,
+        {"_id": OWNER, "seq": 5},
+        [{"_id": updated_id, "title": "Test", "description": "Test", "version": 2, "seq": 4}],
+        [{"_id": deleted_id, "seq": 3, "deleted_at": deleted_at}],
+    ))
+
+    result = await service.get_changes(OWNER, sync_token(2))
+
+    assert result["todos"] == [{"id": str(updated_id), "title": "Test", "description": "Test", "version": 2,
+                                "created_at": None, "updated_at": None}]
+    assert result["deleted"] == [str(deleted_id)]
+    assert result["has_more"] is False
+    assert decode_cursor(result["next_token"]).split(".")[0] == "5"
+    query = mock_db.todo.find.call_args.args[0]
+    assert query == {"owner": OWNER, "seq": {"$gt": 2, "$lte": 5}}
+    assert mock_db.todo_tombstone.find.call_args.args[0] == query
+
+
+@pytest.mark.asyncio
+async def test_get_changes_with_more(mock_db: MagicMock) -> None:
+    issued_at = int(time.time()) - 60
+    service = TodoService(changes_db(
+        mock_db,
+        {"_id": OWNER, "seq": 9},
+        [{"_id": ObjectId(), "title": "Test", "description": "Test", "seq": seq} for seq in (3, 5)],
+        [{"_id": ObjectId(), "seq": seq, "deleted_at": datetime.now(timezone.utc)} for seq in (4, 6)],
+    ))
+
+    result = await service.get_changes(OWNER, sync_token(2, issued_at), limit=3)
+
+    assert len(result["todos"]) == 2
+    assert len(result["deleted"]) == 1
+    assert result["has_more"] is True
+    # 続きのトークンは最後に返した変更の番号を指し、元のトークンの発行時刻を引き継ぐ
+    assert decode_cursor(result["next_token"]) == f"5.{issued_at}"
+
+
+@pytest.mark.asyncio
+async def test_get_changes_with_running_write(mock_db: MagicMock) -> None:
+    issued_at = int(time.time()) - 60
+    started_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    state = {"_id": OWNER, "seq": 6, "recent": [{"first": 5, "at": started_at}, {"first": 6, "at": started_at}]}
+    service = TodoService(changes_db(
+        mock_db, state, [{"_id": ObjectId(), "title": "Test", "description": "Test", "seq": 4}], []
+    ))
+
+    result = await service.get_changes(OWNER, sync_token(2, issued_at))
+
+    # 実行中の可能性がある書き込みを取りこぼさないように、最も小さい番号の手前までしかトークンを進めない
+    assert len(result["todos"]) == 1
+    assert mock_db.todo.find.call_args.args[0]["seq"] == {"$gt": 2, "$lte": 4}
+    assert decode_cursor(result["next_token"]) == f"4.{int(started_at.replace(tzinfo=timezone.utc).timestamp())}"
+
+    result = await service.get_changes(OWNER, None)
+    assert decode_cursor(result["next_token"]).split(".")[0] == "4"
+
+
+@pytest.mark.asyncio
+async def test_get_changes_ignores_settled_writes(mock_db: MagicMock) -> None:
+    settled_at = (datetime.now(timezone.utc) - timedelta(minutes=10)).replace(tzinfo=None)
+    running_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    state = {"_id": OWNER, "seq": 8, "recent": [{"first": 3, "at": settled_at}, {"first": 7, "at": running_at}]}
+    service = TodoService(changes_db(mock_db, state, [], []))
+
+    result = await service.get_changes(OWNER, sync_token(2))
+
+    # WRITE_SETTLE_SECONDSより前に始まった書き込みは完了したものとして、実行中の書き込みの手前までトークンを進める
+    assert decode_cursor(result["next_token"]).split(".")[0] == "6"
+    mock_db.todo_revision.update_one.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_begin_write_drops_settled_writes(monkeypatch: MonkeyPatch) -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    service = TodoService(db)
+    await service._begin_write(OWNER)
+    assert await service._begin_write(OWNER, 3) == 4
+    state = await db.todo_revision.find_one({"_id": OWNER})
+    assert [write["first"] for write in state["recent"]] == [1, 2]
+    assert state["revision"] == 2
+
+    # 記録はWRITE_SETTLE_SECONDSを過ぎると次の書き込みで取り除かれるので、書き込みの数に関わらず増え続けない
+    monkeypatch.setattr("services.todo.WRITE_SETTLE_SECONDS", 0)
+    assert await service._begin_write(OWNER) == 5
+    assert [write["first"] for write in (await db.todo_revision.find_one({"_id": OWNER}))["recent"]] == [5]
+
+
+@pytest.mark.asyncio
+async def test_get_changes_advances_after_writes_settle(monkeypatch: MonkeyPatch) -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    service = TodoService(db)
+    first = await service.register(OWNER, {"title": "First", "description": ""})
+    token = (await service.get_changes(OWNER, None))["next_token"]
+    # 登録した書き込みもWRITE_SETTLE_SECONDSの間は実行中の可能性があるものとして扱う
+    assert decode_cursor(token).split(".")[0] == "0"
+
+    for index in range(3):
+        await service.update(OWNER, first["id"], {"title": f"Update {index}", "description": ""})
+        result = await service.get_changes(OWNER, token)
+        assert result["todos"] == []
+        assert decode_cursor(result["next_token"]).split(".")[0] == "0"
+
+    # 書き込みがWRITE_SETTLE_SECONDSを過ぎると、完了したものとして最後の番号までトークンが進む
+    monkeypatch.setattr("services.todo.WRITE_SETTLE_SECONDS", 0)
+    result = await service.get_changes(OWNER, token)
+    assert [todo["title"] for todo in result["todos"]] == ["Update 2"]
+    assert decode_cursor(result["next_token"]).split(".")[0] == "4"
+
+
+@pytest.mark.asyncio
+async def test_get_changes_with_invalid_token(mock_db: MagicMock) -> None:
+    service = TodoService(changes_db(mock_db, {"_id": OWNER, "seq": 5}, [], []))
+
+    for token in ("invalid", encode_cursor("5"), encode_cursor("a.b")):
+        with pytest.raises(HTTPException) as exc_info:
+            await service.get_changes(OWNER, token)
+        assert exc_info.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_changes_with_expired_token(mock_db: MagicMock) -> None:
+    service = TodoService(changes_db(mock_db, {"_id": OWNER, "seq": 5}, [], []))
+
+    with pytest.raises(HTTPException) as exc_info:
+        await service.get_changes(OWNER, sync_token(2, int(time.time()) - TOMBSTONE_RETENTION_SECONDS - 60))
+    assert exc_info.value.status_code == 410
+
+
+@pytest.mark.asyncio
+async def test_writes_publish_events(mock_db: MagicMock) -> None:
+    hub = EventHub()
+    subscription = hub.subscribe(OWNER)
+    service = TodoService(mock_db, events=hub)
+
+    _id = ObjectId()
+    mock_db.todo.insert_one.return_value.inserted_id = _id
+    mock_db.todo.find_one_and_update.return_value = {"_id": _id, "title": "New", "description": "Test", "version": 2}
+    mock_db.todo.find_one_and_delete.return_value = {"_id": _id}
+
+    created = await service.register(OWNER, {"title": "Test", "description": "Test"})
+    assert await subscription.get() == todo_event("created", created)
+    updated = await service.update(OWNER, str(_id), {"title": "New"})
+    assert await subscription.get() == todo_event("updated", updated)
+    await service.delete(OWNER, str(_id))
+    assert await subscription.get() == deleted_event(str(_id))
+
+    # 失敗した書き込みは配信しない
+    mock_db.todo.find_one_and_delete.return_value = None
+    await service.delete(OWNER, str(_id))
+    assert hub.stats()["published"] == 3
+
+
+@pytest.mark.asyncio
+async def test_bulk_publishes_events(mock_db: MagicMock) -> None:
+    hub = EventHub()
+    subscription = hub.subscribe(OWNER)
+    updated_id, deleted_id, missing_id = ObjectId(), ObjectId(), ObjectId()
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = [{"_id": updated_id, "version": 2}, {"_id": deleted_id, "version": 1}]
+    mock_db.todo.find = MagicMock(return_value=mock_cursor)
+    mock_db.todo.bulk_write.return_value.bulk_api_result = {"nInserted": 1, "nMatched": 1, "nRemoved": 1}
+    service = TodoService(mock_db, events=hub)
+
+    data = {"title": "Test", "description": "Test description"}
+    result = await service.bulk(OWNER, [
+        {"op": "create", "data": data},
+        {"op": "update", "id": str(updated_id), "data": data},
+        {"op": "delete", "id": str(deleted_id)},
+        {"op": "delete", "id": str(missing_id)},
+    ])
+
+    created = await subscription.get()
+    now = created["todo"]["created_at"]
+    assert created == todo_event("created", {"id": result[0]["id"], **data, "version": 1, "created_at": now,
+                                             "updated_at": now})
+    assert await subscription.get() == todo_event("updated", {"id": str(updated_id), **data, "version": 3,
+                                                              "updated_at": now})
+    assert await subscription.get() == deleted_event(str(deleted_id))
+    assert hub.stats()["published"] == 3
+
+
+@pytest.mark.asyncio
+async def test_reads_use_projection(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+    assert TODO_PROJECTION == {"_id": 1, "title": 1, "description": 1, "version": 1, "created_at": 1, "updated_at": 1}
+
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = []
+    mock_db.todo.find = MagicMock(return_value=mock_cursor)
+    await service.get_todos(OWNER)
+    assert mock_db.todo.find.call_args.kwargs["projection"] == TODO_PROJECTION
+
+    service.iter_todos(OWNER)
+    assert mock_db.todo.find.call_args.kwargs["projection"] == TODO_PROJECTION
+
+    mock_db.todo.find_one_and_update.return_value = None
+    await service.update(OWNER, str(ObjectId()), {"title": "Test"})
+    assert mock_db.todo.find_one_and_update.call_args.kwargs["projection"] == TODO_PROJECTION
+
+    changes_db(mock_db, {"_id": OWNER, "seq": 1}, [], [])
+    await service.get_changes(OWNER, sync_token(0))
+    assert mock_db.todo.find.call_args.kwargs["projection"] == CHANGE_PROJECTION
+
+
+@pytest.mark.asyncio
+async def test_search_todos_uses_text_index(mock_db: MagicMock) -> None:
+    mock_db.todo = MagicMock()
+    mock_cursor = AsyncMock()
+    mock_cursor.to_list.return_value = [
+        {"_id": ObjectId(), "title": "milk", "description": "milk", "score": 1.5},
+        {"_id": ObjectId(), "title": "milk", "description": "eggs", "score": 1.0},
+    ]
+    mock_db.todo.find.return_value = mock_cursor
+    service = TodoService(mock_db)
+
+    todos, next_cursor = await service.search_todos(OWNER, "milk", 1, encode_cursor("2"))
+
+    assert [todo["description"] for todo in todos] == ["milk"]
+    assert "score" not in todos[0]
+    assert decode_cursor(next_cursor) == "3"
+    kwargs = mock_db.todo.find.call_args.kwargs
+    assert mock_db.todo.find.call_args.args[0] == {"owner": OWNER, "$text": {"$search": "milk"}}
+    assert kwargs["sort"] == [("score", {"$meta": "textScore"}), ("_id", 1)]
+    assert (kwargs["skip"], kwargs["limit"]) == (2, 2)
+
+
+@pytest.mark.asyncio
+async def test_search_todos_with_invalid_cursor(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    with pytest.raises(HTTPException) as e:
+        await service.search_todos(OWNER, "milk", 10, encode_cursor("-1"))
+    assert e.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_search_todos_with_inverted_index() -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    service = TodoService(db, search=InvertedIndex())
+    milk = await service.register(OWNER, {"title": "Buy milk", "description": "milk and eggs"})
+    eggs = await service.register(OWNER, {"title": "Eggs", "description": "a dozen"})
+    other = await service.register(OWNER, {"title": "Coffee", "description": "beans"})
+    await service.update(OWNER, other["id"], {"title": "Coffee", "description": "milk"})
+    await service.delete(OWNER, eggs["id"])
+
+    todos, next_cursor = await service.search_todos(OWNER, "milk eggs", 1)
+    rest, last_cursor = await service.search_todos(OWNER, "milk eggs", 1, next_cursor)
+
+    assert [todo["id"] for todo in todos + rest] == [milk["id"], other["id"]]
+    assert rest[0]["version"] == 2
+    assert last_cursor is None
+    assert await service.search_todos("other@example.com", "milk", 10) == ([], None)
+
+
+async def insert_listed_todos(db: motor_asyncio.AsyncIOMotorDatabase) -> list[ObjectId]:
+    # 日時の記録より前のtodo(created_atなし)と、作成日時が同じtodoを含める
+    ids = [ObjectId() for _ in range(5)]
+    day1, day2, day3 = (datetime(2024, 1, day, tzinfo=timezone.utc) for day in (1, 2, 3))
+    await db.todo.insert_many([
+        {"_id": ids[0], "owner": OWNER, "title": "Legacy", "description": ""},
+        {"_id": ids[1], "owner": OWNER, "title": "Buy milk", "description": "", "created_at": day1},
+        {"_id": ids[2], "owner": OWNER, "title": "Buy eggs", "description": "", "created_at": day2},
+        {"_id": ids[3], "owner": OWNER, "title": "Call", "description": "", "created_at": day2},
+        {"_id": ids[4], "owner": "other@example.com", "title": "Buy", "description": "", "created_at": day3},
+    ])
+    return ids
+
+
+async def fetch_all_pages(service: TodoService, filters: dict) -> list[str]:
+    ids, after = [], None
+    while True:
+        todos, after = await service.get_todos(OWNER, 1, after, filters)
+        ids.extend(todo["id"] for todo in todos)
+        if after is None:
+            return ids
+
+
+@pytest.mark.asyncio
+async def test_get_todos_sorted_with_keyset_pages() -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    ids = [str(_id) for _id in await insert_listed_todos(db)]
+    service = TodoService(db)
+
+    assert await fetch_all_pages(service, {"sort": "created_at"}) == ids[:4]
+    assert await fetch_all_pages(service, {"sort": "-created_at"}) == [ids[3], ids[2], ids[1], ids[0]]
+    assert await fetch_all_pages(service, {"sort": "title"}) == [ids[2], ids[1], ids[3], ids[0]]
+
+
+@pytest.mark.asyncio
+async def test_get_todos_with_filters() -> None:
+    db = AsyncMongoMockClient()["API_DB"]
+    ids = [str(_id) for _id in await insert_listed_todos(db)]
+    service = TodoService(db)
+
+    todos, _ = await service.get_todos(OWNER, 10, None, {"title_prefix": "Buy ", "sort": "-created_at"})
+    assert [todo["id"] for todo in todos] == [ids[2], ids[1]]
+    assert todos[0]["created_at"] == "2024-01-02T00:00:00.000+00:00"
+
+    todos, _ = await service.get_todos(OWNER, 10, None, {
+        "created_after": datetime(2024, 1, 2, tzinfo=timezone.utc),
+        "created_before": datetime(2024, 1, 3, tzinfo=timezone.utc),
+    })
+    assert [todo["id"] for todo in todos] == [ids[2], ids[3]]
+
+
+@pytest.mark.asyncio
+async def test_get_todos_with_invalid_sort_cursor(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    with pytest.raises(HTTPException) as e:
+        await service.get_todos(OWNER, 10, encode_cursor('["x", "bad"]'), {"sort": "created_at"})
+    assert e.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_todos_rejects_sort_without_index(mock_db: MagicMock) -> None:
+    service = TodoService(mock_db)
+
+    with pytest.raises(HTTPException) as e:
+        await service.get_todos(OWNER, 10, None, {"sort": "description"})
+    assert e.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_register_sets_timestamps() -> None:
+    service = TodoService(AsyncMongoMockClient()["API_DB"])
+
+    registered = await service.register(OWNER, {"title": "Test", "description": ""})
+    updated = await service.update(OWNER, registered["id"], {"title": "New", "description": ""})
+
+    assert registered["created_at"] == registered["updated_at"]
+    assert updated["created_at"] == registered["created_at"]
+    assert updated["updated_at"] >= registered["updated_at"]
@@ -3,8 +3,9 @@ from unittest.mock import AsyncMock, MagicMock
 import pytest
 from bson import ObjectId
 from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
 from pytest import MonkeyPatch
-from services.user import UserService
+from services.user import UserService, rehash_tasks
 
 
 @pytest.fixture
@@ -19,22 +20,22 @@ def mock_db() -> MagicMock:
 async def test_register(mock_db: MagicMock) -> None:
     service = UserService(mock_db)
 
-    # 1回目のfind_oneはNone、2回目はユーザー情報を返す
-    mock_db.user.find_one.side_effect = [None, {"_id": ObjectId(), "email": "test@example.com",
-                                                "password": "hashed_password"}]
-    mock_db.user.insert_one.return_value.inserted_id = ObjectId()
+    inserted_id = ObjectId()
+    mock_db.user.insert_one.return_value.inserted_id = inserted_id
 
     data = {"email": "test@example.com", "password": "ValidPassword123!"}
     result = await service.register(data)
 
-    assert result["email"] == data["email"]
+    assert result == {"id": str(inserted_id), "email": data["email"]}
+    # 重複はユニークインデックスで検出するので、事前の検索は行わない
+    mock_db.user.find_one.assert_not_called()
 
 
 @pytest.mark.asyncio
 async def test_register_existing_user(mock_db: MagicMock) -> None:
     service = UserService(mock_db)
 
-    mock_db.user.find_one.return_value = {"_id": ObjectId(), "email": "test@example.com", "password": "hashed_password"}
+    mock_db.user.insert_one.side_effect = DuplicateKeyError("E11000 duplicate key error")
 
     data = {"email": "test@example.com", "password": "ValidPassword123!"}
 
@@ -63,13 +64,47 @@ async def test_authenticate(mock_db: MagicMock, monkeypatch: MonkeyPatch) -> Non
     service = UserService(mock_db)
 
     mock_db.user.find_one.return_value = {"_id": ObjectId(), "email": "test@example.com", "password": "hashed_password"}
-    monkeypatch.setattr("utils.auth.AuthJwtCsrf.verify_password", lambda x, y, z: True)
+    monkeypatch.setattr("utils.auth.AuthJwtCsrf.check_password_async", AsyncMock(return_value=(True, False)))
     monkeypatch.setattr("utils.auth.AuthJwtCsrf.encode_jwt", lambda x, y: "jwt_token")
 
     data = {"email": "test@example.com", "password": "ValidPassword123!"}
     result = await service.authenticate(data)
 
     assert result == "jwt_token"
+    assert not rehash_tasks
+    # 認証に必要なフィールドだけを取得する
+    mock_db.user.find_one.assert_awaited_once_with(
+        {"email": "test@example.com"}, projection={"_id": 0, "email": 1, "password": 1}
+    )
+
+
+@pytest.mark.asyncio
+async def test_authenticate_rehashes_outdated_password(mock_db: MagicMock, monkeypatch: MonkeyPatch) -> None:
+    service = UserService(mock_db)
+
+    mock_db.user.find_one.return_value = {"email": "test@example.com", "password": "old_hash"}
+    mock_db.user.update_one.return_value.modified_count = 1
+    monkeypatch.setattr("utils.auth.AuthJwtCsrf.check_password_async", AsyncMock(return_value=(True, True)))
+    monkeypatch.setattr("utils.auth.AuthJwtCsrf.hash_password_async", AsyncMock(return_value="new_hash"))
+
+    await service.authenticate({"email": "test@example.com", "password": "ValidPassword123!"})
+    # 再ハッシュはログインのレスポンスを待たせずにバックグラウンドで行う
+    assert len(rehash_tasks) == 1
+    assert await next(iter(rehash_tasks)) is True
+
+    # 待っている間にパスワードが変更された場合は上書きしない
+    mock_db.user.update_one.assert_awaited_once_with({"email": "test@example.com", "password": "old_hash"},
+                                                     {"$set": {"password": "new_hash"}})
+
+
+@pytest.mark.asyncio
+async def test_rehash_password_failure_is_logged(mock_db: MagicMock, monkeypatch: MonkeyPatch) -> None:
+    service = UserService(mock_db)
+    monkeypatch.setattr("utils.auth.AuthJwtCsrf.hash_password_async",
+                        AsyncMock(side_effect=HTTPException(status_code=503, detail="Server is busy")))
+
+    assert await service.rehash_password("test@example.com", "ValidPassword123!", "old_hash") is False
+    mock_db.user.update_one.assert_not_awaited()
 
 
 @pytest.mark.asyncio
@@ -1,10 +1,16 @@
+import hmac
+import time
 from datetime import datetime, timedelta, timezone
 
 import jwt
+import pytest
 from decouple import config
 from fastapi import HTTPException
+from fastapi_csrf_protect import CsrfProtect
+from fastapi_csrf_protect.exceptions import MissingTokenError, TokenValidationError
 from pytest_mock import MockFixture
-from utils.auth import AuthJwtCsrf
+from starlette.datastructures import Headers
+from utils.auth import AuthJwtCsrf, VerifiedTokenCache, validate_csrf, verified_tokens
 
 JWT_SECRET_KEY = config("JWT_SECRET_KEY")
 
@@ -97,3 +103,113 @@ def test_clear_jwt_cookie(mocker: MockFixture) -> None:
     response = mocker.Mock()
     AuthJwtCsrf.clear_jwt_cookie(response)
     response.set_cookie.assert_called_with(key="access_token", value="", httponly=True, samesite="none", secure=True)
+
+
+@pytest.mark.asyncio
+async def test_hash_password_async() -> None:
+    hashed: str = await AuthJwtCsrf.hash_password_async("securepassword")
+    assert await AuthJwtCsrf.verify_password_async("securepassword", hashed)
+    assert not await AuthJwtCsrf.verify_password_async("wrongpassword", hashed)
+
+
+def test_decode_jwt_uses_verified_token_cache(mocker: MockFixture) -> None:
+    verified_tokens.clear()
+    token: str = AuthJwtCsrf.encode_jwt("test@example.com")
+    decode = mocker.spy(jwt, "decode")
+
+    assert AuthJwtCsrf.decode_jwt(token) == "test@example.com"
+    assert AuthJwtCsrf.decode_jwt(token) == "test@example.com"
+    assert decode.call_count == 1
+
+
+def test_decode_jwt_does_not_cache_failures(mocker: MockFixture) -> None:
+    verified_tokens.clear()
+    invalid_token: str = jwt.encode({"exp": datetime.now(tz=timezone.utc) + timedelta(minutes=1),
+                                     "sub": "test@example.com"}, "wrong_secret", algorithm="HS256")
+    decode = mocker.spy(jwt, "decode")
+
+    for _ in range(2):
+        with pytest.raises(HTTPException) as exc_info:
+            AuthJwtCsrf.decode_jwt(invalid_token)
+        assert exc_info.value.detail == AuthJwtCsrf.INVALID_TOKEN_ERROR
+    assert decode.call_count == 2
+    assert verified_tokens.stats()["entries"] == 0
+
+
+def test_verified_token_cache_expires_at_exp(mocker: MockFixture) -> None:
+    cache = VerifiedTokenCache(max_entries=10)
+    cache.set("token", "test@example.com", time.time() + 60)
+    assert cache.get("token") == ("test@example.com", pytest.approx(time.time() + 60, abs=1))
+
+    mocker.patch("utils.auth.time.time", return_value=time.time() + 61)
+    assert cache.get("token") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_verified_token_cache_compares_digest_in_constant_time(mocker: MockFixture) -> None:
+    cache = VerifiedTokenCache(max_entries=10)
+    cache.set("token", "test@example.com", time.time() + 60)
+    compare_digest = mocker.spy(hmac, "compare_digest")
+
+    assert cache.get("token") is not None
+    assert compare_digest.call_count == 1
+    assert cache.get("other") is None
+
+
+def test_verified_token_cache_is_bounded() -> None:
+    cache = VerifiedTokenCache(max_entries=2)
+    for token in ("a", "b", "c"):
+        cache.set(token, token, time.time() + 60)
+    assert cache.stats()["entries"] == 2
+    assert cache.get("a") is None
+
+
+def test_encode_jwt_uses_configured_lifetime(mocker: MockFixture) -> None:
+    mocker.patch("utils.auth.JWT_LIFETIME_SECONDS", 3600)
+    token: str = AuthJwtCsrf.encode_jwt("test@example.com")
+    payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=["HS256"])
+    assert payload["exp"] - payload["iat"] == 3600
+
+
+def test_refresh_jwt_reuses_token_outside_refresh_window(mocker: MockFixture) -> None:
+    request = mocker.Mock()
+    request.cookies.get.return_value = "Bearer valid.token.value"
+    mocker.patch("utils.auth.AuthJwtCsrf.decode_jwt_claims", return_value=("test@example.com", time.time() + 240))
+    mocker.patch("utils.auth.JWT_REFRESH_WINDOW_SECONDS", 60)
+    email, new_token = AuthJwtCsrf().refresh_jwt(request)
+    assert email == "test@example.com"
+    assert new_token is None
+
+
+def test_refresh_jwt_reissues_token_inside_refresh_window(mocker: MockFixture) -> None:
+    request = mocker.Mock()
+    request.cookies.get.return_value = "Bearer valid.token.value"
+    mocker.patch("utils.auth.AuthJwtCsrf.decode_jwt_claims", return_value=("test@example.com", time.time() + 30))
+    mocker.patch("utils.auth.JWT_REFRESH_WINDOW_SECONDS", 60)
+    email, new_token = AuthJwtCsrf().refresh_jwt(request)
+    assert email == "test@example.com"
+    assert AuthJwtCsrf.decode_jwt(new_token) == "test@example.com"
+
+
+def test_set_jwt_cookie_without_token(mocker: MockFixture) -> None:
+    response = mocker.Mock()
+    AuthJwtCsrf.set_jwt_cookie(response, None)
+    response.set_cookie.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_validate_csrf(mocker: MockFixture) -> None:
+    csrf_protect = CsrfProtect()
+    token, signed_token = csrf_protect.generate_csrf_tokens()
+    request = mocker.Mock()
+    request.cookies = {"fastapi-csrf-token": signed_token}
+    request.headers = Headers({"X-CSRF-Token": token})
+
+    await validate_csrf(request, csrf_protect)
+
+    request.headers = Headers({"X-CSRF-Token": "other"})
+    with pytest.raises(TokenValidationError):
+        await validate_csrf(request, csrf_protect)
+    request.cookies = {}
+    with pytest.raises(MissingTokenError):
+        await validate_csrf(request, csrf_protect)
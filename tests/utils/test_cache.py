@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import json
+import time
+
+import pytest
+from pytest import MonkeyPatch
+from utils.cache import VERSIONED_SET_SCRIPT, LRUTTLCache, RedisCache, create_cache
+
+
+class LocalRedis:
+    """テスト用のRedis互換クライアント。get/set(px)/delete/acloseと、バージョン付きの保存のスクリプトだけを実装する"""
+
+    def __init__(self) -> None:
+        self.data: dict[str, tuple[float, str]] = {}
+        self.closed = False
+
+    async def get(self, key: str) -> str | None:
+        entry = self.data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: str, px: int) -> None:
+        self.data[key] = (time.monotonic() + px / 1000, value)
+
+    async def delete(self, *keys: str) -> None:
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def eval(self, script: str, numkeys: int, key: str, value: str, version: int, px: int) -> int:
+        assert script == VERSIONED_SET_SCRIPT
+        assert numkeys == 1
+        current = await self.get(key)
+        if current is not None and json.loads(current)[0] > version:
+            return 0
+        await self.set(key, value, px)
+        return 1
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_hit_and_miss() -> None:
+    cache = LRUTTLCache()
+    assert await cache.get("a") is None
+    await cache.set("a", {"id": "1"}, ttl=10)
+    assert await cache.get("a") == {"id": "1"}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_evicts_least_recently_used() -> None:
+    cache = LRUTTLCache(max_entries=2)
+    await cache.set("a", 1, ttl=10)
+    await cache.set("b", 2, ttl=10)
+    await cache.get("a")
+    await cache.set("c", 3, ttl=10)
+
+    assert await cache.get("b") is None
+    assert await cache.get("a") == 1
+    assert await cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_expires_entries(monkeypatch: MonkeyPatch) -> None:
+    cache = LRUTTLCache()
+    now = time.monotonic()
+    monkeypatch.setattr("utils.cache.time.monotonic", lambda: now)
+    await cache.set("a", 1, ttl=10)
+    monkeypatch.setattr("utils.cache.time.monotonic", lambda: now + 11)
+
+    assert await cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_delete() -> None:
+    cache = LRUTTLCache()
+    await cache.set("a", 1, ttl=10)
+    await cache.set("b", 2, ttl=10)
+    await cache.delete("a", "b", "c")
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_lru_cache_set_versioned_keeps_newer_version() -> None:
+    cache = LRUTTLCache()
+    assert await cache.set_versioned("a", 2, None, ttl=10)
+    assert not await cache.set_versioned("a", 1, {"title": "old"}, ttl=10)
+    assert await cache.get("a") == [2, None]
+    assert await cache.set_versioned("a", 2, {"title": "new"}, ttl=10)
+    assert await cache.get("a") == [2, {"title": "new"}]
+
+
+@pytest.mark.asyncio
+async def test_redis_cache() -> None:
+    client = LocalRedis()
+    cache = RedisCache(client, prefix="test:")
+
+    await cache.set("a", [[{"id": "1"}], None], ttl=10)
+    assert "test:a" in client.data
+    assert await cache.get("a") == [[{"id": "1"}], None]
+    await cache.delete("a")
+    assert await cache.get("a") is None
+    assert cache.stats() == {"backend": "redis", "hits": 1, "misses": 1}
+
+    assert await cache.set_versioned("b", 3, None, ttl=10)
+    assert not await cache.set_versioned("b", 2, {"id": "1"}, ttl=10)
+    assert json.loads(client.data["test:b"][1]) == [3, None]
+
+    await cache.close()
+    assert client.closed
+
+
+def test_create_cache(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.delenv("CACHE_URL", raising=False)
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    monkeypatch.setenv("CACHE_MAX_ENTRIES", "5")
+    cache = create_cache()
+    assert isinstance(cache, LRUTTLCache)
+    assert cache.max_entries == 5
+
+    # プロセス内のキャッシュは他のワーカーの書き込みで無効にならないので、複数のワーカーでは使わない
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    assert create_cache() is None
+
+    monkeypatch.setenv("CACHE_ENABLED", "false")
+    assert create_cache() is None
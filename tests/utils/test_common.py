@@ -1,4 +1,16 @@
-from utils.common import convert_document
+import json
+from collections.abc import AsyncIterator
+
+import pytest
+from utils.common import (
+    FastJSONResponse,
+    convert_document,
+    decode_cursor,
+    dump_json,
+    encode_cursor,
+    to_ndjson,
+    to_projection,
+)
 
 
 def test_convert_document_with_valid_fields() -> None:
@@ -20,3 +32,50 @@ def test_convert_document_with_empty_fields() -> None:
     fields = []
     result = convert_document(document, fields)
     assert result == {}
+
+
+def test_encode_and_decode_cursor() -> None:
+    cursor = encode_cursor("507f1f77bcf86cd799439011")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == "507f1f77bcf86cd799439011"
+
+
+def test_decode_cursor_with_invalid_value() -> None:
+    with pytest.raises(ValueError):
+        decode_cursor("%%%")
+
+
+@pytest.mark.asyncio
+async def test_to_ndjson() -> None:
+    async def documents() -> AsyncIterator[dict]:
+        yield {"id": "1", "title": "タイトル"}
+        yield {"id": "2", "title": "Test"}
+
+    lines = [line async for line in to_ndjson(documents())]
+    assert lines == ['{"id":"1","title":"タイトル"}\n'.encode(), b'{"id":"2","title":"Test"}\n']
+
+
+def test_convert_document_with_defaults() -> None:
+    document = {"_id": "507f1f77bcf86cd799439011", "name": "John"}
+    result = convert_document(document, ["_id", "name", "age"], {"age": 0})
+    assert result == {"id": "507f1f77bcf86cd799439011", "name": "John", "age": 0}
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dump_json(monkeypatch: pytest.MonkeyPatch, use_orjson: bool) -> None:
+    if not use_orjson:
+        monkeypatch.setattr("utils.common.orjson", None)
+    value = [{"id": "1", "title": "タイトル", "version": 1, "done": None}]
+    assert dump_json(value) == '[{"id":"1","title":"タイトル","version":1,"done":null}]'.encode()
+
+
+def test_fast_json_response() -> None:
+    response = FastJSONResponse({"id": "1", "title": "Test"}, status_code=201)
+    assert response.status_code == 201
+    assert response.headers["content-type"] == "application/json"
+    assert json.loads(response.body) == {"id": "1", "title": "Test"}
+
+
+def test_to_projection() -> None:
+    assert to_projection(["_id", "title"]) == {"_id": 1, "title": 1}
+    assert to_projection(["email", "password"]) == {"email": 1, "password": 1, "_id": 0}
@@ -0,0 +1,84 @@
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from pytest import MonkeyPatch
+from pytest_mock import MockFixture
+from utils.dependencies import DATABASE_NAME, connect_client, get_database, get_principal, mongo_client_options
+
+
+def test_mongo_client_options_default(monkeypatch: MonkeyPatch) -> None:
+    for key in ("MONGO_MAX_POOL_SIZE", "MONGO_MIN_POOL_SIZE", "MONGO_MAX_IDLE_TIME_MS", "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+                "MONGO_COMPRESSORS"):
+        monkeypatch.delenv(key, raising=False)
+    assert mongo_client_options() == {"maxPoolSize": 100, "minPoolSize": 0}
+
+
+def test_mongo_client_options_from_environment(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "20")
+    monkeypatch.setenv("MONGO_MIN_POOL_SIZE", "2")
+    monkeypatch.setenv("MONGO_MAX_IDLE_TIME_MS", "60000")
+    monkeypatch.setenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "500")
+    monkeypatch.setenv("MONGO_COMPRESSORS", "zstd,zlib")
+    assert mongo_client_options() == {
+        "maxPoolSize": 20,
+        "minPoolSize": 2,
+        "maxIdleTimeMS": 60000,
+        "waitQueueTimeoutMS": 500,
+        "compressors": "zstd,zlib",
+    }
+
+
+def test_get_database_uses_shared_client() -> None:
+    request = MagicMock()
+    mongo_client = MagicMock()
+    request.app.state.mongo_client = mongo_client
+    assert get_database(request) is mongo_client[DATABASE_NAME]
+    mongo_client.__getitem__.assert_called_with(DATABASE_NAME)
+
+
+def test_get_database_without_lifespan() -> None:
+    request = MagicMock()
+    request.app.state.mongo_client = None
+    with pytest.raises(RuntimeError):
+        get_database(request)
+
+
+def test_connect_client_with_memory_backend(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setattr("utils.dependencies.MONGO_API_KEY", "memory://")
+    mongo_client = connect_client()
+    assert isinstance(mongo_client, AsyncMongoMockClient)
+    mongo_client.close()
+
+
+@pytest.mark.asyncio
+async def test_get_principal_authenticates_once_per_request(mocker: MockFixture) -> None:
+    request = MagicMock()
+    request.method = "POST"
+    request.state = SimpleNamespace()
+    validate = mocker.patch("utils.dependencies.validate_csrf", AsyncMock())
+    refresh = mocker.patch("utils.auth.AuthJwtCsrf.refresh_jwt", return_value=("test@example.com", None))
+    csrf_protect = MagicMock()
+
+    principal = await get_principal(request, csrf_protect)
+
+    assert (principal.email, principal.new_token) == ("test@example.com", None)
+    assert request.state.principal is principal
+    assert await get_principal(request, csrf_protect) is principal
+    validate.assert_awaited_once_with(request, csrf_protect)
+    refresh.assert_called_once_with(request)
+
+
+@pytest.mark.asyncio
+async def test_get_principal_skips_csrf_for_safe_methods(mocker: MockFixture) -> None:
+    request = MagicMock()
+    request.method = "GET"
+    request.state = SimpleNamespace()
+    validate = mocker.patch("utils.dependencies.validate_csrf", AsyncMock())
+    mocker.patch("utils.auth.AuthJwtCsrf.refresh_jwt", return_value=("test@example.com", "new"))
+
+    principal = await get_principal(request, MagicMock())
+
+    assert principal.new_token == "new"
+    validate.assert_not_awaited()
@@ -0,0 +1,41 @@
+import pytest
+from fastapi import HTTPException
+from utils.etag import etag_matches, make_etag, make_list_etag, parse_if_match
+
+
+def test_make_etag() -> None:
+    assert make_etag(3) == '"3"'
+
+
+def test_parse_if_match() -> None:
+    assert parse_if_match(make_etag(3)) == 3
+
+
+def test_parse_if_match_without_header() -> None:
+    assert parse_if_match(None) is None
+    assert parse_if_match("*") is None
+
+
+@pytest.mark.parametrize("header", ['W/"3"', "3", '"abc"', '"1", "2"'])
+def test_parse_if_match_with_unmatchable_etag(header: str) -> None:
+    with pytest.raises(HTTPException) as exc_info:
+        parse_if_match(header)
+    assert exc_info.value.status_code == 412
+
+
+def test_make_list_etag() -> None:
+    etag = make_list_etag("test@example.com", 1, 100, None)
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == make_list_etag("test@example.com", 1, 100, None)
+    assert etag != make_list_etag("test@example.com", 2, 100, None)
+    assert etag != make_list_etag("other@example.com", 1, 100, None)
+    assert etag != make_list_etag("test@example.com", 1, 10, None)
+
+
+def test_etag_matches() -> None:
+    assert etag_matches('"1"', '"1"')
+    assert etag_matches('W/"1"', '"1"')
+    assert etag_matches('"0", "1"', '"1"')
+    assert etag_matches("*", '"1"')
+    assert not etag_matches('"2"', '"1"')
+    assert not etag_matches(None, '"1"')
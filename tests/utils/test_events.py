@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+from typing_extensions import Self
+from utils.events import (
+    RESYNC_EVENT,
+    EventHub,
+    Subscription,
+    change_to_event,
+    deleted_event,
+    format_sse,
+    to_sse,
+    todo_event,
+    watch_changes,
+)
+
+OWNER = "test@example.com"
+
+
+def updated(_id: str, title: str) -> dict:
+    return todo_event("updated", {"id": _id, "title": title, "description": "Test", "version": 1})
+
+
+@pytest.mark.asyncio
+async def test_subscription_coalesces_events_for_same_todo() -> None:
+    subscription = Subscription(OWNER, max_events=10)
+
+    subscription.put(updated("1", "first"))
+    subscription.put(updated("2", "other"))
+    subscription.put(updated("1", "second"))
+
+    assert await subscription.get() == updated("2", "other")
+    assert await subscription.get() == updated("1", "second")
+    assert subscription.coalesced == 1
+
+
+@pytest.mark.asyncio
+async def test_subscription_overflow_sends_resync() -> None:
+    subscription = Subscription(OWNER, max_events=2)
+
+    for _id in ("1", "2", "3", "4"):
+        subscription.put(deleted_event(_id))
+
+    # 溜まっていたイベントは捨て、resyncを1件だけ送る
+    assert await subscription.get() == RESYNC_EVENT
+    assert subscription.overflows == 1
+    subscription.put(deleted_event("5"))
+    assert await subscription.get() == deleted_event("5")
+
+
+@pytest.mark.asyncio
+async def test_subscription_waits_for_event() -> None:
+    subscription = Subscription(OWNER)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(subscription.get(), 0.01)
+    asyncio.get_running_loop().call_soon(subscription.put, deleted_event("1"))
+    assert await asyncio.wait_for(subscription.get(), 1) == deleted_event("1")
+
+
+def test_hub_publishes_to_owner_only() -> None:
+    hub = EventHub()
+    mine = hub.subscribe(OWNER)
+    hub.subscribe("other@example.com")
+
+    assert hub.publish(OWNER, deleted_event("1")) == 1
+    assert hub.publish("nobody@example.com", deleted_event("1")) == 0
+
+    hub.unsubscribe(mine)
+    assert hub.publish(OWNER, deleted_event("1")) == 0
+    assert hub.stats() == {"subscribers": 1, "published": 3, "coalesced": 0, "overflows": 0}
+
+
+def test_format_sse() -> None:
+    assert format_sse(deleted_event("1")) == b'event: deleted\ndata: {"type":"deleted","id":"1"}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_to_sse() -> None:
+    hub = EventHub()
+    stream = to_sse(hub, OWNER, max_seconds=1, heartbeat_seconds=0.01)
+
+    assert await stream.__anext__() == b"retry: 1000\n\n"
+    assert hub.stats()["subscribers"] == 1
+    assert await stream.__anext__() == b": keepalive\n\n"
+    hub.publish(OWNER, deleted_event("1"))
+    assert await stream.__anext__() == format_sse(deleted_event("1"))
+
+    # 接続が切れたら購読を解除する
+    await stream.aclose()
+    assert hub.stats()["subscribers"] == 0
+
+
+@pytest.mark.asyncio
+async def test_to_sse_ends_after_max_seconds() -> None:
+    hub = EventHub()
+    chunks = [chunk async for chunk in to_sse(hub, OWNER, max_seconds=0.05, heartbeat_seconds=1)]
+
+    assert chunks == [b"retry: 1000\n\n", b": keepalive\n\n"]
+    assert hub.stats()["subscribers"] == 0
+
+
+def test_change_to_event() -> None:
+    _id = ObjectId()
+    document = {"_id": _id, "owner": OWNER, "title": "Test", "description": "Test", "version": 1, "seq": 3}
+
+    owner, event = change_to_event({"operationType": "insert", "ns": {"coll": "todo"}, "fullDocument": document})
+    assert owner == OWNER
+    assert event == todo_event("created", {"id": str(_id), "title": "Test", "description": "Test", "version": 1,
+                                           "created_at": None, "updated_at": None})
+
+    _, event = change_to_event({"operationType": "update", "ns": {"coll": "todo"}, "fullDocument": document})
+    assert event["type"] == "updated"
+
+    tombstone = {"_id": _id, "owner": OWNER, "seq": 4}
+    assert change_to_event({"operationType": "insert", "ns": {"coll": "todo_tombstone"}, "fullDocument": tombstone}) \
+        == (OWNER, deleted_event(str(_id)))
+
+    # 更新の後に削除されたドキュメントはfullDocumentがNoneになる
+    assert change_to_event({"operationType": "update", "ns": {"coll": "todo"}, "fullDocument": None}) is None
+
+
+class FakeChangeStream:
+    def __init__(self, changes: list[dict], error: Exception | None = None) -> None:
+        self.changes = changes
+        self.error = error
+        self.resume_token = None
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        return None
+
+    def __aiter__(self) -> FakeChangeStream:
+        return self
+
+    async def __anext__(self) -> dict:
+        if self.changes:
+            self.resume_token = {"_data": len(self.changes)}
+            return self.changes.pop(0)
+        if self.error:
+            raise self.error
+        await asyncio.Event().wait()
+        raise StopAsyncIteration
+
+
+@pytest.mark.asyncio
+async def test_watch_changes(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr("utils.events.CHANGE_STREAM_RETRY_SECONDS", 0)
+    hub = EventHub()
+    subscription = hub.subscribe(OWNER)
+    tombstone = {"_id": ObjectId(), "owner": OWNER, "seq": 1}
+    db = MagicMock()
+    db.watch.side_effect = [
+        FakeChangeStream([], OperationFailure("history lost", code=286)),
+        FakeChangeStream([{"operationType": "insert", "ns": {"coll": "todo_tombstone"}, "fullDocument": tombstone}]),
+    ]
+
+    task = asyncio.create_task(watch_changes(db, hub))
+    # 再開できない場合は最新の位置から購読し直し、購読者にはresyncを送る
+    assert await asyncio.wait_for(subscription.get(), 1) == RESYNC_EVENT
+    assert await asyncio.wait_for(subscription.get(), 1) == deleted_event(str(tombstone["_id"]))
+    assert db.watch.call_count == 2
+    assert db.watch.call_args.kwargs["resume_after"] is None
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
@@ -0,0 +1,134 @@
+from typing import get_args
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from schemas.todo import TodoSort
+from services.todo import TOMBSTONE_RETENTION_SECONDS
+from utils.indexes import (
+    INDEXES,
+    CollectionScanError,
+    UnsupportedQueryError,
+    assert_index_used,
+    ensure_indexes,
+    find_collection_scans,
+    find_supporting_index,
+    list_query_shapes,
+)
+
+IXSCAN_PLAN = {
+    "queryPlanner": {
+        "winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "email_unique"}},
+        "rejectedPlans": [{"stage": "COLLSCAN"}],
+    }
+}
+COLLSCAN_PLAN = {
+    "queryPlanner": {
+        "winningPlan": {"queryPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN", "direction": "forward"}}},
+        "rejectedPlans": [],
+    }
+}
+
+
+def test_user_email_index_is_unique() -> None:
+    keys = [(index.document["key"], index.document.get("unique")) for index in INDEXES["user"]]
+    assert ({"email": 1}, True) in keys
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes() -> None:
+    db = MagicMock()
+    db.__getitem__.return_value.create_indexes = AsyncMock(return_value=["email_unique"])
+    db.__getitem__.return_value.index_information = AsyncMock(return_value={})
+
+    result = await ensure_indexes(db)
+
+    assert result["user"] == ["email_unique"]
+    db.__getitem__.return_value.create_indexes.assert_any_await(INDEXES["user"])
+    db.command.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_updates_changed_ttl() -> None:
+    """
+    保持期間を変更した場合は、TTLインデックスを作り直さずにcollModで期間を変更することを確認する
+    """
+    db = MagicMock()
+    db.command = AsyncMock()
+    db.__getitem__.return_value.create_indexes = AsyncMock(return_value=[])
+    db.__getitem__.return_value.index_information = AsyncMock(
+        return_value={"deleted_at_ttl": {"key": [("deleted_at", 1)], "expireAfterSeconds": 60}}
+    )
+
+    await ensure_indexes(db)
+
+    db.command.assert_awaited_once_with({
+        "collMod": "todo_tombstone",
+        "index": {"name": "deleted_at_ttl", "expireAfterSeconds": TOMBSTONE_RETENTION_SECONDS},
+    })
+
+
+def test_find_collection_scans() -> None:
+    assert find_collection_scans(IXSCAN_PLAN) == []
+    assert find_collection_scans(COLLSCAN_PLAN) == [{"stage": "COLLSCAN", "direction": "forward"}]
+
+
+@pytest.mark.asyncio
+async def test_assert_index_used() -> None:
+    collection = MagicMock()
+    collection.find.return_value.explain = AsyncMock(return_value=IXSCAN_PLAN)
+
+    assert await assert_index_used(collection, {"email": "test@example.com"}) == IXSCAN_PLAN
+
+
+@pytest.mark.asyncio
+async def test_assert_index_used_with_collection_scan() -> None:
+    collection = MagicMock()
+    collection.find.return_value.explain = AsyncMock(return_value=COLLSCAN_PLAN)
+
+    with pytest.raises(CollectionScanError):
+        await assert_index_used(collection, {"title": "Test"}, [("title", 1)])
+
+
+def test_tombstones_expire_after_retention() -> None:
+    ttl = [index.document.get("expireAfterSeconds") for index in INDEXES["todo_tombstone"]
+           if index.document["key"] == {"deleted_at": 1}]
+    assert ttl == [TOMBSTONE_RETENTION_SECONDS]
+
+
+@pytest.mark.parametrize("order", get_args(TodoSort))
+def test_every_todo_sort_has_an_index(order: str) -> None:
+    direction = -1 if order.startswith("-") else 1
+    index, _ = find_supporting_index("todo", ["owner"], [(order.lstrip("-"), direction), ("_id", direction)])
+    assert index == f"owner_{order.lstrip('-')}"
+
+
+def test_find_supporting_index_reports_unindexed_ranges() -> None:
+    assert find_supporting_index("todo", ["owner"], [("_id", 1)]) == ("owner_id", [])
+    assert find_supporting_index("todo", ["owner"], [("created_at", -1), ("_id", -1)], ("created_at", "title")) \
+        == ("owner_created_at", ["title"])
+
+
+def test_find_supporting_index_rejects_unindexed_sort() -> None:
+    with pytest.raises(UnsupportedQueryError):
+        find_supporting_index("todo", ["owner"], [("description", 1)])
+    # 向きが揃っていない並べ替えはインデックスを逆向きに使っても処理できない
+    with pytest.raises(UnsupportedQueryError):
+        find_supporting_index("todo", ["owner"], [("created_at", 1), ("_id", -1)])
+
+
+@pytest.mark.asyncio
+async def test_ensure_indexes_for_collections() -> None:
+    db = MagicMock()
+    db.__getitem__.return_value.create_indexes = AsyncMock(return_value=["email_unique"])
+
+    assert await ensure_indexes(db, ["user"]) == {"user": ["email_unique"]}
+    db.__getitem__.assert_called_once_with("user")
+
+
+def test_list_query_shapes_cover_every_list_query() -> None:
+    shapes = [(sorted(query), sort) for _, query, sort in list_query_shapes()]
+    # 並べ替え7通り(無しと全てのTodoSort)と、カーソル、作成日時、タイトルの前方一致の有無の組み合わせ
+    assert len(shapes) == 7 * 2 * 2 * 2
+    assert (["owner", "title"], [("created_at", 1), ("_id", 1)]) in shapes
+    assert (["$or", "created_at", "owner", "title"], [("updated_at", -1), ("_id", -1)]) in shapes
+    assert (["_id", "owner"], [("_id", 1)]) in shapes
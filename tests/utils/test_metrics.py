@@ -0,0 +1,139 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from httpx import ASGITransport, AsyncClient
+from utils.metrics import (
+    UNMATCHED_ROUTE,
+    CommandMetricsListener,
+    Counter,
+    Histogram,
+    MetricsMiddleware,
+    MetricsRegistry,
+    PoolMetricsListener,
+)
+from utils.slow_queries import query_route
+
+# MetricsRegistryは全てのサンプルの先頭にプロセスIDのラベルを付ける
+PID = f'pid="{os.getpid()}"'
+
+
+def test_counter_render_escapes_labels() -> None:
+    counter = Counter("requests_total", "Requests.", ("path",))
+    counter.inc(('a"b\\c',))
+    counter.inc(('a"b\\c',), 2)
+
+    assert counter.render() == '# HELP requests_total Requests.\n# TYPE requests_total counter\n' \
+                               'requests_total{path="a\\"b\\\\c"} 3'
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    histogram = Histogram("latency_seconds", "Latency.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 2.0):
+        histogram.observe(("/",), value)
+
+    lines = histogram.render().splitlines()[2:]
+
+    assert lines == [
+        'latency_seconds_bucket{route="/",le="0.1"} 1',
+        'latency_seconds_bucket{route="/",le="1.0"} 2',
+        'latency_seconds_bucket{route="/",le="+Inf"} 3',
+        'latency_seconds_sum{route="/"} 2.55',
+        'latency_seconds_count{route="/"} 3',
+    ]
+
+
+def test_render_stats_as_gauges_and_counters() -> None:
+    text = MetricsRegistry().render({"pool": {"kind": "thread", "running": 2, "completed": 5}})
+
+    assert "# TYPE pool_running gauge" in text
+    assert f'pool_running{{{PID},kind="thread"}} 2' in text
+    # 起動からの累積の回数はカウンターとして_totalを付けて出力する
+    assert "# TYPE pool_completed_total counter" in text
+    assert f'pool_completed_total{{{PID},kind="thread"}} 5' in text
+    assert text.endswith("\n")
+
+
+def test_registry_labels_samples_with_pid() -> None:
+    registry = MetricsRegistry()
+    registry.http_in_flight.inc(("GET",))
+
+    text = registry.render({"cache": {"entries": 1}})
+
+    assert f'http_requests_in_flight{{{PID},method="GET"}} 1' in text
+    assert f"cache_entries{{{PID}}} 1" in text
+
+
+@pytest.mark.asyncio
+async def test_middleware_labels_route_template() -> None:
+    registry = MetricsRegistry()
+    fastapi = FastAPI()
+
+    @fastapi.get("/items/{item_id}")
+    def read_item(item_id: str) -> dict:
+        return {"id": item_id}
+
+    fastapi.add_middleware(MetricsMiddleware, registry=registry)
+    async with AsyncClient(transport=ASGITransport(app=fastapi), base_url="http://testserver.local") as client:
+        await client.get("/items/1")
+        await client.get("/items/2")
+        await client.post("/items/3")
+        await client.get("/missing")
+
+    text = registry.render()
+    assert f'http_requests_total{{{PID},method="GET",route="/items/{{item_id}}",status="200"}} 2' in text
+    assert f'http_requests_total{{{PID},method="POST",route="/items/{{item_id}}",status="405"}} 1' in text
+    assert f'http_requests_total{{{PID},method="GET",route="{UNMATCHED_ROUTE}",status="404"}} 1' in text
+    assert f'http_request_duration_seconds_count{{{PID},method="GET",route="/items/{{item_id}}"}} 2' in text
+    assert f'http_requests_in_flight{{{PID},method="GET"}} 0' in text
+
+
+@pytest.mark.asyncio
+async def test_middleware_sets_query_route_after_routing() -> None:
+    fastapi = FastAPI()
+
+    @fastapi.get("/items/{item_id}")
+    async def read_item(item_id: str) -> dict:
+        # ミドルウェアはルーティングの前に設定するが、文字列にするときはルーターが一致させたルートになる
+        return {"id": item_id, "route": str(query_route.get())}
+
+    fastapi.add_middleware(MetricsMiddleware, registry=MetricsRegistry())
+    async with AsyncClient(transport=ASGITransport(app=fastapi), base_url="http://testserver.local") as client:
+        response = await client.get("/items/1")
+
+    assert response.json() == {"id": "1", "route": "GET /items/{item_id}"}
+    assert query_route.get() == ""
+
+
+def test_command_listener_records_collection() -> None:
+    registry = MetricsRegistry()
+    listener = CommandMetricsListener(registry)
+    for request_id, name, command in ((1, "find", {"find": "todo"}),
+                                      (2, "getMore", {"getMore": 123, "collection": "todo"})):
+        listener.started(SimpleNamespace(request_id=request_id, connection_id=("db", 27017), command_name=name,
+                                         command=command))
+    listener.succeeded(SimpleNamespace(request_id=1, connection_id=("db", 27017), command_name="find",
+                                       duration_micros=1500))
+    listener.failed(SimpleNamespace(request_id=2, connection_id=("db", 27017), command_name="getMore",
+                                    duration_micros=500))
+
+    text = registry.render()
+    assert f'mongodb_command_duration_seconds_sum{{{PID},command="find",collection="todo"}} 0.0015' in text
+    assert f'mongodb_command_failures_total{{{PID},command="getMore",collection="todo"}} 1' in text
+    assert listener._collections == {}
+
+
+def test_pool_listener_tracks_connections() -> None:
+    registry = MetricsRegistry()
+    listener = PoolMetricsListener(registry)
+    event = SimpleNamespace(address=("db", 27017))
+    listener.connection_created(event)
+    listener.connection_created(event)
+    listener.connection_checked_out(event)
+    listener.connection_checked_in(event)
+    listener.connection_closed(event)
+
+    text = registry.render()
+    assert f'mongodb_pool_connections{{{PID},address="db:27017"}} 1' in text
+    assert f'mongodb_pool_checked_out_connections{{{PID},address="db:27017"}} 0' in text
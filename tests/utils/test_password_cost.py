@@ -0,0 +1,64 @@
+import asyncio
+import threading
+
+import pytest
+from pytest import MonkeyPatch
+from pytest_mock import MockFixture
+from utils import auth
+from utils.password_cost import MAX_ROUNDS, MIN_ROUNDS, calibrate_rounds, resolve_rounds
+
+
+def test_calibrate_rounds_fits_budget() -> None:
+    # rounds=10で20ms: 11で40ms, 12で80ms, 13で160ms, 14で320ms
+    assert calibrate_rounds(250, measure=lambda _rounds: 20.0) == 13
+    assert calibrate_rounds(320, measure=lambda _rounds: 20.0) == 14
+
+
+def test_calibrate_rounds_is_clamped(caplog: pytest.LogCaptureFixture) -> None:
+    assert calibrate_rounds(250, measure=lambda _rounds: 0.01) == MAX_ROUNDS
+    assert calibrate_rounds(50, measure=lambda _rounds: 300.0) == MIN_ROUNDS
+    assert "over the 50ms budget" in caplog.text
+
+
+def test_resolve_rounds(mocker: MockFixture) -> None:
+    assert resolve_rounds("") is None
+    assert resolve_rounds("11") == 11
+    calibrate = mocker.patch("utils.password_cost.calibrate_rounds", return_value=12)
+    assert resolve_rounds("auto", target_ms=100) == 12
+    calibrate.assert_called_once_with(100)
+
+
+def test_configured_rounds_mark_weaker_hashes_for_update() -> None:
+    weak_hash = auth._hash_password("securepassword", 4)
+    stronger_hash = auth._hash_password("securepassword", 5)
+
+    assert stronger_hash.startswith("$2b$05$")
+    # 検証と同じワーカーの呼び出しで、ハッシュを作り直すべきか判定する
+    assert auth._verify_password("securepassword", weak_hash, 5) == (True, True)
+    assert auth._verify_password("securepassword", stronger_hash, 5) == (True, False)
+    assert auth._verify_password("wrongpassword", weak_hash, 5) == (False, False)
+    # 設定より強いハッシュは弱くしない
+    assert auth._verify_password("securepassword", stronger_hash, 4) == (True, False)
+
+
+@pytest.mark.asyncio
+async def test_password_rounds_are_resolved_once_off_the_event_loop(monkeypatch: MonkeyPatch) -> None:
+    calls = []
+
+    def calibrate(value: str) -> int:
+        calls.append((value, threading.get_ident()))
+        return 4
+
+    monkeypatch.setenv("PASSWORD_HASH_ROUNDS", "auto")
+    monkeypatch.setattr(auth, "resolve_rounds", calibrate)
+    auth._resolved_password_rounds.cache_clear()
+    try:
+        assert await asyncio.gather(auth.resolve_password_rounds(), auth.resolve_password_rounds()) == [4, 4]
+        assert await auth.resolve_password_rounds() == 4
+        assert auth.get_password_rounds() == 4
+    finally:
+        auth._resolved_password_rounds.cache_clear()
+
+    assert len(calls) == 1
+    assert calls[0][0] == "auto"
+    assert calls[0][1] != threading.get_ident()
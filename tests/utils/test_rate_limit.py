@@ -0,0 +1,120 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+from pytest import MonkeyPatch
+from utils.rate_limit import (
+    TOKEN_BUCKET_SCRIPT,
+    AuthRateLimiter,
+    RedisTokenBuckets,
+    TokenBucketTable,
+    create_auth_rate_limiter,
+    parse_limit,
+    take_token,
+)
+
+
+class LocalRedis:
+    """テスト用のRedis互換クライアント。トークンバケットのスクリプトだけをtake_tokenで実行する"""
+
+    def __init__(self) -> None:
+        self.buckets: dict[str, tuple[float, float]] = {}
+        self.closed = False
+
+    async def eval(self, script: str, numkeys: int, key: str, capacity: int, rate: float, cost: float) -> bytes:
+        assert script == TOKEN_BUCKET_SCRIPT
+        assert numkeys == 1
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (capacity, now))
+        tokens, retry_after = take_token(tokens, updated_at, now, capacity, rate, cost)
+        self.buckets[key] = (tokens, now)
+        return str(retry_after).encode()
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+def test_take_token_refills_up_to_capacity() -> None:
+    assert take_token(0, 0, 10, capacity=3, rate=1) == (2, 0)
+    assert take_token(0.5, 0, 0, capacity=3, rate=0.5) == (0.5, 1)
+
+
+@pytest.mark.asyncio
+async def test_table_rejects_when_bucket_is_empty(monkeypatch: MonkeyPatch) -> None:
+    table = TokenBucketTable()
+    now = time.monotonic()
+    monkeypatch.setattr("utils.rate_limit.time.monotonic", lambda: now)
+
+    assert [await table.take("ip:1", capacity=2, rate=0.1) for _ in range(3)] == [0, 0, pytest.approx(10)]
+    assert await table.take("ip:2", capacity=2, rate=0.1) == 0
+
+    monkeypatch.setattr("utils.rate_limit.time.monotonic", lambda: now + 10)
+    assert await table.take("ip:1", capacity=2, rate=0.1) == 0
+
+
+@pytest.mark.asyncio
+async def test_table_bounds_each_shard() -> None:
+    table = TokenBucketTable(max_entries=8, shards=4)
+    for i in range(100):
+        await table.take(f"ip:{i}", capacity=1, rate=1)
+
+    stats = table.stats()
+    assert stats["entries"] <= 8
+    assert stats["evictions"] == 100 - stats["entries"]
+
+    await table.close()
+    assert table.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_shares_buckets() -> None:
+    client = LocalRedis()
+    buckets = RedisTokenBuckets(client, prefix="test:")
+
+    assert await buckets.take("email:a", capacity=1, rate=0.5) == 0
+    assert await buckets.take("email:a", capacity=1, rate=0.5) == pytest.approx(2, abs=0.01)
+    assert set(client.buckets) == {"test:email:a"}
+
+    await buckets.close()
+    assert client.closed
+
+
+@pytest.mark.asyncio
+async def test_auth_rate_limiter_checks_ip_then_email() -> None:
+    limiter = AuthRateLimiter(TokenBucketTable(), ip_limit=(2, 0.01), email_limit=(1, 0.01))
+
+    await limiter.check("10.0.0.1", "User@Example.com")
+    with pytest.raises(HTTPException) as e:
+        await limiter.check("10.0.0.2", "user@example.com ")
+    assert e.value.status_code == 429
+    assert e.value.headers == {"Retry-After": "100"}
+
+    await limiter.check("10.0.0.1", "other@example.com")
+    # IPアドレスで拒否した場合はメールアドレスのトークンを使わない
+    with pytest.raises(HTTPException):
+        await limiter.check("10.0.0.1", "third@example.com")
+    await limiter.check(None, "third@example.com")
+
+    assert limiter.stats() == {"backend": "memory", "entries": 5, "evictions": 0, "rejected_ip": 1,
+                               "rejected_email": 1}
+
+
+def test_parse_limit() -> None:
+    assert parse_limit("5/60") == (5, 5 / 60)
+    assert parse_limit("3") == (3, 3)
+    with pytest.raises(ValueError, match="Invalid rate limit"):
+        parse_limit("0/60")
+
+
+def test_create_auth_rate_limiter(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("AUTH_RATE_LIMIT_EMAIL", "10/5")
+    limiter = create_auth_rate_limiter()
+    assert isinstance(limiter.backend, TokenBucketTable)
+    assert limiter.email_limit == (10, 2)
+
+    monkeypatch.setenv("AUTH_RATE_LIMIT_URL", "memcached://localhost")
+    with pytest.raises(ValueError, match="Unsupported AUTH_RATE_LIMIT_URL"):
+        create_auth_rate_limiter()
+
+    monkeypatch.setenv("AUTH_RATE_LIMIT_ENABLED", "false")
+    assert create_auth_rate_limiter() is None
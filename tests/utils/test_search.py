@@ -0,0 +1,46 @@
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+from utils.search import InvertedIndex, tokenize
+
+OWNER = "test@example.com"
+
+
+def test_tokenize() -> None:
+    assert tokenize("Buy MILK, eggs & bread!") == ["buy", "milk", "eggs", "bread"]
+
+
+def test_search_ranks_by_term_count() -> None:
+    index = InvertedIndex()
+    index.add(OWNER, {"id": "a", "title": "milk", "description": "buy bread"})
+    index.add(OWNER, {"id": "b", "title": "milk", "description": "milk and eggs"})
+    index.add(OWNER, {"id": "c", "title": "eggs", "description": "bread"})
+    index.add("other@example.com", {"id": "d", "title": "milk", "description": "milk milk"})
+
+    assert index.search(OWNER, "milk bread", 0, 10) == ["a", "b", "c"]
+    assert index.search(OWNER, "milk", 0, 10) == ["b", "a"]
+    assert index.search(OWNER, "milk bread", 1, 1) == ["b"]
+    assert index.search(OWNER, "coffee", 0, 10) == []
+
+
+def test_apply_events_replaces_and_removes() -> None:
+    index = InvertedIndex()
+    index.apply(OWNER, {"type": "created", "id": "a", "todo": {"id": "a", "title": "milk", "description": ""}})
+    index.apply(OWNER, {"type": "updated", "id": "a", "todo": {"id": "a", "title": "eggs", "description": ""}})
+
+    assert index.search(OWNER, "milk", 0, 10) == []
+    assert index.search(OWNER, "eggs", 0, 10) == ["a"]
+
+    index.apply(OWNER, {"type": "deleted", "id": "a"})
+    assert index.search(OWNER, "eggs", 0, 10) == []
+    assert index._postings[OWNER] == {}
+
+
+@pytest.mark.asyncio
+async def test_rebuild_from_collection() -> None:
+    collection = AsyncMongoMockClient()["API_DB"].todo
+    result = await collection.insert_one({"owner": OWNER, "title": "milk", "description": "2 bottles"})
+    index = InvertedIndex()
+
+    await index.rebuild(collection)
+
+    assert index.search(OWNER, "bottles", 0, 10) == [str(result.inserted_id)]
@@ -0,0 +1,70 @@
+from pytest import MonkeyPatch
+from pytest_mock import MockFixture
+from utils import serve
+from utils.serve import ServeApplication, TunedUvicornWorker, gunicorn_options, worker_environment
+
+
+def test_worker_count_defaults_to_cpu_count(monkeypatch: MonkeyPatch, mocker: MockFixture) -> None:
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    mocker.patch("utils.serve.cpu_count", return_value=6)
+    assert serve.worker_count() == 6
+
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    assert serve.worker_count() == 3
+
+
+def test_worker_environment_splits_connection_budget(monkeypatch: MonkeyPatch, mocker: MockFixture) -> None:
+    monkeypatch.setattr(serve, "MONGO_CONNECTION_BUDGET", 100)
+    monkeypatch.setenv("MONGO_MIN_POOL_SIZE", "40")
+    monkeypatch.delenv("PASSWORD_HASH_WORKERS", raising=False)
+    mocker.patch("utils.serve.cpu_count", return_value=8)
+
+    assert worker_environment(4) == {"WEB_CONCURRENCY": "4", "MONGO_MAX_POOL_SIZE": "25", "MONGO_MIN_POOL_SIZE": "25",
+                                     "PASSWORD_HASH_WORKERS": "2"}
+    # ワーカーが予算より多くても、最低1接続は使えるようにする
+    assert worker_environment(200)["MONGO_MAX_POOL_SIZE"] == "1"
+
+    monkeypatch.setenv("PASSWORD_HASH_WORKERS", "3")
+    assert worker_environment(4)["PASSWORD_HASH_WORKERS"] == "3"
+
+
+def test_worker_environment_calibrates_password_rounds_once(monkeypatch: MonkeyPatch, mocker: MockFixture) -> None:
+    monkeypatch.setenv("PASSWORD_HASH_ROUNDS", "auto")
+    resolve = mocker.patch("utils.serve.resolve_rounds", return_value=12)
+
+    # 全てのワーカーが同じコストを使うように、計測した値を渡す
+    assert worker_environment(4)["PASSWORD_HASH_ROUNDS"] == "12"
+    resolve.assert_called_once_with("auto")
+
+    monkeypatch.setenv("PASSWORD_HASH_ROUNDS", "11")
+    assert "PASSWORD_HASH_ROUNDS" not in worker_environment(4)
+
+
+def test_serve_application_applies_options(monkeypatch: MonkeyPatch) -> None:
+    monkeypatch.setenv("PORT", "9000")
+    monkeypatch.setattr(serve, "SERVE_MAX_REQUESTS", 500)
+    monkeypatch.setattr(serve, "SERVE_MAX_REQUESTS_JITTER", 50)
+
+    cfg = ServeApplication(gunicorn_options(2)).cfg
+
+    assert cfg.bind == ["0.0.0.0:9000"]
+    assert cfg.workers == 2
+    assert cfg.worker_class is TunedUvicornWorker
+    assert (cfg.max_requests, cfg.max_requests_jitter) == (500, 50)
+    assert cfg.preload_app is False
+    # プロキシの後ろでも、ログインの制限にクライアントのIPアドレスを使えるようにする
+    assert cfg.forwarded_allow_ips == ["*"]
+
+
+def test_worker_cancels_remaining_requests_before_graceful_timeout(mocker: MockFixture) -> None:
+    options = gunicorn_options(1)
+    options["graceful_timeout"] = 30
+    cfg = ServeApplication(options).cfg
+    # uvicornのロガーの設定を変更しないようにする
+    mocker.patch("uvicorn.workers.logging.getLogger")
+    worker = TunedUvicornWorker(0, 0, [], mocker.MagicMock(), 30, cfg, mocker.MagicMock())
+
+    assert worker.config.timeout_graceful_shutdown == 25
+    assert worker.config.lifespan == "on"
+    # uvloopとhttptoolsの選択はuvicornに任せる
+    assert (worker.config.loop, worker.config.http) == ("auto", "auto")
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from utils.slow_queries import (
+    SlowQueryListener,
+    explain_command,
+    query_operation,
+    query_route,
+    summarize_plan,
+    trace_queries,
+)
+
+
+def command_events(name: str, command: dict, duration_micros: int) -> tuple[SimpleNamespace, SimpleNamespace]:
+    started = SimpleNamespace(request_id=1, connection_id=("db", 27017), command_name=name, command=command)
+    succeeded = SimpleNamespace(request_id=1, connection_id=("db", 27017), command_name=name,
+                                database_name="API_DB", duration_micros=duration_micros)
+    return started, succeeded
+
+
+@pytest.mark.asyncio
+async def test_trace_queries_sets_operation() -> None:
+    @trace_queries
+    class Service:
+        async def fetch(self) -> str:
+            return query_operation.get()
+
+        async def _private(self) -> str:
+            return query_operation.get()
+
+    assert await Service().fetch() == "Service.fetch"
+    assert await Service()._private() == ""
+    assert query_operation.get() == ""
+
+
+def test_fast_command_is_not_logged(caplog: pytest.LogCaptureFixture) -> None:
+    listener = SlowQueryListener(threshold_ms=100, explain_rate=1)
+    started, succeeded = command_events("find", {"find": "todo"}, 99_000)
+
+    listener.started(started)
+    listener.succeeded(succeeded)
+
+    assert caplog.records == []
+    assert listener._started == {}
+
+
+def test_slow_command_logged_with_route_and_operation(caplog: pytest.LogCaptureFixture) -> None:
+    listener = SlowQueryListener(threshold_ms=100, explain_rate=1)
+    started, succeeded = command_events("find", {"find": "todo", "filter": {"owner": "a"}}, 150_000)
+    route_token = query_route.set("GET /api/todos")
+    operation_token = query_operation.set("TodoService.get_todos")
+    try:
+        listener.started(started)
+    finally:
+        query_route.reset(route_token)
+        query_operation.reset(operation_token)
+
+    with caplog.at_level(logging.WARNING):
+        listener.succeeded(succeeded)
+
+    # クライアントを設定していないのでexplainせずにログだけを出力する
+    assert caplog.messages == ["Slow MongoDB command: find API_DB.todo took 150.0ms "
+                               "(route=GET /api/todos, operation=TodoService.get_todos)"]
+
+
+@pytest.mark.asyncio
+async def test_slow_command_explained(caplog: pytest.LogCaptureFixture) -> None:
+    db = MagicMock()
+    db.command = AsyncMock(return_value={
+        "queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}},
+        "executionStats": {"totalKeysExamined": 0, "totalDocsExamined": 5000},
+    })
+    client = MagicMock()
+    client.__getitem__.return_value = db
+    listener = SlowQueryListener(threshold_ms=100, explain_rate=1)
+    listener.bind(client)
+    started, succeeded = command_events("find", {"find": "todo", "filter": {"owner": "a"}, "$db": "API_DB",
+                                                 "lsid": {"id": 1}}, 150_000)
+
+    with caplog.at_level(logging.WARNING):
+        listener.started(started)
+        listener.succeeded(succeeded)
+        await asyncio.sleep(0)
+        await asyncio.gather(*listener._tasks)
+    await listener.close()
+
+    db.command.assert_awaited_once_with({"explain": {"find": "todo", "filter": {"owner": "a"}},
+                                         "verbosity": "executionStats"})
+    assert caplog.messages[0].endswith("; plan=COLLSCAN keysExamined=0 docsExamined=5000")
+
+
+def test_explain_command_strips_session_fields() -> None:
+    command = {"update": "todo", "updates": [], "$db": "API_DB", "lsid": {}, "txnNumber": 1, "writeConcern": {}}
+
+    assert explain_command(command) == {"explain": {"update": "todo", "updates": []}, "verbosity": "executionStats"}
+
+
+def test_summarize_plan() -> None:
+    plan = {"queryPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "owner_id"}}}
+
+    assert summarize_plan(plan) == "FETCH > IXSCAN(owner_id)"
+    assert summarize_plan(None) == "unknown"
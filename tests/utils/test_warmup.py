@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from main import create_app
+from mongomock_motor import AsyncMongoMockClient
+from pytest_mock import MockFixture
+from utils.auth import get_password_rounds, load_password_backend
+from utils.dependencies import DATABASE_NAME
+from utils.warmup import warm_up
+
+APP_DIR = Path(__file__).resolve().parents[2] / "app"
+
+
+def test_import_main_defers_heavy_modules() -> None:
+    # 別のプロセスでインポートし、最初のリクエストまで不要なモジュールが読み込まれていないことを確認する
+    code = "import sys, main; print(sorted({'passlib', 'mongomock'} & set(sys.modules)))"
+    env = {**os.environ, "PYTHONPATH": str(APP_DIR)}
+    result = subprocess.run([sys.executable, "-c", code], cwd=APP_DIR, env=env, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip() == "[]"
+
+
+@pytest.mark.asyncio
+async def test_warm_up_pings_mongo_and_loads_password_backend(mocker: MockFixture) -> None:
+    db = MagicMock()
+    db.command = AsyncMock(return_value={"ok": 1})
+    run = mocker.patch("utils.warmup.password_pool.run", AsyncMock(return_value="bcrypt"))
+
+    timings = await warm_up(db)
+
+    db.command.assert_awaited_once_with("ping")
+    # 親プロセスで決めたbcryptのコストでワーカーのバックエンドを読み込む
+    run.assert_awaited_once_with(load_password_backend, get_password_rounds())
+    assert set(timings) == {"mongo", "password_hash"}
+
+
+@pytest.mark.asyncio
+async def test_warm_up_ensures_indexes_and_survives_failures(mocker: MockFixture) -> None:
+    ensure = mocker.patch("utils.warmup.ensure_indexes", AsyncMock(side_effect=RuntimeError("unreachable")))
+    mocker.patch("utils.warmup.password_pool.run", AsyncMock(return_value="bcrypt"))
+
+    timings = await warm_up(MagicMock(), ensure=True)
+
+    ensure.assert_awaited_once()
+    assert set(timings) == {"password_hash"}
+
+
+@pytest.mark.asyncio
+async def test_lifespan_creates_user_index_before_serving(mocker: MockFixture) -> None:
+    # ユーザー登録はemailのユニークインデックスで重複を検出するので、バックグラウンドの準備を待たずに作成する
+    mongo_client = AsyncMongoMockClient()
+    mocker.patch("main.connect_client", return_value=mongo_client)
+    mocker.patch("main.warm_up", AsyncMock(return_value={}))
+    mocker.patch("main.slow_queries", MagicMock(close=AsyncMock()))
+    mocker.patch("main.password_pool")
+    app = create_app()
+
+    async with app.router.lifespan_context(app):
+        indexes = await mongo_client[DATABASE_NAME].user.index_information()
+        assert indexes["email_unique"]["unique"] is True
+        assert await mongo_client[DATABASE_NAME].todo.index_information() == {}
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+import pytest
+from fastapi import HTTPException
+from utils.worker_pool import BoundedWorkerPool
+
+
+@pytest.mark.asyncio
+async def test_run_returns_result() -> None:
+    pool = BoundedWorkerPool("thread", max_workers=1)
+    result = await pool.run(pow, 2, 10)
+    assert result == 1024
+    assert pool.stats()["completed"] == 1
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_in_worker_thread() -> None:
+    pool = BoundedWorkerPool("thread", max_workers=1)
+    thread_name = await pool.run(lambda: threading.current_thread().name)
+    assert thread_name != threading.current_thread().name
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_rejects_when_queue_is_full() -> None:
+    pool = BoundedWorkerPool("thread", max_workers=1, max_queue=1)
+    release = threading.Event()
+
+    # 1件実行中、1件待機中の状態を作る
+    tasks = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert pool.stats()["running"] == 1
+    assert pool.stats()["queued"] == 1
+
+    with pytest.raises(HTTPException) as exc_info:
+        await pool.run(release.wait)
+    assert exc_info.value.status_code == 503
+    assert pool.stats()["rejected"] == 1
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert pool.stats()["queued"] == 0
+    assert pool.stats()["completed"] == 2
+    pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_in_process_pool() -> None:
+    pool = BoundedWorkerPool("process", max_workers=1)
+    result = await pool.run(pow, 3, 3)
+    assert result == 27
+    pool.shutdown()
+
+
+def test_unknown_kind() -> None:
+    with pytest.raises(ValueError):
+        BoundedWorkerPool("fiber")